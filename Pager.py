@@ -0,0 +1,55 @@
+# Functions defined in class Pager:
+#     Show        prints a page, pulling only as many lines from the source as
+#                 that page needs
+#     Next        shows the page after the current one
+#     Previous    shows the page before the current one
+#
+# The source is any iterable of lines, usually a generator, so a listing over
+# millions of stacks only does the work for the lines that are actually
+# looked at. Lines that have been produced are kept, so going back is free.
+
+class Pager(object):
+    def __init__(self, aLines, aPageLen):
+        self.source = iter(aLines)
+        self.pageLen = max(aPageLen, 1)
+        self.lines = []
+        self.done = False
+        self.page = 0
+
+    # Pulls lines from the source until there are at least aCount, or the
+    # source runs out.
+    def _Fill(self, aCount):
+        while not self.done and len(self.lines) < aCount:
+            try:
+                self.lines.append(next(self.source))
+            except StopIteration:
+                self.done = True
+
+    # Returns the lines of 0-based page aPage, and whether there is anything
+    # after it.
+    def GetPage(self, aPage):
+        start = aPage * self.pageLen
+        self._Fill(start + self.pageLen + 1) # one extra to know if there's more
+        return self.lines[start:start + self.pageLen], len(self.lines) > start + self.pageLen
+
+    def Show(self, aPage):
+        if aPage < 0:
+            print("Already at the first page")
+            return
+        lines, more = self.GetPage(aPage)
+        if not lines and aPage:
+            print("No more pages")
+            return
+        self.page = aPage
+        for line in lines:
+            print(line)
+        if more:
+            print("-- page {}, n for next, p for previous --".format(aPage + 1))
+        elif aPage:
+            print("-- page {} of {}, p for previous --".format(aPage + 1, aPage + 1))
+
+    def Next(self):
+        self.Show(self.page + 1)
+
+    def Previous(self):
+        self.Show(self.page - 1)
@@ -0,0 +1,297 @@
+import bz2
+import calendar
+import gzip
+import json
+import lzma
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+
+# Functions defined here:
+#     GetLeafName     lowercased file name of a module path
+#     ShardRanges     splits a dump file into line-aligned byte ranges
+#     OpenDump        memory-maps a dump file
+#     ScanLines       yields the byte offsets of each line in a range of a dump
+#     IsCompressed    whether a dump is compressed
+#     StreamLines     yields the lines of a compressed dump, decompressing on
+#                     another thread
+#     PreFilter       cheap byte-level check for pings that will be dropped
+#     ParsePing       decodes one ping line
+#     ParseTime       ping creation date to seconds since the epoch
+#     PingResults     yields the stack records of one decoded ping, one list
+#                     per result
+#     ReadResults     yields the stack records of a ping dump, one list per
+#                     result
+#     LineResults     ReadResults for one line of a dump
+#
+# A ping dump is a file where each line is one raw JSON ping, as exported from
+# telemetry (eg "big.json").
+#
+# Dumps are read through mmap and scanned for line boundaries as raw bytes, so
+# nothing is decoded up front and the OS pages the file in and out as needed;
+# dumps larger than RAM are fine. Only the lines that are parsed get copied out
+# of the map, and they go to the JSON decoder as bytes.
+#
+# Dumps ending in .gz, .xz or .bz2 are decompressed as a stream instead. A
+# thread decompresses into a small queue of chunks while the caller parses, so
+# the two overlap (zlib, lzma and bz2 release the GIL while they work), and
+# nothing is written to disk. A compressed dump can't be split into byte
+# ranges, so ShardRanges gives all of it to the first shard.
+
+# compressed dump extension -> function opening it for binary reading
+COMPRESSED_OPENERS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open,
+}
+
+# Why an ineligible ping is dropped, in the order PingResults checks. Each is
+# counted in the stats as "dropped <reason>".
+DROP_WOW64 = "wow64"
+DROP_NO_STACKS = "no stacks or client"
+DROP_NO_RESULTS = "no results"
+# A result with no event at its index is dropped on its own, the rest of the
+# ping is kept, so this one counts results rather than pings.
+DROP_NO_EVENT = "no event"
+
+PREFILTER_WOW64 = re.compile(rb'"is_wow64"\s*:\s*(true|false)')
+
+# Decompressed bytes per chunk handed from the decompression thread, and the
+# number of chunks it can get ahead of the parser.
+STREAM_CHUNK = 1 << 20
+STREAM_QUEUE_LEN = 8
+
+def GetLeafName(path):
+    return os.path.split(path)[1].lower()
+
+# Splits the file at aPath into aNumShards contiguous byte ranges. The ranges
+# are only approximately equal in size; ReadResults takes care of aligning them
+# to line boundaries, so every line belongs to exactly one range. For a
+# compressed dump, the first range is the whole file and the rest are empty.
+#
+# Returns a list of (start, end) tuples.
+def ShardRanges(aPath, aNumShards):
+    size = os.path.getsize(aPath)
+    if IsCompressed(aPath):
+        return [(0, size)] + [(size, size)] * (aNumShards - 1)
+    bounds = [size * i // aNumShards for i in range(aNumShards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Returns an mmap of the file at aPath, or None if the file is empty (which
+# can't be mapped). The caller closes it.
+def OpenDump(aPath):
+    with open(aPath, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        ret = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    if hasattr(ret, "madvise"):
+        ret.madvise(mmap.MADV_SEQUENTIAL)
+    return ret
+
+# Yields (start, end) byte offsets of each line of aMap in the range
+# [aStart, aEnd), not including the newline. Empty lines are skipped. aMap can
+# be an mmap or any bytes-like object.
+#
+# If aStart falls inside a line, that line belongs to the previous range and
+# is skipped. A line that starts before aEnd is yielded in full. None for aEnd
+# means the end of the map.
+def ScanLines(aMap, aStart = 0, aEnd = None):
+    size = len(aMap)
+    end = size if aEnd is None else min(aEnd, size)
+    pos = aStart
+    if pos and aMap[pos - 1] != ord("\n"):
+        pos = aMap.find(b"\n", pos)
+        pos = size if pos == -1 else pos + 1
+    while pos < end:
+        lineEnd = aMap.find(b"\n", pos)
+        if lineEnd == -1:
+            lineEnd = size
+        if lineEnd > pos and not (lineEnd == pos + 1 and aMap[pos] == ord("\r")):
+            yield pos, lineEnd
+        pos = lineEnd + 1
+
+def IsCompressed(aPath):
+    return os.path.splitext(aPath)[1].lower() in COMPRESSED_OPENERS
+
+# Reads the compressed file at aPath in chunks onto aQueue, followed by None,
+# or by the exception if reading fails. Stops early once aStop is set.
+def _DecompressChunks(aPath, aQueue, aStop):
+    try:
+        with COMPRESSED_OPENERS[os.path.splitext(aPath)[1].lower()](aPath, "rb") as f:
+            while not aStop.is_set():
+                chunk = f.read(STREAM_CHUNK)
+                if not chunk:
+                    break
+                aQueue.put(chunk)
+        aQueue.put(None)
+    except Exception as e:
+        aQueue.put(e)
+
+# Yields each line of the compressed dump at aPath as bytes, without the
+# newline. Empty lines are skipped, as in ScanLines.
+def StreamLines(aPath):
+    chunks = queue.Queue(STREAM_QUEUE_LEN)
+    stop = threading.Event()
+    thread = threading.Thread(target = _DecompressChunks, args = (aPath, chunks, stop), daemon = True)
+    thread.start()
+    try:
+        rest = b""
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                if line and line != b"\r":
+                    yield line
+        if rest and rest != b"\r":
+            yield rest
+    finally:
+        # unblock the thread if we stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+
+# Looks at the raw bytes aBuffer[aStart:aEnd] of one ping line and returns the
+# reason PingResults would drop it for, if that's certain without decoding,
+# and None otherwise. aBuffer can be bytes or an mmap; nothing is copied.
+#
+# It relies on "is_wow64" appearing exactly once in a ping (in
+# environment.system), and on keys not being written with \u escapes; lines
+# with any \u escape aren't rejected for missing keys. A line this passes
+# still gets all the real checks after it's decoded.
+def PreFilter(aBuffer, aStart, aEnd):
+    wow64 = PREFILTER_WOW64.search(aBuffer, aStart, aEnd)
+    if not wow64 or aBuffer.find(b'"is_wow64"', aStart, aEnd) != wow64.start() \
+            or aBuffer.find(b'"is_wow64"', wow64.end(), aEnd) != -1:
+        return None
+    if wow64.group(1) == b"true":
+        return DROP_WOW64
+    if aBuffer.find(b"\\u", aStart, aEnd) != -1:
+        return None
+    if aBuffer.find(b'"symbolicated_stacks"', aStart, aEnd) == -1 or aBuffer.find(b'"client_id"', aStart, aEnd) == -1:
+        return DROP_NO_STACKS
+    # symbolicated_stacks is itself JSON in a string, so its keys are escaped
+    if aBuffer.find(b'\\"results\\"', aStart, aEnd) == -1:
+        return DROP_NO_RESULTS
+    return None
+
+def _Drop(aStats, aReason):
+    key = "dropped " + aReason
+    aStats[key] = aStats.get(key, 0) + 1
+
+# Decodes one ping line, given as bytes. Invalid UTF-8 is replaced rather than
+# failing the ping.
+def ParsePing(aLine):
+    try:
+        return json.loads(aLine)
+    except UnicodeDecodeError:
+        return json.loads(aLine.decode("utf-8", errors = 'replace'))
+
+# Returns the ping creation date aDate, eg "2019-07-01T12:34:56.789Z", as
+# seconds since the epoch, or None if it isn't a date in that form. The
+# fraction and zone are ignored; telemetry dates are UTC.
+def ParseTime(aDate):
+    if not isinstance(aDate, str):
+        return None
+    try:
+        return calendar.timegm(time.strptime(aDate[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+# Yields, for every result of the decoded ping aData if it's eligible, a list
+# of stack records {
+#     "frames"      the symbolicated stack frames
+#     "clientID"    the client that sent the ping
+#     "threadName"  the name of the thread that loaded the module
+#     "modules"     list of leaf names of the modules loaded in the event
+#     "timestamp"   when the ping was created, in seconds since the epoch, or
+#                   None if the ping has no valid "creation_date"
+# }
+#
+# aStats    dict with a "results" counter, updated as results are read. A
+#           dropped ping, or a result without an event, adds one to
+#           "dropped <reason>" (see DROP_*).
+def PingResults(aData, aStats):
+    if aData["environment"]["system"]["is_wow64"]:
+        _Drop(aStats, DROP_WOW64)
+        return
+    if not ("symbolicated_stacks" in aData) or not ("client_id" in aData):
+        _Drop(aStats, DROP_NO_STACKS)
+        return
+    realstacks = json.loads(aData["symbolicated_stacks"])
+    if "results" not in realstacks:
+        _Drop(aStats, DROP_NO_RESULTS)
+        return
+    aStats["results"] += len(realstacks["results"])
+    timestamp = ParseTime(aData["creation_date"] if "creation_date" in aData else None)
+    events = aData["payload"]["events"]
+    for idx, result in enumerate(realstacks["results"]):
+        event = events[idx] if idx < len(events) else None
+        if not event:
+            _Drop(aStats, DROP_NO_EVENT)
+            continue
+        yield list(map(lambda stack: {
+            "frames": stack,
+            "clientID": aData["client_id"],
+            "threadName": event["thread_name"],
+            "modules": list(map(lambda m: GetLeafName(m["module_name"]), event["modules"])),
+            "timestamp": timestamp,
+            }, filter(lambda stack: stack, result["stacks"])))
+
+# Reads the ping dump at aPath, which can be compressed, and yields the stack
+# records of every ping in it, as PingResults does.
+#
+# aStats    dict with "pings" and "results" counters, updated as lines are
+#           read. Drop reasons are counted as in PingResults, and pings that
+#           PreFilter rejected without decoding them in "prefiltered".
+# aStart    byte offset to start at. If it falls inside a line, that line
+#           belongs to the previous range and is skipped.
+# aEnd      byte offset to stop at; a line that starts before aEnd is read in
+#           full. None means the end of the file.
+# aPrefilter  False decodes every ping. The results and counters are the same
+#           either way, apart from "prefiltered".
+def ReadResults(aPath, aStats, aStart = 0, aEnd = None, aPrefilter = True):
+    if IsCompressed(aPath):
+        if aStart:
+            return # not the first shard; see ShardRanges
+        for line in StreamLines(aPath):
+            yield from LineResults(line, aStats, aPrefilter)
+        return
+
+    dump = OpenDump(aPath)
+    if dump is None:
+        return
+    try:
+        for lineStart, lineEnd in ScanLines(dump, aStart, aEnd):
+            aStats["pings"] += 1
+            yield from _LineResults(dump, lineStart, lineEnd, aStats, aPrefilter)
+    finally:
+        dump.close()
+
+# Yields the stack records of the ping dump line aLine, a bytes object, as
+# ReadResults does, and counts it in aStats["pings"]. For readers that keep
+# track of their own position in a dump, eg by line number.
+def LineResults(aLine, aStats, aPrefilter = True):
+    aStats["pings"] += 1
+    yield from _LineResults(aLine, 0, len(aLine), aStats, aPrefilter)
+
+# PingResults for the line aBuffer[aStart:aEnd], PreFilter first if
+# aPrefilter.
+def _LineResults(aBuffer, aStart, aEnd, aStats, aPrefilter):
+    if aPrefilter:
+        reason = PreFilter(aBuffer, aStart, aEnd)
+        if reason:
+            aStats["prefiltered"] = aStats.get("prefiltered", 0) + 1
+            _Drop(aStats, reason)
+            return
+    yield from PingResults(ParsePing(aBuffer[aStart:aEnd]), aStats)
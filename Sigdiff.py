@@ -0,0 +1,196 @@
+import argparse
+import json
+import sys
+import time
+
+import Pingdata
+import Stacksig
+
+# Functions defined in class RuleDiff:
+#     AddStack       signaturizes one stack record under both rule sets
+#     Moved          (from, to, stacks) for every signature change
+#     Splits         old signatures whose stacks went to several new ones
+#     Merges         new signatures that took stacks from several old ones
+#     CountChanges   client counts per signature that went up or down
+#     Report         yields the lines of a readable report
+#
+# Module functions:
+#     LoadRules      a Stacksig with rules overridden from a JSON file
+#
+# A rule diff runs two Stacksig configurations, "a" (usually the current
+# rules) and "b" (the proposed ones), over the same stacks. The frame
+# signatures (Stacksig.FrameSignatures) don't depend on the rules, so both
+# rule sets share them through a _SharedFrames, which converts each frame at
+# most once and only when one of the rule sets gets that far. A signature is
+# usually settled a few frames in, so most of a long stack is never converted. Both Stacksigs must use the same limits.
+#
+# Counts per signature are unique clients, as in Sigindex.
+#
+# Command line usage:
+#     Sigdiff.py big.json --b proposed.json
+#     Sigdiff.py big.json --a old.json --b new.json --examples 3
+# where the rule files hold any of "ignoreFrameSubstrings",
+# "floorFrameSubstrings" and "targetFrameSubstrings" as lists of strings.
+
+RULE_NAMES = ["ignoreFrameSubstrings", "floorFrameSubstrings", "targetFrameSubstrings"]
+
+# The items of aIterable, pulled from it only as far as anyone iterating over
+# this has got, and kept for the next iteration.
+class _SharedFrames(object):
+    def __init__(self, aIterable):
+        self.source = iter(aIterable)
+        self.items = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self.items):
+                item = next(self.source, None)
+                if item is None:
+                    return
+                self.items.append(item)
+            yield self.items[i]
+            i += 1
+
+class RuleDiff(object):
+    def __init__(self, aUtilsA, aUtilsB, aNumExamples = 3):
+        for limit in ["MAX_FRAMES_TO_SCAN", "MAX_SYMBOL_LEN"]:
+            if getattr(aUtilsA, limit) != getattr(aUtilsB, limit):
+                raise ValueError("Rule sets must share limits; {} differs".format(limit))
+        self.utilsA = aUtilsA
+        self.utilsB = aUtilsB
+        self.numExamples = aNumExamples
+        self.numStacks = 0
+        self.transitions = {} # (signature a, signature b) -> number of stacks
+        self.examples = {} # (signature a, signature b) -> up to numExamples stack records
+        self.clientsA = set() # (clientID, signature a)
+        self.clientsB = set() # (clientID, signature b)
+
+    # aStack is a stack record from Pingdata.ReadResults.
+    def AddStack(self, aStack):
+        frames = _SharedFrames(self.utilsA.FrameSignatures(aStack["frames"]))
+        threadName = aStack["threadName"] if "threadName" in aStack else None
+        sigA, _ = self.utilsA.SignatureFromFrames(frames, threadName, False)
+        sigB, _ = self.utilsB.SignatureFromFrames(frames, threadName, False)
+        key = (sigA, sigB)
+        self.numStacks += 1
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        if sigA != sigB:
+            examples = self.examples.setdefault(key, [])
+            if len(examples) < self.numExamples:
+                examples.append(aStack)
+        clientID = aStack["clientID"] if "clientID" in aStack else None
+        self.clientsA.add((clientID, sigA))
+        self.clientsB.add((clientID, sigB))
+
+    # Returns a list of (signature a, signature b, number of stacks) for every
+    # pair where the signature changed, most stacks first.
+    def Moved(self):
+        ret = [(a, b, n) for (a, b), n in self.transitions.items() if a != b]
+        return sorted(ret, key = lambda x: (-x[2], x[0], x[1]))
+
+    # Returns a dict signature a -> {signature b: stacks} for each old
+    # signature whose stacks now get more than one signature.
+    def Splits(self):
+        return self._Fanout(0)
+
+    # Returns a dict signature b -> {signature a: stacks} for each new
+    # signature that stacks with more than one old signature now share.
+    def Merges(self):
+        return self._Fanout(1)
+
+    def _Fanout(self, aSide):
+        groups = {}
+        for key, n in self.transitions.items():
+            groups.setdefault(key[aSide], {})[key[1 - aSide]] = n
+        return {sig: targets for sig, targets in groups.items() if len(targets) > 1}
+
+    # Returns a list of (signature, clients under a, clients under b) for
+    # each signature whose client count changed, biggest change first.
+    def CountChanges(self):
+        countsA = _CountClients(self.clientsA)
+        countsB = _CountClients(self.clientsB)
+        ret = []
+        for sig in set(countsA) | set(countsB):
+            a = countsA[sig] if sig in countsA else 0
+            b = countsB[sig] if sig in countsB else 0
+            if a != b:
+                ret.append((sig, a, b))
+        return sorted(ret, key = lambda x: (-abs(x[2] - x[1]), x[0]))
+
+    # Yields the lines of a report showing at most aTop entries per section.
+    def Report(self, aTop = 20):
+        moved = self.Moved()
+        numMoved = sum(n for _, _, n in moved)
+        yield "{} of {} stacks changed signature ({} distinct changes)".format(numMoved, self.numStacks, len(moved))
+
+        changes = self.CountChanges()
+        yield "\n{} signatures changed client count:".format(len(changes))
+        for sig, a, b in changes[:aTop]:
+            yield "  {:6d} -> {:6d} ({:+d}) : {}".format(a, b, b - a, sig)
+
+        splits = self.Splits()
+        yield "\n{} signatures split:".format(len(splits))
+        for sig in sorted(splits, key = lambda s: -sum(splits[s].values()))[:aTop]:
+            yield "  {}".format(sig)
+            for target, n in sorted(splits[sig].items(), key = lambda x: -x[1]):
+                yield "      {:6d} -> {}".format(n, target)
+
+        merges = self.Merges()
+        yield "\n{} signatures merged:".format(len(merges))
+        for sig in sorted(merges, key = lambda s: -sum(merges[s].values()))[:aTop]:
+            yield "  {}".format(sig)
+            for source, n in sorted(merges[sig].items(), key = lambda x: -x[1]):
+                yield "      {:6d} <- {}".format(n, source)
+
+        yield "\nExamples:"
+        for a, b, n in moved[:aTop]:
+            yield "  {:6d} stacks: {}  ->  {}".format(n, a, b)
+            for stack in self.examples[(a, b)]:
+                frames = sorted(stack["frames"][:self.utilsA.MAX_FRAMES_TO_SCAN], key = lambda f: f["frame"])
+                yield "      client {}: {}".format(
+                    stack["clientID"] if "clientID" in stack else None,
+                    " / ".join(self.utilsA.FrameDictToString(f, True, False)[0] for f in frames[:6]))
+
+def _CountClients(aPairs):
+    ret = {}
+    for _, sig in aPairs:
+        ret[sig] = ret.get(sig, 0) + 1
+    return ret
+
+# Returns a Stacksig whose rules are overridden by those in the JSON file at
+# aPath. Rules missing from the file keep their defaults. None for aPath
+# returns the defaults.
+def LoadRules(aPath):
+    ret = Stacksig.Stacksig()
+    if aPath:
+        with open(aPath, "r") as f:
+            rules = json.load(f)
+        for name in rules:
+            if name not in RULE_NAMES:
+                raise ValueError("Unknown rule list {}".format(name))
+            setattr(ret, name, tuple(rules[name]))
+    return ret
+
+def main(aArgs):
+    parser = argparse.ArgumentParser(description = "Compare the signatures two rule sets give a corpus.")
+    parser.add_argument("inputs", nargs = "+", help = "ping dumps")
+    parser.add_argument("--a", help = "JSON rules for the first rule set (default: current rules)")
+    parser.add_argument("--b", help = "JSON rules for the second rule set (default: current rules)")
+    parser.add_argument("--examples", type = int, default = 3, help = "example stacks kept per change")
+    parser.add_argument("--top", type = int, default = 20, help = "entries shown per section")
+    args = parser.parse_args(aArgs)
+
+    start = time.time()
+    diff = RuleDiff(LoadRules(args.a), LoadRules(args.b), args.examples)
+    stats = {"pings": 0, "results": 0}
+    for path in args.inputs:
+        for filtered in Pingdata.ReadResults(path, stats):
+            for stack in filtered:
+                diff.AddStack(stack)
+    for line in diff.Report(args.top):
+        print(line)
+    sys.stderr.write("{} pings, {} stacks in {:.1f}s\n".format(stats["pings"], diff.numStacks, time.time() - start))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,429 @@
+import numpy as np
+
+import Sigsample
+import Stacksig
+
+# Functions defined in class SigIndex:
+#     SortSignatures         reorders the signature display list
+#     SortedOrder            a sorted signature order, leaving the display
+#                            list alone
+#     FilterSignatures       signature IDs, in display order, matching a substring
+#     SignatureForHash       the signature ID with a given Stacksig.SignatureHash
+#     SignatureModules       module names loaded by a signature's stacks
+#     ModuleBits             bitset of the modules matching a substring
+#     SignaturesWithModule   signatures that loaded a module matching a substring
+#     SignaturesWithAllModules  signatures that loaded a module matching each of
+#                            several substrings
+#     ModulePrevalence       module IDs sorted by how many signatures loaded them
+#     CoLoadedModules        modules most often loaded by the same stacks as a
+#                            module
+#     StacksForSignature     indices of the deduplicated stacks for a signature
+#     NumStacks              number of deduplicated stacks kept for a
+#                            signature
+#     SampleStacks           keeps only a random sample of stacks per signature
+#     Components             the index's data grouped for memory accounting
+#     BuildFrameText         pretty-prints every stack once for frame searches
+#     StacksMatchingFrames   stacks with a frame containing a substring
+#
+# Module functions outside the class:
+#     BitsToIds              the set bit positions of a bitset
+#     IdsToBits              a bitset with the given bit positions set
+#     PopCount               the number of set bits in a bitset
+#
+# SigIndex is the analysis layer over a signaturized corpus. Signature, module
+# and client strings are interned into integer IDs exactly once, and everything
+# after that (dedup, counts, per-module prevalence, filtered listings) is done
+# with numpy over those IDs instead of nested loops over dicts and sets.
+#
+# Signature IDs are assigned by descending occurrence count, so ID 0 is the
+# most common signature. This matches the IDs main.py has always shown. They
+# change whenever the data does; signatureHashes holds each signature's
+# Stacksig.SignatureHash, which doesn't, for matching signatures across runs.
+#
+# The modules loaded by each signature are kept as a plain Python int used as a
+# bitset over module IDs. Module IDs are assigned by descending prevalence, so
+# the handful of modules that show up everywhere live in the low bits and most
+# bitsets stay a few machine words long. Union, intersection and cardinality
+# are then single int operations.
+#
+# Module co-occurrence, how many deduplicated stacks loaded both of two
+# modules, is kept as a sparse symmetric matrix in compressed rows: module i's
+# row is coModules / coCounts[coOffsets[i]:coOffsets[i + 1]], most often
+# co-loaded first. Only pairs that actually occur take space.
+#
+# Counts and module sets always cover every stack. With SampleStacks, only a
+# bounded random sample of each signature's stacks is kept to look at; the
+# rest are dropped after the counts are taken. A corpus sampled as it was read
+# (see Sigpartial.PartialAggregate) only passes in the frames of its sample.
+
+# Most module pairs expanded at once while counting co-occurrence, to bound the
+# temporary arrays when stacks list many modules.
+CO_BLOCK_PAIRS = 1 << 22
+
+# Returns a numpy array of the set bit positions of aBits, ascending.
+def BitsToIds(aBits):
+    if not aBits:
+        return np.zeros(0, dtype=np.int64)
+    raw = np.frombuffer(aBits.to_bytes((aBits.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little"))
+
+# Returns a bitset with the bits in aIds (a numpy array of ints) set.
+def IdsToBits(aIds):
+    if not len(aIds):
+        return 0
+    mask = np.zeros(int(aIds.max()) + 1, dtype=bool)
+    mask[aIds] = True
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+# Returns the number of set bits in aBits.
+def PopCount(aBits):
+    return bin(aBits).count("1")
+
+class SigIndex(object):
+    # aStacks   List of stack dicts which already carry "signature",
+    #           "clientID" and "modules" (a list of module leaf names).
+    #           Stacks without "frames" (see Sigsample.StackStub) are
+    #           counted like the rest but aren't kept in self.stacks, as if
+    #           SampleStacks had dropped them.
+    #
+    # aSampleSize, aMemoryBudget
+    #           Optional; see SampleStacks.
+    #
+    # Duplicate (clientID, signature) pairs are removed the same way a dict
+    # keyed on "clientID|signature" would: the stack is positioned where the
+    # pair was first seen, but the last stack seen for the pair is kept.
+    def __init__(self, aStacks, aSampleSize = None, aMemoryBudget = None):
+        sigIds = {}
+        clientIds = {}
+        moduleIds = {}
+        rawSig = []
+        rawClient = []
+        rawModCounts = []
+        rawMods = []
+        for stack in aStacks:
+            rawSig.append(sigIds.setdefault(stack["signature"], len(sigIds)))
+            rawClient.append(clientIds.setdefault(stack["clientID"], len(clientIds)))
+            mods = stack["modules"]
+            rawModCounts.append(len(mods))
+            rawMods.extend(moduleIds.setdefault(m, len(moduleIds)) for m in mods)
+
+        numRaw = len(rawSig)
+        numSigs = len(sigIds)
+        rawSig = np.array(rawSig, dtype=np.int64)
+        rawClient = np.array(rawClient, dtype=np.int64)
+        rawModCounts = np.array(rawModCounts, dtype=np.int64)
+        rawMods = np.array(rawMods, dtype=np.int64)
+
+        # Module IDs are renumbered alphabetically first, so that prevalence
+        # ties below are broken alphabetically.
+        moduleNames = sorted(moduleIds)
+        remap = np.empty(len(moduleIds), dtype=np.int64)
+        remap[[moduleIds[m] for m in moduleNames]] = np.arange(len(moduleNames))
+        rawMods = remap[rawMods]
+
+        # dedup on (client, signature)
+        keys = rawClient * max(numSigs, 1) + rawSig
+        _, firstIdx = np.unique(keys, return_index=True)
+        _, lastIdxReversed = np.unique(keys[::-1], return_index=True)
+        kept = (numRaw - 1 - lastIdxReversed)[np.argsort(firstIdx, kind="stable")]
+
+        # gather the module lists of the kept stacks
+        rawModStarts = np.cumsum(rawModCounts) - rawModCounts
+        lengths = rawModCounts[kept]
+        keptStarts = np.cumsum(lengths) - lengths
+        gather = np.arange(lengths.sum()) + np.repeat(rawModStarts[kept] - keptStarts, lengths)
+        keptMods = rawMods[gather]
+
+        # Renumber signatures by descending count. The sort is stable, so ties
+        # stay in first-seen order.
+        counts = np.bincount(rawSig[kept], minlength=numSigs)
+        rank = np.argsort(-counts, kind="stable")
+        newSigId = np.empty(numSigs, dtype=np.int64)
+        newSigId[rank] = np.arange(numSigs)
+        sigNames = list(sigIds)
+
+        self.numDuplicates = numRaw - len(kept)
+        self.stacks = [aStacks[i] for i in kept]
+        self.signatures = [sigNames[i] for i in rank]
+        self.numClients = len(clientIds)
+        self.stackSig = newSigId[rawSig[kept]]
+        self.counts = counts[rank]
+        self.numSampledOut = 0
+        self._BuildPostings()
+
+        # Distinct (signature, module) pairs. This is the whole "which
+        # signature loaded which module" relation.
+        numMods = max(len(moduleNames), 1)
+        pairs = np.unique(np.repeat(self.stackSig, lengths) * numMods + keptMods)
+        pairSig = pairs // numMods
+        pairMod = pairs % numMods
+
+        # Renumber modules by descending prevalence (ties alphabetical), then
+        # fold each signature's modules into a bitset.
+        prevalence = np.bincount(pairMod, minlength=len(moduleNames))
+        modRank = np.argsort(-prevalence, kind="stable")
+        newModId = np.empty(len(moduleNames), dtype=np.int64)
+        newModId[modRank] = np.arange(len(moduleNames))
+        pairMod = newModId[pairMod]
+        offsets = np.searchsorted(pairSig, np.arange(numSigs + 1))
+
+        self.modules = [moduleNames[i] for i in modRank]
+        self.modulePrevalence = prevalence[modRank]
+        self.sigModules = [IdsToBits(pairMod[offsets[i]:offsets[i + 1]]) for i in range(numSigs)]
+        self.moduleCounts = np.diff(offsets)
+        self._BuildCoOccurrence(newModId[keptMods], lengths)
+
+        self.signatureHashes = np.array([Stacksig.SignatureHash(s) for s in self.signatures], dtype=np.uint64)
+        self._hashOrder = np.argsort(self.signatureHashes, kind="stable")
+        self._sortedHashes = self.signatureHashes[self._hashOrder]
+        # Plain lists rather than numpy string arrays, which are fixed width
+        # (one long signature would pad every row to its length) and drop
+        # trailing NULs.
+        self._sigLower = [s.lower() for s in self.signatures]
+        self._alphaRank = np.empty(numSigs, dtype=np.int64)
+        self._alphaRank[sorted(range(numSigs), key=self.signatures.__getitem__)] = np.arange(numSigs)
+        self._lengths = np.array([len(s) for s in self.signatures], dtype=np.int64)
+
+        # display order; initially by descending count, which is ID order
+        self.order = np.arange(numSigs)
+
+        stubs = [i for i, stack in enumerate(self.stacks) if "frames" not in stack]
+        if stubs:
+            keep = np.ones(len(self.stacks), dtype=bool)
+            keep[stubs] = False
+            self._KeepStacks(np.flatnonzero(keep))
+        if aSampleSize:
+            self.SampleStacks(aSampleSize, aMemoryBudget)
+
+    # Builds the per-signature views of self.stacks from self.stackSig.
+    def _BuildPostings(self):
+        numStacks = len(self.stacks)
+        perSig = np.bincount(self.stackSig, minlength=len(self.signatures))
+
+        # Posting lists: the stack indices of each signature, in corpus order,
+        # concatenated. Signature i's stacks are
+        # sigStacks[sigStackOffsets[i]:sigStackOffsets[i + 1]].
+        self.sigStacks = np.argsort(self.stackSig, kind="stable")
+        self.sigStackOffsets = np.concatenate(([0], np.cumsum(perSig)))
+
+        # 0-based position of each stack within its signature's posting list;
+        # this is the stack ID shown by the REPL.
+        self.stackOrdinal = np.empty(numStacks, dtype=np.int64)
+        self.stackOrdinal[self.sigStacks] = np.arange(numStacks) - np.repeat(self.sigStackOffsets[:-1], perSig)
+
+        # see BuildFrameText
+        self.frameText = None
+
+    # Builds the module co-occurrence matrix from the module IDs of every
+    # deduplicated stack, aStackMods, which are the concatenated lists of
+    # aLengths modules each. A module listed twice by one stack counts once.
+    def _BuildCoOccurrence(self, aStackMods, aLengths):
+        numMods = max(len(self.modules), 1)
+        stackMods = np.unique(np.repeat(np.arange(len(aLengths)), aLengths) * numMods + aStackMods)
+        mods = stackMods % numMods
+        lengths = np.bincount(stackMods // numMods, minlength=len(aLengths))
+        starts = np.cumsum(lengths) - lengths
+
+        # number of stacks that loaded each module; the matrix's diagonal
+        self.moduleStacks = np.bincount(mods, minlength=len(self.modules))
+
+        # Every ordered pair of modules in a stack, a stack at a time would
+        # be a nested loop; instead whole blocks of stacks are expanded with
+        # repeat: each module is repeated once per module of its stack (a),
+        # against each of those modules in turn (b).
+        cumPairs = np.cumsum(lengths * lengths)
+        keys = []
+        counts = []
+        first = 0
+        while first < len(lengths):
+            done = cumPairs[first - 1] if first else 0
+            last = max(int(np.searchsorted(cumPairs, done + CO_BLOCK_PAIRS, "right")), first + 1)
+            blockLengths = lengths[first:last]
+            blockStart = starts[first]
+            elemLengths = np.repeat(blockLengths, blockLengths)
+            a = np.repeat(mods[blockStart:blockStart + elemLengths.size], elemLengths)
+            pairStackStart = np.repeat(np.repeat(starts[first:last], blockLengths), elemLengths)
+            within = np.arange(a.size) - np.repeat(np.cumsum(elemLengths) - elemLengths, elemLengths)
+            b = mods[pairStackStart + within]
+            other = a != b
+            blockKeys, blockCounts = np.unique(a[other] * numMods + b[other], return_counts=True)
+            keys.append(blockKeys)
+            counts.append(blockCounts)
+            first = last
+        if keys:
+            pairs, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+            pairCounts = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+        else:
+            pairs = pairCounts = np.zeros(0, dtype=np.int64)
+
+        # rows by module, most often co-loaded first, ties by module ID
+        rows = pairs // numMods
+        cols = pairs % numMods
+        rowOrder = np.lexsort((cols, -pairCounts, rows))
+        self.coModules = cols[rowOrder]
+        self.coCounts = pairCounts[rowOrder]
+        self.coOffsets = np.searchsorted(rows[rowOrder], np.arange(len(self.modules) + 1))
+
+    # Drops all but a uniform random sample of at most aSize stacks per
+    # signature, and fewer if the kept stacks would take more than
+    # aMemoryBudget bytes (see Sigsample). Counts and modules are unchanged;
+    # stack IDs are renumbered over the stacks that are left, which stay in
+    # corpus order.
+    def SampleStacks(self, aSize, aMemoryBudget = None):
+        reservoir = Sigsample.Reservoir(aSize, aMemoryBudget)
+        for i, sigId in enumerate(self.stackSig.tolist()):
+            reservoir.Add(sigId, i, Sigsample.StackSize(self.stacks[i]))
+        self._KeepStacks(np.sort(np.array([i for sample in reservoir.samples.values() for i, _ in sample], dtype=np.int64)))
+
+    # Keeps only the stacks at the ascending indices aKeep. Counts, modules
+    # and co-occurrence aren't touched.
+    def _KeepStacks(self, aKeep):
+        self.numSampledOut += len(self.stacks) - len(aKeep)
+        self.stacks = [self.stacks[i] for i in aKeep]
+        self.stackSig = self.stackSig[aKeep]
+        self._BuildPostings()
+
+    # Reorders the display list. Sorts are stable with respect to the current
+    # display order, the same as sorting a Python list in place.
+    #
+    # aKey is one of:
+    #     "count"        descending occurrence count
+    #     "modules"      descending number of unique modules
+    #     "alpha"        alphabetical signature
+    #     "length"       ascending signature length
+    #     "length-desc"  descending signature length
+    def SortSignatures(self, aKey):
+        self.order = self.SortedOrder(aKey)
+
+    # Returns aOrder (by default the display order) sorted by aKey, as
+    # SortSignatures would, without changing the display order. Raises
+    # KeyError for an unknown aKey.
+    def SortedOrder(self, aKey, aOrder = None):
+        keys = {
+            "count": lambda: -self.counts,
+            "modules": lambda: -self.moduleCounts,
+            "alpha": lambda: self._alphaRank,
+            "length": lambda: self._lengths,
+            "length-desc": lambda: -self._lengths,
+        }
+        key = keys[aKey]()
+        order = self.order if aOrder is None else aOrder
+        return order[np.argsort(key[order], kind="stable")]
+
+    # Returns the ID of the signature whose Stacksig.SignatureHash is aHash, or
+    # None if there isn't one.
+    def SignatureForHash(self, aHash):
+        if not 0 <= aHash < 2 ** 64:
+            return None
+        i = int(np.searchsorted(self._sortedHashes, np.uint64(aHash)))
+        if i == len(self._sortedHashes) or int(self._sortedHashes[i]) != aHash:
+            return None
+        return int(self._hashOrder[i])
+
+    # Returns an array of signature IDs in display order (or aOrder) whose
+    # signature contains aQuery (case insensitive). No query returns
+    # everything.
+    def FilterSignatures(self, aQuery, aOrder = None):
+        order = self.order if aOrder is None else aOrder
+        if not aQuery:
+            return order
+        query = aQuery.lower()
+        hit = np.array([query in s for s in self._sigLower], dtype=bool)
+        return order[hit[order]]
+
+    # Returns a sorted list of the module names loaded by signature aSigId.
+    def SignatureModules(self, aSigId):
+        return sorted(self.modules[i] for i in BitsToIds(self.sigModules[aSigId]))
+
+    # Returns a bitset of every module whose name contains aQuery (case
+    # sensitive).
+    def ModuleBits(self, aQuery):
+        return IdsToBits(np.array([i for i, m in enumerate(self.modules) if aQuery in m], dtype=np.int64))
+
+    # Returns an array of signature IDs in display order (or aOrder) which
+    # loaded any module whose name contains aQuery (case sensitive).
+    def SignaturesWithModule(self, aQuery, aOrder = None):
+        order = self.order if aOrder is None else aOrder
+        mask = self.ModuleBits(aQuery)
+        hit = np.array([bool(bits & mask) for bits in self.sigModules], dtype=bool)
+        return order[hit[order]] if len(hit) else order
+
+    # Returns an array of signature IDs in display order (or aOrder) which,
+    # for every substring in aQueries, loaded a module containing it. For
+    # example ["foo", "bar"] finds signatures that loaded both foo.dll and
+    # bar.dll.
+    def SignaturesWithAllModules(self, aQueries, aOrder = None):
+        order = self.order if aOrder is None else aOrder
+        masks = [self.ModuleBits(q) for q in aQueries]
+        hit = np.array([all(bits & mask for mask in masks) for bits in self.sigModules], dtype=bool)
+        return order[hit[order]] if len(hit) else order
+
+    # Returns (moduleIds, counts): every module ID sorted by the number of
+    # unique signatures that loaded it, descending. Module IDs are already
+    # assigned in that order.
+    def ModulePrevalence(self):
+        return np.arange(len(self.modules)), self.modulePrevalence
+
+    # Returns (moduleIds, counts): the modules loaded by the same deduplicated
+    # stacks as module aModuleId, and how many stacks loaded both, most often
+    # first, ties by module ID. At most aTop of them if given. The arrays are
+    # views into the matrix; don't modify them.
+    def CoLoadedModules(self, aModuleId, aTop = None):
+        start = self.coOffsets[aModuleId]
+        end = self.coOffsets[aModuleId + 1]
+        if aTop is not None:
+            end = min(end, start + aTop)
+        return self.coModules[start:end], self.coCounts[start:end]
+
+    # Returns an array of indices into self.stacks for signature aSigId, in
+    # corpus order. This is a view into the posting lists; don't modify it.
+    def StacksForSignature(self, aSigId):
+        return self.sigStacks[self.sigStackOffsets[aSigId]:self.sigStackOffsets[aSigId + 1]]
+
+    # Builds self.frameText: for each stack, all of its frames pretty-printed
+    # and lowercased, one per line. Searching frames then needs no formatting
+    # at all. Does nothing if it's already built.
+    def BuildFrameText(self):
+        if self.frameText is not None:
+            return
+        utils = Stacksig.Stacksig()
+        self.frameText = [
+            "\n".join(utils.FrameDictToString(frame, False, False)[0].lower() for frame in stack["frames"])
+            for stack in self.stacks]
+
+    # Yields the index of every stack with a pretty-printed frame containing
+    # aQuery (case insensitive, not containing a newline), in corpus order.
+    # With aFirstPerSignature, only the first such stack of each signature is
+    # yielded.
+    def StacksMatchingFrames(self, aQuery, aFirstPerSignature = False):
+        self.BuildFrameText()
+        query = aQuery.lower()
+        found = set()
+        for i, sigId in enumerate(self.stackSig.tolist()):
+            if aFirstPerSignature and sigId in found:
+                continue
+            if query in self.frameText[i]:
+                found.add(sigId)
+                yield i
+
+    # Returns a list of (name, objects) grouping everything the index holds,
+    # in the form Sigmem.ComponentSizes takes. The frames and any debug
+    # output come before the stacks that hold them, so they're broken out.
+    def Components(self):
+        return [
+            ("frames", [stack["frames"] for stack in self.stacks]),
+            ("debug", [stack["signatureDebug"] for stack in self.stacks if "signatureDebug" in stack]),
+            ("stacks", [self.stacks]),
+            ("aggregates", [self.signatures, self.signatureHashes, self.counts, self.modules, self.modulePrevalence,
+                            self.sigModules, self.moduleCounts, self.moduleStacks,
+                            self.coOffsets, self.coModules, self.coCounts]),
+            ("indexes", [self.stackSig, self.sigStacks, self.sigStackOffsets, self.stackOrdinal, self.order,
+                         self._hashOrder, self._sortedHashes, self._sigLower, self._alphaRank,
+                         self._lengths]),
+            ("caches", [self.frameText]),
+        ]
+
+    # Returns the number of deduplicated stacks kept for signature aSigId.
+    # Without sampling this is also its count.
+    def NumStacks(self, aSigId):
+        return int(self.sigStackOffsets[aSigId + 1] - self.sigStackOffsets[aSigId])
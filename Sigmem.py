@@ -0,0 +1,84 @@
+import sys
+import tracemalloc
+
+# Functions defined here:
+#     DeepSize        bytes taken by an object and everything it refers to
+#     ComponentSizes  DeepSize of each named component, without double counting
+#     TopSites        the source lines that allocated the most live memory
+#     Report          yields the lines of a memory report
+#
+# Structural sizes walk the objects themselves, so they work at any time, but
+# they only see what they're pointed at. tracemalloc sees every allocation,
+# including temporaries and interpreter overhead, but only while it's tracing
+# and only for memory allocated since it started. The mem command in main.py
+# shows both.
+
+# Returns the number of bytes taken by aObj and everything reachable from it
+# through containers and instance dicts. Objects whose id is in aSeen are
+# skipped, and everything counted is added to aSeen, so an object shared by
+# several components is only counted for the first. numpy arrays count their
+# data buffer (sys.getsizeof includes it for arrays that own their data).
+def DeepSize(aObj, aSeen):
+    ret = 0
+    todo = [aObj]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in aSeen:
+            continue
+        aSeen.add(id(obj))
+        ret += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+            todo.append(obj.__dict__)
+    return ret
+
+# aComponents is a list of (name, objects). Returns a list of (name, bytes) in
+# the same order. Objects reachable from more than one component are counted
+# for the first one only, so list the parts you want broken out (eg frames)
+# before the things that contain them (eg stacks).
+def ComponentSizes(aComponents):
+    seen = set()
+    return [(name, sum(DeepSize(obj, seen) for obj in objects)) for name, objects in aComponents]
+
+# Returns a list of (bytes, count, "file:line") for the aTop source lines
+# holding the most memory allocated since tracemalloc started, or None if it
+# isn't tracing.
+def TopSites(aTop):
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    ret = []
+    for stat in snapshot.statistics("lineno")[:aTop]:
+        frame = stat.traceback[0]
+        ret.append((stat.size, stat.count, "{}:{}".format(frame.filename, frame.lineno)))
+    return ret
+
+def _Mb(aBytes):
+    return "{:10.1f} MB".format(aBytes / (1024 * 1024))
+
+# Yields the lines of a report of the structural size of each of aComponents
+# (see ComponentSizes), and, if tracemalloc is tracing, the traced totals and
+# the aTop allocation sites.
+def Report(aComponents, aTop = 10):
+    sizes = ComponentSizes(aComponents)
+    yield "Structural sizes:"
+    for name, size in sizes:
+        yield "  {} {}".format(_Mb(size), name)
+    yield "  {} total".format(_Mb(sum(size for _, size in sizes)))
+
+    sites = TopSites(aTop)
+    if sites is None:
+        yield "\ntracemalloc is off; \"mem on\" then \"r\" to trace a reload"
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    yield "\nTraced: {} now, {} peak".format(_Mb(current).strip(), _Mb(peak).strip())
+    yield "Top allocation sites:"
+    for size, count, where in sites:
+        yield "  {} {:9d} blocks  {}".format(_Mb(size), count, where)
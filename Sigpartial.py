@@ -0,0 +1,356 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import Pingdata
+import Sigindex
+import Sigsample
+import Stacksig
+
+# Functions defined in class PartialAggregate:
+#     AddStack       adds one signaturized stack record
+#     Merge          folds a later partial aggregate into this one
+#     Counts         number of unique clients per signature
+#     Modules        set of modules per signature
+#     ToIndex        builds a Sigindex.SigIndex over the aggregate
+#     ToJson         plain data form, for pickling or writing to disk
+#     FromJson       the reverse of ToJson
+#     Save / Load    ToJson / FromJson to and from a file
+#
+# Module functions:
+#     AggregateRange   signaturizes one byte range of a ping dump
+#     AggregateShards  runs AggregateRange over many ranges in a process pool
+#                      and merges the results
+#     AggregateShardsThreaded
+#                      the same on a thread pool sharing one Stacksig, for
+#                      free-threaded Python builds
+#     AggregateCheckpointed
+#                      aggregates a whole dump in one process, checkpointing
+#                      as it goes so an interrupted run can be resumed
+#
+# A partial aggregate is the result of processing some contiguous piece of the
+# corpus: the client dedup state (one entry per (clientID, signature)), and for
+# each entry the exemplar stack that was kept for it, including its modules.
+# Signature counts and module sets are derived from the entries, so they come
+# out exactly as if the whole corpus had been processed in one pass.
+#
+# A partial aggregate made with a sample size keeps the full stack of only a
+# bounded random sample of entries per signature, chosen as the stacks are
+# added with a Sigsample.Reservoir; every other entry is kept as a
+# Sigsample.StackStub, which is all the counts and module sets need. So a
+# corpus can be counted exactly without ever holding all of its stacks.
+# Merging such aggregates pools their samples; ToIndex can cut them down.
+#
+# Merge is associative, so shards can be reduced in any grouping, but it is
+# not commutative: like the dedup in main.py, the exemplar from the later
+# shard wins. Merge shards in corpus order to reproduce a single-pass run.
+#
+# A checkpointed run reads the dump in pieces and, after each, saves that
+# piece's partial aggregate as a segment file and then rewrites a small
+# manifest with the position reached and the list of segments. Both are
+# written to a temporary file first and renamed into place, so a crash at any
+# point leaves the last complete checkpoint. Resuming merges the segments in
+# order and carries on from the position, which, since Merge reproduces a
+# single pass, gives exactly the result of an uninterrupted run. Only the
+# new piece is written at each checkpoint, not everything so far.
+#
+# Command line usage:
+#     Sigpartial.py big.json -o partial.json --processes 8
+#     Sigpartial.py big.json -o partial.json --checkpoint run.ckpt [--resume]
+#     Sigpartial.py big.json -o partial.json --threads 8
+#     Sigpartial.py big.json -o part1.json --part 1/4        (on host 1 of 4)
+#     Sigpartial.py --merge part0.json part1.json ... -o merged.json
+
+FORMAT_VERSION = 1
+CHECKPOINT_VERSION = 1
+
+# How much of a dump is read between checkpoints: bytes of a plain dump, or
+# lines of a compressed one, which can't be seeked into and is counted in
+# lines instead.
+CHECKPOINT_BYTES = 64 << 20
+CHECKPOINT_LINES = 100000
+
+class PartialAggregate(object):
+    # aSampleSize, aMemoryBudget
+    #           Optional; keep the full stacks of at most aSampleSize entries
+    #           per signature, within aMemoryBudget bytes, as a
+    #           Sigsample.Reservoir would.
+    def __init__(self, aSampleSize = None, aMemoryBudget = None):
+        self.entries = {} # (clientID, signature) -> stack record or stub
+        self.stats = {"pings": 0, "results": 0, "stacks": 0}
+        self.reservoir = Sigsample.Reservoir(aSampleSize, aMemoryBudget) if aSampleSize else None
+
+    # aStack is a stack record from Pingdata.ReadResults which also carries
+    # its "signature".
+    def AddStack(self, aStack):
+        key = (aStack["clientID"], aStack["signature"])
+        self.stats["stacks"] += 1
+        if self.reservoir is None:
+            self.entries[key] = aStack
+            return
+        # Each entry is offered to the sample once, when it's first seen.
+        # Later stacks for it replace its stack if it was sampled, and its
+        # stub if not; the first stack's size stands in for them in the
+        # budget.
+        previous = self.entries.get(key)
+        if previous is not None:
+            self.entries[key] = aStack if "frames" in previous else Sigsample.StackStub(aStack)
+            return
+        self.entries[key] = aStack
+        for dropped in self.reservoir.Add(aStack["signature"], key, Sigsample.StackSize(aStack)):
+            self.entries[dropped] = Sigsample.StackStub(self.entries[dropped])
+
+    # Folds aOther, which covers the part of the corpus after this one, into
+    # this aggregate. Returns self.
+    def Merge(self, aOther):
+        self.entries.update(aOther.entries)
+        for key, value in aOther.stats.items():
+            self.stats[key] = self.stats.get(key, 0) + value
+        return self
+
+    # Returns a dict signature -> number of unique clients.
+    def Counts(self):
+        ret = {}
+        for _, signature in self.entries:
+            ret[signature] = ret.get(signature, 0) + 1
+        return ret
+
+    # Returns a dict signature -> set of module names.
+    def Modules(self):
+        ret = {}
+        for (_, signature), stack in self.entries.items():
+            ret.setdefault(signature, set()).update(stack["modules"])
+        return ret
+
+    # aSampleSize and aMemoryBudget are passed to Sigindex.SigIndex.
+    def ToIndex(self, aSampleSize = None, aMemoryBudget = None):
+        return Sigindex.SigIndex(list(self.entries.values()), aSampleSize, aMemoryBudget)
+
+    def ToJson(self):
+        return {
+            "version": FORMAT_VERSION,
+            "stats": self.stats,
+            "stacks": list(self.entries.values()),
+        }
+
+    @staticmethod
+    def FromJson(aJson):
+        if aJson["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported partial aggregate version {}".format(aJson["version"]))
+        ret = PartialAggregate()
+        ret.stats = dict(aJson["stats"])
+        for stack in aJson["stacks"]:
+            ret.entries[(stack["clientID"], stack["signature"])] = stack
+        return ret
+
+    def Save(self, aPath):
+        with open(aPath, "w") as f:
+            json.dump(self.ToJson(), f)
+
+    # Save, but written to a temporary file which replaces aPath only once
+    # it's complete and on disk.
+    def SaveAtomic(self, aPath):
+        _WriteAtomic(aPath, self.ToJson())
+
+    @staticmethod
+    def Load(aPath):
+        with open(aPath, "r") as f:
+            return PartialAggregate.FromJson(json.load(f))
+
+# Signaturizes the stacks in the byte range [aStart, aEnd) of the ping dump at
+# aPath.
+#
+# Takes a single (aPath, aStart, aEnd) tuple so it can be handed straight to
+# Pool.map, and returns the ToJson() form, which is what would travel between
+# hosts.
+def AggregateRange(aRange):
+    return _AggregateRange(aRange, Stacksig.Stacksig()).ToJson()
+
+# AggregateRange with a given Stacksig, returning the PartialAggregate itself.
+def _AggregateRange(aRange, aUtils):
+    path, start, end = aRange
+    partial = PartialAggregate()
+    for filtered in Pingdata.ReadResults(path, partial.stats, start, end):
+        for stack in filtered:
+            stack["signature"], _ = aUtils.StackToSignature(stack["frames"], stack["threadName"], False)
+            partial.AddStack(stack)
+    return partial
+
+# Returns the (path, start, end) ranges for splitting each of aPaths into
+# aShardsPerFile pieces.
+def _Ranges(aPaths, aShardsPerFile):
+    ranges = []
+    for path in aPaths:
+        ranges.extend((path, start, end) for start, end in Pingdata.ShardRanges(path, aShardsPerFile))
+    return ranges
+
+# Splits each ping dump in aPaths into aShardsPerFile ranges, aggregates them
+# on aProcesses worker processes and merges the results in corpus order.
+#
+# Returns the merged PartialAggregate.
+def AggregateShards(aPaths, aProcesses, aShardsPerFile = None):
+    ranges = _Ranges(aPaths, aShardsPerFile or aProcesses)
+
+    ret = PartialAggregate()
+    if aProcesses > 1:
+        with multiprocessing.Pool(aProcesses) as pool:
+            partials = pool.imap(AggregateRange, ranges)
+            for partial in partials:
+                ret.Merge(PartialAggregate.FromJson(partial))
+    else:
+        for r in ranges:
+            ret.Merge(PartialAggregate.FromJson(AggregateRange(r)))
+    return ret
+
+# AggregateShards on aThreads threads of this process. The threads share one
+# Stacksig and nothing is pickled; partial aggregates are merged in corpus
+# order as they come back.
+#
+# On a regular (GIL) build this is no faster than one thread, since
+# signaturizing is pure Python. It pays off on free-threaded builds.
+def AggregateShardsThreaded(aPaths, aThreads, aShardsPerFile = None):
+    ranges = _Ranges(aPaths, aShardsPerFile or aThreads)
+    utils = Stacksig.Stacksig()
+    ret = PartialAggregate()
+    with concurrent.futures.ThreadPoolExecutor(aThreads) as pool:
+        for partial in pool.map(lambda r: _AggregateRange(r, utils), ranges):
+            ret.Merge(partial)
+    return ret
+
+# Writes aJson to aPath by way of a temporary file, so aPath is always either
+# the old or the new contents.
+def _WriteAtomic(aPath, aJson):
+    tmpPath = aPath + ".tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(aJson, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, aPath)
+
+# What a checkpoint must match to be resumed: the same dump, unchanged.
+def _InputIdentity(aPath):
+    st = os.stat(aPath)
+    return {"input": os.path.abspath(aPath), "size": st.st_size, "mtime": st.st_mtime}
+
+# Yields (position after the piece, read) for each piece of the dump at aPath
+# from aPosition on, where read(aStats) yields the piece's stack record lists
+# as ReadResults does. Positions are byte offsets, or line numbers for a
+# compressed dump. Each piece must be read before asking for the next.
+def _Pieces(aPath, aPosition, aPieceBytes, aPieceLines):
+    if not Pingdata.IsCompressed(aPath):
+        size = os.path.getsize(aPath)
+        for start in range(aPosition, size, aPieceBytes):
+            end = min(start + aPieceBytes, size)
+            yield end, lambda aStats: Pingdata.ReadResults(aPath, aStats, start, end)
+        return
+
+    lines = Pingdata.StreamLines(aPath)
+    try:
+        for _ in zip(range(aPosition), lines):
+            pass # already done
+        position = aPosition
+        while True:
+            piece = [line for _, line in zip(range(aPieceLines), lines)]
+            if not piece:
+                return
+            position += len(piece)
+            yield position, lambda aStats: (filtered for line in piece for filtered in Pingdata.LineResults(line, aStats))
+    finally:
+        lines.close()
+
+# Aggregates the whole ping dump at aPath, the same as AggregateShards with one
+# shard, saving a checkpoint at aCheckpointPath after every piece of
+# aPieceBytes bytes (aPieceLines lines if the dump is compressed). Segments go
+# next to it, as aCheckpointPath.0, .1 and so on.
+#
+# aResume   carries on from the checkpoint at aCheckpointPath if there is one.
+#           ValueError is raised if it was made from a different or changed
+#           dump.
+# aOnCheckpoint  called with the manifest after each checkpoint is written.
+#
+# Returns the merged PartialAggregate. The checkpoint files are left in place.
+def AggregateCheckpointed(aPath, aCheckpointPath, aResume = False, aPieceBytes = CHECKPOINT_BYTES,
+                          aPieceLines = CHECKPOINT_LINES, aOnCheckpoint = None):
+    manifest = dict(_InputIdentity(aPath), version = CHECKPOINT_VERSION, position = 0, segments = [])
+    ret = PartialAggregate()
+    if aResume and os.path.isfile(aCheckpointPath):
+        with open(aCheckpointPath, "r") as f:
+            saved = json.load(f)
+        if saved["version"] != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version {}".format(saved["version"]))
+        for key, value in _InputIdentity(aPath).items():
+            if saved[key] != value:
+                raise ValueError("Checkpoint {} was made from a different or changed dump ({})".format(aCheckpointPath, key))
+        manifest = saved
+        for segment in manifest["segments"]:
+            ret.Merge(PartialAggregate.Load(os.path.join(os.path.dirname(aCheckpointPath), segment)))
+
+    utils = Stacksig.Stacksig()
+    for position, read in _Pieces(aPath, manifest["position"], aPieceBytes, aPieceLines):
+        partial = PartialAggregate()
+        for filtered in read(partial.stats):
+            for stack in filtered:
+                stack["signature"], _ = utils.StackToSignature(stack["frames"], stack["threadName"], False)
+                partial.AddStack(stack)
+        segment = "{}.{}".format(os.path.basename(aCheckpointPath), len(manifest["segments"]))
+        partial.SaveAtomic(os.path.join(os.path.dirname(aCheckpointPath), segment))
+        manifest["segments"].append(segment)
+        manifest["position"] = position
+        _WriteAtomic(aCheckpointPath, manifest)
+        ret.Merge(partial)
+        if aOnCheckpoint:
+            aOnCheckpoint(manifest)
+    return ret
+
+def main(aArgs):
+    parser = argparse.ArgumentParser(description = "Build or merge partial signature aggregates.")
+    parser.add_argument("inputs", nargs = "+", help = "ping dumps, or partial aggregates with --merge")
+    parser.add_argument("-o", "--output", required = True, help = "partial aggregate to write")
+    parser.add_argument("--merge", action = "store_true", help = "merge partial aggregates, in the order given")
+    parser.add_argument("--processes", type = int, default = 1, help = "worker processes")
+    parser.add_argument("--threads", type = int, help = "use this many worker threads instead of processes")
+    parser.add_argument("--part", help = "I/N: only process the I-th (0-based) of N parts of each dump")
+    parser.add_argument("--checkpoint", help = "checkpoint to this file as the dump is read, in one process")
+    parser.add_argument("--resume", action = "store_true", help = "carry on from the --checkpoint file")
+    args = parser.parse_args(aArgs)
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if args.checkpoint and len(args.inputs) != 1:
+        parser.error("--checkpoint takes one dump")
+
+    start = time.time()
+    if args.checkpoint:
+        def progress(aManifest):
+            sys.stderr.write("checkpoint {}: position {}\n".format(len(aManifest["segments"]), aManifest["position"]))
+        partial = AggregateCheckpointed(args.inputs[0], args.checkpoint, args.resume, aOnCheckpoint = progress)
+    elif args.merge:
+        partial = PartialAggregate()
+        for path in args.inputs:
+            partial.Merge(PartialAggregate.Load(path))
+    elif args.part:
+        part, numParts = map(int, args.part.split("/"))
+        partial = PartialAggregate()
+        for path in args.inputs:
+            partStart, partEnd = Pingdata.ShardRanges(path, numParts)[part]
+            # split this host's part further between the local processes
+            subRanges = [(path, partStart + (partEnd - partStart) * i // args.processes,
+                          partStart + (partEnd - partStart) * (i + 1) // args.processes)
+                         for i in range(args.processes)]
+            with multiprocessing.Pool(args.processes) as pool:
+                for p in pool.imap(AggregateRange, subRanges):
+                    partial.Merge(PartialAggregate.FromJson(p))
+    elif args.threads:
+        partial = AggregateShardsThreaded(args.inputs, args.threads)
+    else:
+        partial = AggregateShards(args.inputs, args.processes)
+    partial.Save(args.output)
+
+    sys.stderr.write("{} stacks, {} unique (client, signature), {} signatures in {:.1f}s\n".format(
+        partial.stats["stacks"], len(partial.entries), len(partial.Counts()), time.time() - start))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
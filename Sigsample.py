@@ -0,0 +1,93 @@
+import random
+
+# Functions defined in class Reservoir:
+#     Add           offers one item for a key
+#     Sample        the items kept for a key
+#
+# Module functions:
+#     StackSize     rough number of bytes a stack record takes up
+#     StackStub     a stack record without its frames
+#
+# A Reservoir keeps a uniform random sample of at most aSize items per key
+# (reservoir sampling, "algorithm R"), however many items are offered, and
+# counts every item offered in "seen".
+#
+# With a memory budget, the per-key size is lowered whenever the kept items
+# add up to more than the budget: the biggest samples are cut down to the new
+# size by evicting random items, so every sample stays uniform. At least one
+# item per key is always kept, so a budget smaller than that is exceeded.
+#
+# The random generator is seeded, so the same input gives the same sample.
+
+class Reservoir(object):
+    def __init__(self, aSize, aBudget = None, aSeed = 0):
+        self.size = max(aSize, 1)
+        self.budget = aBudget
+        self.rng = random.Random(aSeed)
+        self.samples = {} # key -> list of (item, bytes)
+        self.seen = {} # key -> number of items offered
+        self.bytes = 0
+
+    # Offers aItem, which takes up aBytes, for aKey. Returns a list of the
+    # items that aren't kept any more: aItem if it wasn't taken, and any it
+    # replaced or the budget pushed out.
+    def Add(self, aKey, aItem, aBytes):
+        n = self.seen.get(aKey, 0) + 1
+        self.seen[aKey] = n
+        sample = self.samples.setdefault(aKey, [])
+        dropped = []
+        if len(sample) < self.size:
+            sample.append((aItem, aBytes))
+            self.bytes += aBytes
+        else:
+            # keep the n-th item with probability size / n
+            j = self.rng.randrange(n)
+            if j >= len(sample):
+                return [aItem]
+            dropped.append(sample[j][0])
+            self.bytes += aBytes - sample[j][1]
+            sample[j] = (aItem, aBytes)
+        if self.budget is not None and self.bytes > self.budget:
+            dropped.extend(self._Shrink())
+        return dropped
+
+    # Lowers the per-key size until the kept items fit in the budget. Returns
+    # the items evicted.
+    def _Shrink(self):
+        ret = []
+        while self.bytes > self.budget and self.size > 1:
+            self.size = max(self.size - 1, 1)
+            for sample in self.samples.values():
+                while len(sample) > self.size:
+                    item, dropped = sample.pop(self.rng.randrange(len(sample)))
+                    self.bytes -= dropped
+                    ret.append(item)
+        return ret
+
+    # Returns the items kept for aKey, in no particular order.
+    def Sample(self, aKey):
+        return [item for item, _ in self.samples[aKey]] if aKey in self.samples else []
+
+# Returns a rough size in bytes of the stack record aStack: the text of its
+# frames and modules plus a fixed overhead per object. It's only used to
+# compare against a budget, so it's meant to be cheap, not exact.
+def StackSize(aStack):
+    ret = 200
+    for frame in aStack["frames"]:
+        ret += 250
+        for value in frame.values():
+            if isinstance(value, str):
+                ret += len(value)
+    for module in aStack["modules"] if "modules" in aStack else []:
+        ret += 60 + len(module)
+    return ret
+
+# Returns what of the stack record aStack is needed to count it, its
+# signature, client and modules, without the frames. Stacks that weren't
+# sampled are kept in this form; see Sigpartial.PartialAggregate.
+def StackStub(aStack):
+    return {
+        "signature": aStack["signature"],
+        "clientID": aStack["clientID"],
+        "modules": aStack["modules"],
+    }
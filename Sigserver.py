@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import collections
+import json
+import numpy as np
+import sys
+import time
+import urllib.parse
+
+import main as repl
+import Sigindex
+import Sigpartial
+import Stacksig
+
+# Functions defined in class QueryApi:
+#     Handle            answers one request path, with caching
+#     Signatures        the signature list, filtered and sorted ("\" in main.py)
+#     Signature         one signature and its modules ("sig")
+#     ModuleSignatures  signatures that loaded modules ("ms" / "mb")
+#     Modules           modules by prevalence ("lm")
+#     CoLoaded          modules loaded by the same stacks as a module ("co")
+#     Frames            first stack of each signature matching a frame ("sf")
+#     Stack             one stack in detail ("s")
+#
+# Module functions:
+#     Serve             runs the HTTP server until cancelled
+#     Get               a minimal client, for tests and scripts
+#
+# A small HTTP server answering the REPL's queries as JSON, over one resident
+# Sigindex.SigIndex, so many people can query one loaded corpus. Only GET is
+# supported:
+#     /signatures?q=&sort=count|modules|alpha|length|length-desc
+#     /signature/<ID>
+#     /signature-hash/<HASH>                 the same, by Stacksig.SignatureHash
+#     /module-signatures?q=<Q>[&q=<Q2>...]   signatures that loaded all of them
+#     /modules
+#     /co-modules?q=<Q>&top=<N>   for each module matching Q, the N modules
+#                                 most often loaded by the same stacks
+#     /frames?q=<Q>
+#     /stack/<ID>/<SID>
+# Lists take offset= and limit= (at most MAX_LIMIT) and return
+#     {"total": N, "offset": O, "items": [...]}
+# Signatures are listed with their module count as "numModules"; a single
+# signature also has the module names in "modules", and "numStacks".
+#
+# The index is never changed while serving, so requests only read it. Queries
+# run on the default thread pool to keep the event loop responsive, and
+# response bodies are kept in an LRU cache keyed on the request.
+#
+# Command line usage:
+#     Sigserver.py                      the state main.py would load, from
+#                                       the current directory
+#     Sigserver.py --partial merged.json --port 8080
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+CACHE_SIZE = 256
+
+# Raised for a request that can't be answered, with the HTTP status to send.
+class RequestError(Exception):
+    def __init__(self, aStatus, aMessage):
+        Exception.__init__(self, aMessage)
+        self.status = aStatus
+
+class QueryApi(object):
+    def __init__(self, aIndex, aCacheSize = CACHE_SIZE):
+        self.index = aIndex
+        self.index.BuildFrameText() # up front, so requests never write
+        self.cache = collections.OrderedDict()
+        self.cacheSize = aCacheSize
+        self.utils = Stacksig.Stacksig()
+
+    # Returns (status, body bytes) for the request target aTarget, eg
+    # "/signatures?q=xul&limit=10". Answers from the cache if it can;
+    # otherwise aRun(function) is awaited to run the query, so the caller
+    # decides where it runs.
+    async def Handle(self, aTarget, aRun):
+        url = urllib.parse.urlsplit(aTarget)
+        params = urllib.parse.parse_qs(url.query)
+        key = (url.path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        try:
+            result = await aRun(lambda: self._Route(url.path, params))
+            ret = (200, json.dumps(result).encode())
+        except RequestError as e:
+            ret = (e.status, json.dumps({"error": str(e)}).encode())
+        except (ValueError, KeyError, IndexError) as e:
+            ret = (400, json.dumps({"error": "bad request: {}".format(e)}).encode())
+        except Exception as e:
+            # a bug, not the request's fault; not cached, so a fix or a retry
+            # isn't stuck with it
+            ret = (500, json.dumps({"error": "internal error: {}".format(repr(e))}).encode())
+        if ret[0] in (200, 404):
+            self.cache[key] = ret
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last = False)
+        return ret
+
+    def _Route(self, aPath, aParams):
+        parts = [p for p in aPath.split("/") if p]
+        def one(aName, aDefault = None):
+            return aParams[aName][-1] if aName in aParams else aDefault
+        offset = int(one("offset", 0))
+        limit = min(int(one("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        if offset < 0 or limit < 0:
+            raise ValueError("offset and limit must not be negative")
+
+        if parts == ["signatures"]:
+            return self.Signatures(one("q"), one("sort", "count"), offset, limit)
+        if len(parts) == 2 and parts[0] == "signature":
+            return self.Signature(int(parts[1]))
+        if len(parts) == 2 and parts[0] == "signature-hash":
+            sigId = self.index.SignatureForHash(int(parts[1], 16))
+            if sigId is None:
+                raise RequestError(404, "No signature with hash {}".format(parts[1]))
+            return self.Signature(sigId)
+        if parts == ["module-signatures"]:
+            return self.ModuleSignatures(aParams["q"] if "q" in aParams else [], offset, limit)
+        if parts == ["modules"]:
+            return self.Modules(offset, limit)
+        if parts == ["co-modules"]:
+            return self.CoLoaded(one("q", ""), int(one("top", DEFAULT_LIMIT)), offset, limit)
+        if parts == ["frames"]:
+            return self.Frames(one("q", ""), offset, limit)
+        if len(parts) == 3 and parts[0] == "stack":
+            return self.Stack(int(parts[1]), int(parts[2]))
+        raise RequestError(404, "no such query {}".format(aPath))
+
+    def _CheckSignature(self, aSigId):
+        if aSigId < 0 or aSigId >= len(self.index.signatures):
+            raise RequestError(404, "No matching signature for ID {}".format(aSigId))
+
+    def _Page(self, aItems, aOffset, aLimit, aFormat):
+        return {
+            "total": len(aItems),
+            "offset": aOffset,
+            "items": [aFormat(item) for item in aItems[aOffset:aOffset + aLimit]],
+        }
+
+    def _SignatureItem(self, aSigId):
+        index = self.index
+        return {
+            "id": int(aSigId),
+            "signature": index.signatures[aSigId],
+            "hash": Stacksig.FormatSignatureHash(int(index.signatureHashes[aSigId])),
+            "count": int(index.counts[aSigId]),
+            "numModules": int(index.moduleCounts[aSigId]),
+        }
+
+    def Signatures(self, aQuery, aSort, aOffset, aLimit):
+        order = self.index.SortedOrder(aSort, self.index.FilterSignatures(aQuery, self._IdOrder()))
+        return self._Page(order, aOffset, aLimit, self._SignatureItem)
+
+    def Signature(self, aSigId):
+        self._CheckSignature(aSigId)
+        ret = self._SignatureItem(aSigId)
+        ret["numStacks"] = self.index.NumStacks(aSigId)
+        ret["modules"] = self.index.SignatureModules(aSigId)
+        return ret
+
+    def ModuleSignatures(self, aQueries, aOffset, aLimit):
+        if not aQueries:
+            raise ValueError("q is required")
+        sigIds = self.index.SignaturesWithAllModules(aQueries, self._IdOrder())
+        return self._Page(sigIds, aOffset, aLimit, self._SignatureItem)
+
+    def Modules(self, aOffset, aLimit):
+        moduleIds, counts = self.index.ModulePrevalence()
+        return self._Page(moduleIds, aOffset, aLimit, lambda modId: {
+            "module": self.index.modules[modId],
+            "signatures": int(counts[modId]),
+        })
+
+    def CoLoaded(self, aQuery, aTop, aOffset, aLimit):
+        if not aQuery:
+            raise ValueError("q is required")
+        index = self.index
+        def item(aModuleId):
+            moduleIds, counts = index.CoLoadedModules(aModuleId, min(aTop, MAX_LIMIT))
+            return {
+                "module": index.modules[aModuleId],
+                "stacks": int(index.moduleStacks[aModuleId]),
+                "coLoaded": [{"module": index.modules[m], "stacks": int(c)} for m, c in zip(moduleIds, counts)],
+            }
+        return self._Page(Sigindex.BitsToIds(index.ModuleBits(aQuery)), aOffset, aLimit, item)
+
+    def Frames(self, aQuery, aOffset, aLimit):
+        if not aQuery:
+            raise ValueError("q is required")
+        stacks = list(self.index.StacksMatchingFrames(aQuery, True))
+        def item(aStack):
+            ret = self._SignatureItem(self.index.stackSig[aStack])
+            ret["stackId"] = int(self.index.stackOrdinal[aStack])
+            return ret
+        return self._Page(stacks, aOffset, aLimit, item)
+
+    def Stack(self, aSigId, aStackId):
+        self._CheckSignature(aSigId)
+        stackIds = self.index.StacksForSignature(aSigId)
+        if aStackId < 0 or aStackId >= len(stackIds):
+            raise RequestError(404, "No stack {} for signature {}".format(aStackId, aSigId))
+        stack = self.index.stacks[stackIds[aStackId]]
+        threadName = stack["threadName"] if "threadName" in stack else None
+        _, debug = self.utils.StackToSignature(stack["frames"], threadName)
+        return {
+            "id": aSigId,
+            "stackId": aStackId,
+            "signature": self.index.signatures[aSigId],
+            "clientID": stack["clientID"] if "clientID" in stack else None,
+            "threadName": threadName,
+            "modules": stack["modules"],
+            "frames": [self.utils.FrameDictToString(f, False, False)[0] for f in stack["frames"]],
+            "debug": debug,
+        }
+
+    # Signature IDs in ID order, which is descending count. The REPL's
+    # display order belongs to the REPL.
+    def _IdOrder(self):
+        return np.arange(len(self.index.signatures))
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error"}
+
+async def _HandleConnection(aApi, aReader, aWriter):
+    loop = asyncio.get_running_loop()
+    try:
+        requestLine = await aReader.readline()
+        while (await aReader.readline()) not in (b"\r\n", b"\n", b""):
+            pass # headers; nothing we need
+        parts = requestLine.decode("latin-1").split()
+        if len(parts) < 2:
+            return
+        if parts[0] != "GET":
+            status, body = 405, json.dumps({"error": "only GET is supported"}).encode()
+        else:
+            status, body = await aApi.Handle(parts[1], lambda f: loop.run_in_executor(None, f))
+        aWriter.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, HTTP_REASONS[status], len(body)).encode() + body)
+        await aWriter.drain()
+    finally:
+        aWriter.close()
+
+# Serves aApi on aHost:aPort. aOnReady, if given, is called with the bound
+# port once the server is listening (useful with port 0). Runs until
+# cancelled.
+async def Serve(aApi, aHost, aPort, aOnReady = None):
+    server = await asyncio.start_server(lambda r, w: _HandleConnection(aApi, r, w), aHost, aPort)
+    if aOnReady:
+        aOnReady(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+# Requests aPath from the server at aHost:aPort. Returns (status, decoded
+# JSON body).
+async def Get(aHost, aPort, aPath):
+    reader, writer = await asyncio.open_connection(aHost, aPort)
+    writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n".format(aPath, aHost).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+def main(aArgs):
+    parser = argparse.ArgumentParser(description = "Serve signature queries as JSON over HTTP.")
+    parser.add_argument("--partial", help = "serve this partial aggregate instead of main.py's data")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    args = parser.parse_args(aArgs)
+
+    start = time.time()
+    if args.partial:
+        index = Sigpartial.PartialAggregate.Load(args.partial).ToIndex()
+    else:
+        repl.InitData()
+        index = repl.sigIndex
+    api = QueryApi(index)
+    sys.stderr.write("{} signatures loaded in {:.1f}s\n".format(len(index.signatures), time.time() - start))
+
+    def ready(aPort):
+        sys.stderr.write("Serving on http://{}:{}/\n".format(args.host, aPort))
+    try:
+        asyncio.run(Serve(api, args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import pickle
+
+import Sigindex
+import Sigpartial
+import Sigsample
+import Sigtime
+import Stacksig
+
+# Functions defined here:
+#     SnapshotKey   identifies the input file and the code and rules that
+#                   processed it
+#     Load          returns the saved state if its key matches
+#     Save          writes the state and its key atomically
+#
+# A snapshot is the fully processed analysis state (the Sigindex.SigIndex,
+# which holds the signaturized stacks, aggregates and indexes, and the
+# Sigtime.Timeline), pickled next to the input it came from. It is only reused
+# when the key matches exactly, so changing the input, Stacksig, Sigindex,
+# Sigpartial, Sigsample, Sigtime or the rule lists rebuilds it.
+#
+# The file holds two pickles: the header, then the state. The header is read
+# first so a stale snapshot costs almost nothing to reject.
+
+# Bump when the layout of the pickled state changes in a way the source hashes
+# wouldn't catch.
+SNAPSHOT_VERSION = 3
+
+def _HashFile(aPath, aHash):
+    with open(aPath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            aHash.update(chunk)
+
+# Returns a string identifying the input at aInputPath plus everything that
+# determines how it's processed: the source of the processing modules, the
+# rules and limits of aUtils, a Stacksig.Stacksig, and aOptions, anything else
+# with a stable repr that changes the result.
+def SnapshotKey(aInputPath, aUtils, aOptions = None):
+    st = os.stat(aInputPath)
+    h = hashlib.sha1()
+    h.update("{}|{}|{}|".format(SNAPSHOT_VERSION, st.st_size, st.st_mtime_ns).encode())
+    _HashFile(aInputPath, h)
+    for module in [Stacksig, Sigindex, Sigpartial, Sigsample, Sigtime]:
+        _HashFile(module.__file__, h)
+    rules = [
+        aUtils.ignoreFrameSubstrings,
+        aUtils.floorFrameSubstrings,
+        aUtils.targetFrameSubstrings,
+        aUtils.MAX_SIGNATURE_LEN,
+        aUtils.MAX_FRAMES_TO_SCAN,
+        aUtils.MAX_SYMBOL_LEN,
+        aOptions,
+    ]
+    h.update(repr(rules).encode())
+    return h.hexdigest()
+
+# Returns the state saved at aPath if it was saved with aKey, otherwise None.
+def Load(aPath, aKey):
+    if not os.path.isfile(aPath):
+        return None
+    try:
+        with open(aPath, "rb") as f:
+            header = pickle.load(f)
+            if header != {"version": SNAPSHOT_VERSION, "key": aKey}:
+                return None
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None # unreadable or from incompatible code; just rebuild
+
+# Saves aState to aPath under aKey. The file is written next to aPath and
+# renamed into place, so a crash never leaves a truncated snapshot behind.
+def Save(aPath, aKey, aState):
+    tmpPath = aPath + ".tmp"
+    with open(tmpPath, "wb") as f:
+        pickle.dump({"version": SNAPSHOT_VERSION, "key": aKey}, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(aState, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, aPath)
@@ -0,0 +1,121 @@
+import argparse
+import json
+import sys
+import time
+
+import Pingdata
+import Stacksig
+
+# Functions defined here:
+#     StreamRecords     yields the stack records of a stream of JSON lines
+#     SignatureRecords  signaturizes stack records, yielding output records
+#     Run               reads inputs, writes JSON lines, returns stats
+#
+# Non-interactive front end: reads JSON lines from stdin or files and writes
+# one JSON line per stack to stdout:
+#     {"signature": ..., "signatureHash": ..., "threadName": ..., "clientID": ...,
+#      "modules": [...]}
+# where signatureHash is the signature's Stacksig.SignatureHash in hex, for
+# joining the output of different runs and machines.
+#
+# Files ending in .gz, .xz or .bz2 are decompressed as they're read.
+#
+# Input lines can be raw pings (as in a ping dump), or stack records with at
+# least "frames" (as written by Pingdata.ReadResults, optionally with
+# "threadName", "clientID" and "modules"). Both can be mixed in one stream.
+#
+# Every line is processed and written before the next is read, so memory use
+# doesn't grow with the input. No client dedup is done; that needs the whole
+# corpus, see Sigpartial.py.
+#
+# Command line usage:
+#     Sigstream.py < big.json > sigs.jsonl
+#     Sigstream.py big.json more.json.gz -o sigs.jsonl
+#     cat stacks.jsonl | Sigstream.py - | grep xul
+
+# Yields lists of stack records for each line of aLines, an iterable of
+# JSON lines as bytes or str. Blank lines are skipped.
+#
+# aStats    dict with "lines", "pings", "results" and "stacks" counters,
+#           updated as lines are read.
+def StreamRecords(aLines, aStats):
+    for line in aLines:
+        if not line.strip():
+            continue
+        aStats["lines"] += 1
+        data = Pingdata.ParsePing(line) if isinstance(line, bytes) else json.loads(line)
+        if "frames" in data:
+            aStats["stacks"] += 1
+            yield [data]
+            continue
+        aStats["pings"] += 1
+        for filtered in Pingdata.PingResults(data, aStats):
+            aStats["stacks"] += len(filtered)
+            yield filtered
+
+# Yields an output record for each stack record in aRecords, an iterable of
+# lists of stack records as from StreamRecords.
+def SignatureRecords(aRecords, aUtils):
+    for filtered in aRecords:
+        for stack in filtered:
+            threadName = stack["threadName"] if "threadName" in stack else None
+            signature, _ = aUtils.StackToSignature(stack["frames"], threadName, False)
+            yield {
+                "signature": signature,
+                "signatureHash": Stacksig.FormatSignatureHash(Stacksig.SignatureHash(signature)),
+                "threadName": threadName,
+                "clientID": stack["clientID"] if "clientID" in stack else None,
+                "modules": stack["modules"] if "modules" in stack else [],
+            }
+
+# Signaturizes every stack in the files aInputs ("-" is stdin) and writes the
+# output records to aOutput, a text file object.
+#
+# Returns the stats dict: lines, pings, results, stacks and seconds.
+def Run(aInputs, aOutput):
+    utils = Stacksig.Stacksig()
+    stats = {"lines": 0, "pings": 0, "results": 0, "stacks": 0}
+    start = time.time()
+    for path in aInputs:
+        if path == "-":
+            f = sys.stdin.buffer
+        elif Pingdata.IsCompressed(path):
+            f = Pingdata.StreamLines(path)
+        else:
+            f = open(path, "rb")
+        try:
+            for record in SignatureRecords(StreamRecords(f, stats), utils):
+                aOutput.write(json.dumps(record))
+                aOutput.write("\n")
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+    aOutput.flush()
+    stats["seconds"] = time.time() - start
+    return stats
+
+def main(aArgs):
+    parser = argparse.ArgumentParser(description = "Signaturize a stream of pings or stack records.")
+    parser.add_argument("inputs", nargs = "*", default = ["-"], help = "JSON lines files, optionally compressed, - for stdin (the default)")
+    parser.add_argument("-o", "--output", help = "file to write, instead of stdout")
+    parser.add_argument("-q", "--quiet", action = "store_true", help = "don't report stats on stderr")
+    args = parser.parse_args(aArgs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            stats = Run(args.inputs, f)
+    else:
+        stats = Run(args.inputs, sys.stdout)
+
+    if not args.quiet:
+        seconds = max(stats["seconds"], 1e-9)
+        sys.stderr.write("{} lines, {} pings, {} results, {} stacks in {:.2f}s ({:.0f} lines/s, {:.0f} stacks/s)\n".format(
+            stats["lines"], stats["pings"], stats["results"], stats["stacks"], stats["seconds"],
+            stats["lines"] / seconds, stats["stacks"] / seconds))
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except BrokenPipeError:
+        # eg piped into head; nothing more to write
+        sys.stderr.close()
@@ -0,0 +1,314 @@
+import argparse
+import bisect
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+import Pingdata
+
+# Functions defined in class Zipf:
+#     Sample        a random rank, 0 the most likely
+#
+# Functions defined in class PingGenerator:
+#     Functions     the function symbol pool of one frame module
+#     Symbol        a random templated C++ function symbol
+#     Frames        a random symbolicated stack
+#     Ping          one random ping, eligible or not
+#     Chunk         the pings of one chunk of the dump
+#
+# Module functions:
+#     ChunkLines    the JSON lines of one chunk, for a worker process
+#     WriteDump     writes a whole synthetic dump
+#
+# Writes synthetic ping dumps shaped like a telemetry export (big.json), for
+# load-testing main.py, Sigpartial.py and friends at sizes real data can't be
+# shared at. Modules, functions, thread names and clients are Zipf-distributed,
+# so a few are everywhere and most are rare. Function symbols are templated
+# C++ in the style of TestData_FrameToString, untidy spacing included. Some
+# pings are wow64, and some are malformed in the ways Pingdata drops: no
+# client, no stacks, or symbolication errors instead of results.
+#
+# Everything is seeded. The dump is made in chunks of CHUNK_PINGS pings, each
+# with its own generator seeded from the seed and the chunk number, so the
+# chunks can be made in parallel and the file is the same byte for byte
+# whatever the number of processes. The same seed and options always give the
+# same file.
+#
+# Command line usage:
+#     Sigsynth.py big.json --pings 1000000
+#     Sigsynth.py big.json.gz --pings 20000000 --seed 7 --processes 8
+
+CHUNK_PINGS = 10000
+MAX_DEPTH = 120
+
+# Per-ping odds of each kind of ineligible ping.
+WOW64_RATE = 0.05
+MALFORMED_RATE = 0.02
+
+# Where the dump's creation dates start, and how many days they cover.
+START_TIME = 1561939200 # 2019-07-01T00:00:00Z
+DAYS = 35
+
+# Frame modules that every stack goes through, as (module, function).
+LOADER_PREFIXES = [
+    [("ntdll.pdb", "LdrLoadDll"), ("kernelbase.pdb", "LoadLibraryExW"), ("kernel32.pdb", "LoadLibraryW")],
+    [("ntdll.pdb", "LdrLoadDll"), ("mozglue.pdb", "patched_LdrLoadDll"), ("kernelbase.pdb", "LoadLibraryExW")],
+    [("ntdll.pdb", "LdrLoadDll"), ("kernelbase.pdb", "LoadLibraryExW"), ("combase.pdb", "CoGetClassObject"),
+     ("combase.pdb", "CoCreateInstance")],
+    [("ntdll.pdb", "LdrLoadDll"), ("clr.pdb", "LoadAssembly")],
+    [("ntdll.pdb", "LdrLoadDll")],
+]
+THREAD_START = [("kernel32.pdb", "BaseThreadInitThunk"), ("ntdll.pdb", "RtlUserThreadStart")]
+
+# The most common frame modules, most common first. The rest of the pool is
+# made up.
+COMMON_MODULES = [
+    "xul.pdb", "ntdll.pdb", "kernelbase.pdb", "user32.pdb", "combase.pdb", "ole32.pdb",
+    "mozglue.pdb", "nss3.pdb", "kernel32.pdb", "shell32.pdb", "win32u.pdb", "uxtheme.pdb",
+]
+
+THREAD_NAMES = [
+    "", "Gecko_IOThread", "Socket Thread", "StreamTrans #1", "DOM Worker", "Compositor",
+    "ImageIO", "Timer", "BgHangManager", "Cache2 I/O", "mscom", "WinWindowsEvents",
+]
+
+NAMESPACES = [
+    "mozilla", "mozilla::dom", "mozilla::ipc", "mozilla::detail", "mozilla::widget", "js",
+    "js::jit", "IPC", "std", "`anonymous namespace'", "nsThreadUtils", "base",
+]
+CLASS_NAMES = [
+    "Runnable", "RunnableFunction", "RunnableMethodImpl", "MessageChannel", "TaskQueue",
+    "EventQueue", "HTMLMediaElement", "WindowsDllInterceptor", "ParamTraits", "ScopedCOM",
+    "LoaderObserver", "PrintDialog", "ShellService", "FileSystem", "AccessibleWrap",
+]
+METHOD_NAMES = [
+    "Run", "Init", "Dispatch", "Call", "Invoke", "Load", "Read", "Write", "OnMessageReceived",
+    "ProcessNextEvent", "Open", "Create", "GetInterface", "HandleEvent", "Notify",
+]
+TEMPLATE_ARGS = [
+    "T", "int", "unsigned int", "unsigned __int64", "char const *", "wchar_t * *", "bool",
+    "std::allocator<char>", "mozilla::Maybe<unsigned char>", "void *", "nsTString<char16_t>",
+    "`lambda at z:\\build\\build\\src\\dom\\html\\HTMLMediaElement.cpp:7150:11'",
+    "IAccessible, &IID_IAccessible",
+]
+PARAM_TYPES = [
+    "int", "unsigned  long", "unsigned __int16", "char const*", "wchar_t const *", "void *",
+    "class IPC::Message const*", "class PickleIterator*", "struct HINSTANCE__*", "bool",
+    "nsresult (*)(void *)", "unsigned char * *", "const nsACString&", "unsigned int",
+]
+RETURN_TYPES = [
+    "", "", "void ", "static void ", "nsresult ", "bool ", "static long ", "struct HINSTANCE__* ",
+    "unsigned int ", "already_AddRefed<nsIRunnable> ",
+]
+OPERATORS = ["operator()", "operator==", "operator new", "operator<<", "operator bool"]
+QUALIFIERS = ["", "", "", " const", " const &", "&&"]
+
+# Samples ranks 0..aNumItems-1 with probability proportional to
+# 1 / (rank + 1) ** aExponent.
+class Zipf(object):
+    def __init__(self, aNumItems, aExponent):
+        self.cumulative = []
+        total = 0.0
+        for rank in range(aNumItems):
+            total += 1.0 / (rank + 1) ** aExponent
+            self.cumulative.append(total)
+        self.total = total
+
+    def Sample(self, aRng):
+        return bisect.bisect(self.cumulative, aRng.random() * self.total)
+
+class PingGenerator(object):
+    def __init__(self, aSeed, aNumPings, aNumClients = None, aNumModules = 2000, aNumUntrusted = 5000):
+        self.seed = aSeed
+        self.numPings = aNumPings
+        numClients = aNumClients or max(aNumPings // 4, 1)
+        self.clients = Zipf(numClients, 0.8)
+        self.modules = COMMON_MODULES + ["mod{}.pdb".format(i) for i in range(max(aNumModules - len(COMMON_MODULES), 0))]
+        self.moduleRanks = Zipf(len(self.modules), 1.1)
+        self.untrusted = Zipf(aNumUntrusted, 1.0)
+        self.threadNames = Zipf(len(THREAD_NAMES), 1.2)
+        self.functions = {} # frame module -> (symbols, Zipf)
+
+    # Returns (symbols, Zipf) for the frame module aModule. Each module's pool
+    # is made from its own seed, so it doesn't depend on which chunk asks
+    # first.
+    def Functions(self, aModule):
+        if aModule not in self.functions:
+            rng = random.Random("{}/{}".format(self.seed, aModule))
+            symbols = [self.Symbol(rng) for _ in range(rng.randrange(10, 150))]
+            self.functions[aModule] = (symbols, Zipf(len(symbols), 1.1))
+        return self.functions[aModule]
+
+    def _Templated(self, aRng, aDepth):
+        name = aRng.choice(CLASS_NAMES)
+        if aDepth < 3 and aRng.random() < 0.5:
+            args = [self._Templated(aRng, aDepth + 1) if aRng.random() < 0.3 else aRng.choice(TEMPLATE_ARGS)
+                    for _ in range(aRng.randrange(1, 4))]
+            spacing = aRng.choice([",", ", ", " ,", ",  "])
+            name += "<" + spacing.join(args) + (" >" if args[-1].endswith(">") else ">")
+        return name
+
+    # Returns a random symbol, eg
+    #     "nsresult mozilla::detail::RunnableFunction<`lambda at ...'>::Run()"
+    def Symbol(self, aRng):
+        scope = aRng.choice(NAMESPACES) + "::" + self._Templated(aRng, 0)
+        if aRng.random() < 0.1:
+            method = aRng.choice(OPERATORS)
+        else:
+            method = aRng.choice(METHOD_NAMES)
+            if aRng.random() < 0.2:
+                method += "<{}>".format(aRng.choice(TEMPLATE_ARGS))
+        params = ", ".join(aRng.choice(PARAM_TYPES) for _ in range(aRng.randrange(4)))
+        return "{}{}::{}({}){}".format(aRng.choice(RETURN_TYPES), scope, method, params, aRng.choice(QUALIFIERS))
+
+    def _Frame(self, aRng, aIndex, aModule, aFunction):
+        # random() rather than randrange(), which is several times slower
+        frame = {"frame": aIndex, "module_offset": "0x{:x}".format(0x1000 + int(aRng.random() * 0x3fff000))}
+        if aModule:
+            frame["module"] = aModule
+        if aFunction:
+            frame["function"] = aFunction
+            frame["function_offset"] = "0x{:x}".format(int(aRng.random() * 0x800))
+        return frame
+
+    # Returns a random symbolicated stack, innermost frame first: the loader
+    # frames, some Zipf-distributed callers, then usually the thread start.
+    def Frames(self, aRng):
+        frames = list(aRng.choice(LOADER_PREFIXES))
+        for _ in range(min(int(aRng.lognormvariate(2.0, 0.7)), MAX_DEPTH)):
+            module = self.modules[self.moduleRanks.Sample(aRng)]
+            symbols, ranks = self.Functions(module)
+            frames.append((module, symbols[ranks.Sample(aRng)]))
+        if aRng.random() < 0.9:
+            frames.extend(THREAD_START)
+
+        ret = []
+        for i, (module, function) in enumerate(frames):
+            odds = aRng.random()
+            if odds < 0.01:
+                module, function = None, None # an address outside any module
+            elif odds < 0.05:
+                function = None # no symbols for the module
+            ret.append(self._Frame(aRng, i, module, function))
+        return ret
+
+    def _Untrusted(self, aRank):
+        vendor = "vendor{}".format(aRank // 3)
+        return "c:\\program files\\{}\\{}hook{}.dll".format(vendor, vendor, aRank % 3)
+
+    # Returns one random ping, and the number of stack records Pingdata will
+    # read from it: 0 for wow64 and malformed pings.
+    def Ping(self, aRng):
+        ping = {
+            "client_id": "client{}".format(self.clients.Sample(aRng)),
+            "creation_date": time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                time.gmtime(START_TIME + aRng.randrange(DAYS * 24 * 3600))),
+            "environment": {"system": {"is_wow64": False}},
+            "payload": {"events": []},
+        }
+        results = []
+        numStacks = 0
+        for _ in range(1 if aRng.random() < 0.9 else 2):
+            ping["payload"]["events"].append({
+                "thread_name": THREAD_NAMES[self.threadNames.Sample(aRng)],
+                "modules": [{"module_name": self._Untrusted(self.untrusted.Sample(aRng))}
+                            for _ in range(aRng.randrange(1, 4))],
+            })
+            stacks = [self.Frames(aRng) for _ in range(1 if aRng.random() < 0.8 else 2)]
+            results.append({"stacks": stacks})
+            numStacks += len(stacks)
+        ping["symbolicated_stacks"] = json.dumps({"results": results}, separators = (",", ":"))
+
+        odds = aRng.random()
+        if odds < WOW64_RATE:
+            ping["environment"]["system"]["is_wow64"] = True
+            numStacks = 0
+        elif odds < WOW64_RATE + MALFORMED_RATE:
+            kind = aRng.randrange(3)
+            if kind == 0:
+                del ping["client_id"]
+            elif kind == 1:
+                del ping["symbolicated_stacks"]
+            else:
+                ping["symbolicated_stacks"] = json.dumps({"errors": ["symbolication failed"]})
+            numStacks = 0
+        return ping, numStacks
+
+    # Yields (ping, number of stack records) for each ping of chunk aChunk.
+    def Chunk(self, aChunk):
+        rng = random.Random("{}#{}".format(self.seed, aChunk))
+        for _ in range(min(CHUNK_PINGS, self.numPings - aChunk * CHUNK_PINGS)):
+            yield self.Ping(rng)
+
+# One generator per worker process, reused for every chunk it makes.
+_workerGenerator = None
+
+# Returns (bytes of the JSON lines, number of pings, number of stack records)
+# for one chunk. Takes a single (generator options, chunk) tuple so it can be
+# handed straight to Pool.imap.
+def ChunkLines(aArgs):
+    global _workerGenerator
+    options, chunk = aArgs
+    if _workerGenerator is None or _workerGenerator.options != options:
+        _workerGenerator = PingGenerator(*options)
+        _workerGenerator.options = options
+    lines = []
+    numStacks = 0
+    for ping, n in _workerGenerator.Chunk(chunk):
+        lines.append(json.dumps(ping, separators = (",", ":")))
+        numStacks += n
+    return ("\n".join(lines) + "\n").encode(), len(lines), numStacks
+
+# Writes a dump of aNumPings pings to aPath, compressed if it ends in .gz, .xz
+# or .bz2. aOptions are the remaining PingGenerator arguments after the seed
+# and number of pings.
+#
+# Returns a dict with "pings" and "stacks", the number of stack records
+# Pingdata.ReadResults will read back.
+def WriteDump(aPath, aNumPings, aSeed = 1, aProcesses = 1, aOptions = (), aProgress = None):
+    options = (aSeed, aNumPings) + tuple(aOptions)
+    chunks = [(options, chunk) for chunk in range((aNumPings + CHUNK_PINGS - 1) // CHUNK_PINGS)]
+    stats = {"pings": 0, "stacks": 0}
+    opener = open
+    for ext, compressedOpener in Pingdata.COMPRESSED_OPENERS.items():
+        if aPath.endswith(ext):
+            opener = compressedOpener
+
+    with opener(aPath, "wb") as f:
+        def write(aResults):
+            for data, numPings, numStacks in aResults:
+                f.write(data)
+                stats["pings"] += numPings
+                stats["stacks"] += numStacks
+                if aProgress:
+                    aProgress(stats)
+        if aProcesses > 1:
+            with multiprocessing.Pool(aProcesses) as pool:
+                write(pool.imap(ChunkLines, chunks))
+        else:
+            write(map(ChunkLines, chunks))
+    return stats
+
+def main(aArgs):
+    parser = argparse.ArgumentParser(description = "Write a synthetic ping dump.")
+    parser.add_argument("output", help = "dump to write; .gz, .xz and .bz2 are compressed")
+    parser.add_argument("--pings", type = int, default = 100000)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--clients", type = int, help = "number of clients (default a quarter of the pings)")
+    parser.add_argument("--modules", type = int, default = 2000, help = "number of frame modules")
+    parser.add_argument("--untrusted", type = int, default = 5000, help = "number of untrusted modules")
+    parser.add_argument("--processes", type = int, default = 1, help = "worker processes")
+    args = parser.parse_args(aArgs)
+
+    start = time.time()
+    def progress(aStats):
+        if aStats["pings"] % (CHUNK_PINGS * 100) == 0:
+            sys.stderr.write("{} pings...\n".format(aStats["pings"]))
+    stats = WriteDump(args.output, args.pings, args.seed, args.processes,
+                      (args.clients, args.modules, args.untrusted), progress)
+    sys.stderr.write("{} pings, {} stacks in {:.1f}s\n".format(stats["pings"], stats["stacks"], time.time() - start))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,144 @@
+# Functions defined in class TimeBuckets:
+#     Add           counts a client for some keys at a time
+#     Buckets       bucket indexes in the window, oldest first
+#     Counts        counts per key over the newest buckets
+#     Series        count of one key in each bucket of the window
+#     Spikes        keys whose recent count is well above their baseline
+#
+# Functions defined in class Timeline:
+#     AddStack      adds a stack record to the hourly and daily buckets
+#
+# A TimeBuckets is a ring buffer of fixed-width time buckets, eg the last 192
+# hours. Each bucket counts unique clients per key (a signature or a module),
+# so, like the global counts, one client sending the same thing many times in
+# an hour counts once for that hour. Adding data only touches the bucket it
+# falls in; when time moves past the end of the ring, the oldest buckets are
+# cleared and reused. Data older than the window is counted in "dropped".
+#
+# "Now" is the newest bucket that has seen data, not the wall clock, so a
+# dump from last month reads the same as a live feed.
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+class TimeBuckets(object):
+    def __init__(self, aBucketSeconds, aNumBuckets):
+        self.bucketSeconds = aBucketSeconds
+        self.numBuckets = aNumBuckets
+        self.newest = None # index of the newest bucket (time // bucketSeconds)
+        self.oldest = None # index of the oldest bucket that has seen data
+        self.slots = [None] * aNumBuckets # index % numBuckets -> bucket
+        self.dropped = 0
+
+    def _Bucket(self, aIndex):
+        slot = self.slots[aIndex % self.numBuckets]
+        if slot is None or slot["index"] != aIndex:
+            return None
+        return slot
+
+    # Counts aClientID once for each of aKeys in the bucket of aTime, in
+    # seconds since the epoch.
+    def Add(self, aTime, aClientID, aKeys):
+        index = int(aTime // self.bucketSeconds)
+        if self.newest is None or index > self.newest:
+            self.newest = index
+        elif index <= self.newest - self.numBuckets:
+            self.dropped += 1
+            return
+        if self.oldest is None or index < self.oldest:
+            self.oldest = index
+        bucket = self._Bucket(index)
+        if bucket is None:
+            # a new bucket; whatever was in the slot is out of the window
+            bucket = {"index": index, "seen": set(), "counts": {}}
+            self.slots[index % self.numBuckets] = bucket
+        for key in aKeys:
+            if (aClientID, key) in bucket["seen"]:
+                continue
+            bucket["seen"].add((aClientID, key))
+            bucket["counts"][key] = bucket["counts"].get(key, 0) + 1
+
+    # Returns the indexes of the aNumBuckets buckets ending with the newest,
+    # oldest first. Defaults to the whole window. Buckets from before the
+    # first data are left out.
+    def Buckets(self, aNumBuckets = None):
+        if self.newest is None:
+            return []
+        n = min(aNumBuckets or self.numBuckets, self.numBuckets)
+        return list(range(max(self.newest - n + 1, self.oldest), self.newest + 1))
+
+    # Returns a dict key -> count summed over the aNumBuckets newest buckets,
+    # or over aIndexes if given.
+    def Counts(self, aNumBuckets = None, aIndexes = None):
+        ret = {}
+        for index in self.Buckets(aNumBuckets) if aIndexes is None else aIndexes:
+            bucket = self._Bucket(index)
+            if bucket is None:
+                continue
+            for key, count in bucket["counts"].items():
+                ret[key] = ret.get(key, 0) + count
+        return ret
+
+    # Returns a list of (bucket start time, count of aKey) over the window,
+    # oldest first.
+    def Series(self, aKey):
+        ret = []
+        for index in self.Buckets():
+            bucket = self._Bucket(index)
+            count = bucket["counts"].get(aKey, 0) if bucket else 0
+            ret.append((index * self.bucketSeconds, count))
+        return ret
+
+    # Finds keys whose count over the aRecent newest buckets is at least
+    # aFactor times what their average over the aBaseline buckets before that
+    # predicts for aRecent buckets. Keys with no baseline count as spikes if
+    # the recent count is at least aMinCount, which also filters out noise.
+    #
+    # Returns a list of (key, recent count, expected count, ratio), highest
+    # ratio first. ratio is inf for keys with no baseline.
+    def Spikes(self, aRecent, aBaseline, aFactor, aMinCount = 5):
+        recentIndexes = self.Buckets(aRecent)
+        if not recentIndexes:
+            return []
+        first = recentIndexes[0]
+        baselineIndexes = [i for i in range(first - aBaseline, first)
+                           if i > self.newest - self.numBuckets and i >= self.oldest]
+        recent = self.Counts(aIndexes = recentIndexes)
+        baseline = self.Counts(aIndexes = baselineIndexes)
+        ret = []
+        for key, count in recent.items():
+            if count < aMinCount:
+                continue
+            expected = 0
+            if key in baseline:
+                expected = baseline[key] * len(recentIndexes) / len(baselineIndexes)
+            if not expected:
+                ret.append((key, count, 0, float("inf")))
+            elif count >= aFactor * expected:
+                ret.append((key, count, expected, count / expected))
+        return sorted(ret, key = lambda x: (-x[3], -x[1], x[0]))
+
+# Hourly and daily signature and module counts. Times are the "timestamp"
+# of stack records, see Pingdata.PingResults.
+class Timeline(object):
+    def __init__(self, aHours = 8 * 24, aDays = 35):
+        self.hourlySignatures = TimeBuckets(HOUR, aHours)
+        self.hourlyModules = TimeBuckets(HOUR, aHours)
+        self.dailySignatures = TimeBuckets(DAY, aDays)
+        self.dailyModules = TimeBuckets(DAY, aDays)
+        self.untimed = 0
+
+    # aStack is a stack record with its "signature". Records without a
+    # "timestamp" are only counted in self.untimed.
+    def AddStack(self, aStack):
+        timestamp = aStack["timestamp"] if "timestamp" in aStack else None
+        if timestamp is None:
+            self.untimed += 1
+            return
+        clientID = aStack["clientID"] if "clientID" in aStack else None
+        signature = [aStack["signature"]]
+        modules = aStack["modules"] if "modules" in aStack else []
+        self.hourlySignatures.Add(timestamp, clientID, signature)
+        self.dailySignatures.Add(timestamp, clientID, signature)
+        self.hourlyModules.Add(timestamp, clientID, modules)
+        self.dailyModules.Add(timestamp, clientID, modules)
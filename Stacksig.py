@@ -1,3 +1,4 @@
+import hashlib
 import re
 from enum import Enum, auto
 
@@ -5,12 +6,177 @@ from enum import Enum, auto
 #     IsolateFunctionName   a utility used by StackFrameToString
 #     StackFrameToString    converts a single frame to a single string for either
 #                           printing or signature generation
+#     FrameDictToString     StackFrameToString for a frame dict from
+#                           symbolication
 #     StackToSignature      Converts a whole stack into a single string
 #                           signature
+#     FrameSignatures       the per-frame half of StackToSignature, which
+#                           doesn't depend on the rules
+#     SignatureFromFrames   the rules half of StackToSignature
+#
+# Functions defined in class SignatureBuilder:
+#     AddFrame              adds the next frame; says if the signature is final
+#     AddFrameSignature     AddFrame for a frame from FrameSignatures
+#     Result                the signature of the frames so far
+#
+# Module functions used by IsolateFunctionName:
+#     ReplaceEnclosed       replaces each `...' or [...] style span in one pass
+#     FindOperator          locates the operator text of an operator function
+#
+# Module functions used by StackFrameToString:
+#     PrettyFunction        tidies up the spacing and qualifiers of a symbol
+#
+# Other module functions:
+#     SignatureHash         stable 64-bit hash of a signature string
+#     FormatSignatureHash   the hex form of a hash, as shown and written out
+#
+# Symbols come from untrusted pings, so everything that runs on them must be
+# linear in the length of the symbol, and the length itself is capped by
+# MAX_SYMBOL_LEN. Regexes that can backtrack over the same text from many
+# start positions (eg "\[.*?\]" on a string of '[') are written out by hand
+# or anchored with lookbehinds instead.
+#
+# A Stacksig can be shared between threads. Everything it holds is set up in
+# the constructor and never changed after (the rule lists are tuples so they
+# can't be changed in place by accident), and the methods only work on locals,
+# so there are no locks and no caches to guard. A SignatureBuilder belongs to
+# one stack, and to one thread at a time.
 #
 # NOTE that the "bottom" and "top" terminology can be confusing because stacks
 # are often listed bottom-to-top. So the stack "bottom" is array element [0]
 
+# Replaces every span that starts with aOpen and ends at the next aClose with
+# aReplacement. Spans don't cross newlines, and an aOpen with no aClose after it
+# is left alone. This is the same as re.sub(aOpen + ".*?" + aClose, ...) but
+# runs in linear time even when there are lots of aOpen and no aClose.
+def ReplaceEnclosed(aText, aOpen, aClose, aReplacement):
+    ret = []
+    pos = 0
+    while True:
+        start = aText.find(aOpen, pos)
+        if start == -1:
+            break
+        end = aText.find(aClose, start + 1)
+        if end == -1:
+            break # no more closers, so nothing else can match either
+        newline = aText.find("\n", start + 1, end)
+        if newline != -1:
+            # nothing that opens before this newline can close after it
+            ret.append(aText[pos:newline + 1])
+            pos = newline + 1
+            continue
+        ret.append(aText[pos:start])
+        ret.append(aReplacement)
+        pos = end + 1
+    ret.append(aText[pos:])
+    return "".join(ret)
+
+OPERATOR_WORD = re.compile(r"\boperator\b")
+OPERATOR_CALL = re.compile(r"\(\s*\)")
+
+# Finds the operator in aFunction the same way as searching for
+#     (?P<all>\boperator\b(?P<op>(\(\s*\)|.*?)))(\(|$)
+# but in linear time; the regex rescans the rest of the string for every
+# "operator" that is followed by a newline.
+#
+# Returns (start, end, opText) for the "all" group, or None.
+def FindOperator(aFunction):
+    length = len(aFunction)
+    def atEnd(i):
+        return i == length or (i == length - 1 and aFunction[i] == "\n")
+
+    nextParen = -1
+    nextNewline = -1
+    for word in OPERATOR_WORD.finditer(aFunction):
+        pos = word.end()
+
+        # operator()(...): the op is the empty call parens
+        call = OPERATOR_CALL.match(aFunction, pos)
+        if call and (atEnd(call.end()) or aFunction[call.end()] == "("):
+            return word.start(), call.end(), aFunction[pos:call.end()]
+
+        # otherwise everything up to the next paren or the end, not crossing a
+        # newline. The lookups are cached because they only ever move forward.
+        if nextParen != length and nextParen < pos:
+            nextParen = aFunction.find("(", pos)
+            nextParen = length if nextParen == -1 else nextParen
+        if nextNewline != length and nextNewline < pos:
+            nextNewline = aFunction.find("\n", pos)
+            nextNewline = length if nextNewline == -1 else nextNewline
+        if nextParen < nextNewline:
+            return word.start(), nextParen, aFunction[pos:nextParen]
+        if atEnd(nextNewline):
+            return word.start(), nextNewline, aFunction[pos:nextNewline]
+    return None
+
+# Leading "static", "void" and spaces. Anchored, so it only looks at the head.
+PRETTY_LEADING = re.compile(r"(\s|\bstatic\b|\bvoid\b)+")
+
+# The rewrites PrettyFunction makes in the middle of a symbol, one alternative
+# each, tried at every position in one scan. The group that matched picks the
+# replacement from PRETTY_REPLACEMENTS:
+#   1. "unsigned __int16" -> "uint16": "unsigned", spaces and any number of
+#      underscores before a type name become "u"
+#   2. exactly one space after a comma. ", " followed by anything but a space
+#      or "*" is already right, so it's skipped rather than replaced
+#   3. no spaces before an asterisk, which turns "char * * const *" into
+#      "char** const*"
+#   4. any other run of spaces becomes one space. Again a single " " is
+#      skipped, which is most of them
+PRETTY_MIDDLE = re.compile(
+    r"(unsigned\s+_*)(?=char|long|short|int|int64|int32|int16|int8)"
+    r"|(,(?! [^\s*])\s*)"
+    r"|(\s+\*)"
+    r"|((?! \S)\s+)")
+PRETTY_REPLACEMENTS = (None, "u", ", ", "*", " ")
+
+def _IsWordChar(aChar):
+    return aChar.isalnum() or aChar == "_"
+
+# Tidies up the oddness that comes from symbolication in aFunction, for
+# pretty-printing: leading "static", "void" and trailing "const", "&" are
+# dropped, "unsigned int" becomes "uint", and spaces around commas and
+# asterisks are normalized. Gives the same result as the re.sub chain this
+# used to be (see StacksigBench.ChainedPrettyFunction), applying in order
+#     re.sub(r"(^(\s|\bstatic\b|\bvoid\b)+)|((\s|\bconst\b|&)+$)", "", f)
+#     re.sub(r"(unsigned\s+_*)(?=char|long|short|int|int64|int32|int16|int8)", "u", f)
+#     re.sub(r"\s+\*", "*", f)
+#     re.sub(r",\s*", ", ", f)
+#     re.sub(r"\s+", " ", f)
+# but the ends are only looked at where they're stripped and the middle is
+# scanned once, instead of the whole symbol being copied and rescanned six
+# times.
+def PrettyFunction(aFunction):
+    leading = PRETTY_LEADING.match(aFunction)
+    start = leading.end() if leading else 0
+
+    # Trailing spaces, "&" and "const", found walking back from the end. A
+    # "const" only counts as a whole word; the character after it has
+    # already been stripped, so only the one before needs checking.
+    end = len(aFunction)
+    while end > start:
+        last = aFunction[end - 1]
+        if last.isspace() or last == "&":
+            end -= 1
+        elif aFunction.endswith("const", start, end) and (end - 5 == start or not _IsWordChar(aFunction[end - 6])):
+            end -= 5
+        else:
+            break
+
+    return PRETTY_MIDDLE.sub(lambda m: PRETTY_REPLACEMENTS[m.lastindex], aFunction[start:end])
+
+# Returns a 64-bit hash of the signature string aSignature, as an int in
+# [0, 2**64). Unlike hash() it's the same on every run and machine, so it
+# identifies a signature across runs, where signature IDs (list positions)
+# don't. It's the first 8 bytes of the BLAKE2b digest of the UTF-8 text.
+def SignatureHash(aSignature):
+    return int.from_bytes(hashlib.blake2b(aSignature.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+# Returns aHash as 16 hex digits. JSON output uses this rather than a number,
+# which many JSON readers can't hold exactly above 2**53.
+def FormatSignatureHash(aHash):
+    return "{:016x}".format(aHash)
+
 class Stacksig(object):
     def __init__(self):
 
@@ -18,6 +184,9 @@ class Stacksig(object):
         # and maximum stack frames
         self.MAX_SIGNATURE_LEN = 240
         self.MAX_FRAMES_TO_SCAN = 40
+        # Longer function symbols are truncated before being parsed. Real
+        # symbols, even heavily templated ones, are well under this.
+        self.MAX_SYMBOL_LEN = 4096
 
         self.OPERATOR_SUBST = "@OPERATOR_SUBST@"
         self.SIG_TOKEN_DELIMITER = " | "
@@ -26,14 +195,14 @@ class Stacksig(object):
         # Frame substrings that should be discarded from the start. These are
         # not useful to signature generation or could even cause inaccurate
         # signatures.
-        self.ignoreFrameSubstrings = [
+        self.ignoreFrameSubstrings = (
             "KiUserCallbackDispatcher",
             "patched_LdrLoadDll",
             # almost every stack has this at the top but it's not helpful and
             # if we don't ignore it, it will act as a (very unhelpful) target
             # frame
             "BaseThreadInitThunk",
-        ]
+        )
 
         # We want to search for frames "above" a certain floor. These "floor"
         # frame substrings mark the place in the stack where we already have
@@ -51,11 +220,11 @@ class Stacksig(object):
         # time, because that will almost always be at the bottom of the stack.
         # Floor frames help us look up the stack and try to get out of the
         # "we know this is loading a DLL" zone.
-        self.floorFrameSubstrings = [
+        self.floorFrameSubstrings = (
             "CoCreateInstance",
             "LoadAssembly",
             "LoadLibrary",
-        ]
+        )
 
         # A "target" frame is one where we are specifically interested in seeing
         # in a signature. Similar to Socorro's prefix signature, except we don't
@@ -67,7 +236,7 @@ class Stacksig(object):
         #
         # Bottom line: This allows us to see where in Firefox code DLLs were
         # loaded from.
-        self.targetFrameSubstrings = [
+        self.targetFrameSubstrings = (
             "AccessibleHandler!",
             "AccessibleMarshal!",
             "firefox!",
@@ -76,20 +245,31 @@ class Stacksig(object):
             "mozglue!",
             "nss3!",
             "xul!",
-        ]
+        )
 
     # This function attempts to take any C-ish function signature from
     # symbolication and return the function name only. These symbols have a lot
     # of odd cases so here we try and get the best bang-for-the-buck.
     #
+    # aDebug is optional; pass False to skip collecting debug messages, which
+    # is noticeably cheaper.
+    #
     # Returns a tuple (functionName, debug)
     # Where
     #     functionName is the isolated function name. Always valid, non-empty.
     #     debug is an array of messages generated during the parsing process.
-    def IsolateFunctionName(self, aFunction):
+    #           Empty if aDebug is False.
+    def IsolateFunctionName(self, aFunction, aDebug = True):
         debug = [] # return debug info to caller
         function = aFunction.strip()
 
+        # Pathological input. Parse what fits; the name will usually still be
+        # in there, and if not we return something harmless.
+        if len(function) > self.MAX_SYMBOL_LEN:
+            if aDebug:
+                debug.append("Truncated from {} chars".format(len(function)))
+            function = function[:self.MAX_SYMBOL_LEN]
+
         # Consider unnamed namespaces and lambdas enclosed in `'
         # eg RunnableFunction<`lambda at z:\/build\/build\/src\/dom\/html\/HTMLMediaElement.cpp:7150:11'>::Run()
         # eg HMODULE `anonymous namespace'::LoadLibrary()
@@ -97,7 +277,7 @@ class Stacksig(object):
         # Replace anything between these quotes (non-greedy) with "unnamed"
         # eg RunnableFunction<unnamed>::Run()
         # eg HMODULE unnamed::LoadLibrary()
-        function = re.sub(r"\`.*?\'", "unnamed", function)
+        function = ReplaceEnclosed(function, "`", "'", "unnamed")
 
         # How we deal with C++ operators.
         #
@@ -127,19 +307,20 @@ class Stacksig(object):
         # then restored with opText as
         #          xyz::operator +
         opText = None
-        parens = r"(\(\s*\))"
         # search for word "operator", then either () or whatever-else (non-greedy) until we hit an open paren or the end of the string.
-        match = re.search(r"(?P<all>\boperator\b(?P<op>(" + parens + r"|.*?)))(\(|$)", function)
+        match = FindOperator(function)
         if match:
-            # Though it's tempting to return match.group('all') here, we still
-            # need to preserve other qualifiers like namespaces
-            opText = match.group('op').strip()
+            # Though it's tempting to return the whole operator text here, we
+            # still need to preserve other qualifiers like namespaces
+            allStart, allEnd, opText = match
+            opText = opText.strip()
             if opText: # Check that the parsing was actually successful
 
                 # Replace the whole operator text with a placeholder
-                function = function[:match.start('all')] + self.OPERATOR_SUBST + function[match.end('all'):]
-                debug.append("opText                  : \"{}\"".format(opText)) # eg "<<", "->*", "+=", "()", "const bool *"
-                debug.append("Remove ops              : {}".format(function))
+                function = function[:allStart] + self.OPERATOR_SUBST + function[allEnd:]
+                if aDebug:
+                    debug.append("opText                  : \"{}\"".format(opText)) # eg "<<", "->*", "+=", "()", "const bool *"
+                    debug.append("Remove ops              : {}".format(function))
 
         # Remove symbols that confuse parsing. Pointers, references, et al
         # It's important to remove indexers as well [], because it can be a part
@@ -149,8 +330,10 @@ class Stacksig(object):
         # parsing.
         #
         # Replacing by string will make sure tokens stay separated.
-        function = re.sub(r"\*|&|&&|\[.*?\]", " ", function)
-        debug.append("Remove array,ptr,ref    : {}".format(function))
+        function = ReplaceEnclosed(function, "[", "]", " ")
+        function = function.replace("*", " ").replace("&", " ")
+        if aDebug:
+            debug.append("Remove array,ptr,ref    : {}".format(function))
 
         # Now prepare to walk through the string. Remove template arguments,
         # paying attention to nesting levels.
@@ -202,15 +385,17 @@ class Stacksig(object):
         for ch in function:
             if ch == "<":
                 templateBracketLevel += 1
-                templateLevels.append(str(templateBracketLevel))
-                parenLevels.append(str(parenLevel))
+                if aDebug:
+                    templateLevels.append(str(templateBracketLevel))
+                    parenLevels.append(str(parenLevel))
                 continue
             elif ch == ">":
                 templateBracketLevel -= 1
                 if not templateBracketLevel:
                     fn2 += "<T>" # replace ALL nested templates with <T>. Even <A<B<C>>> just becomes <T>
-                templateLevels.append(str(templateBracketLevel))
-                parenLevels.append(str(parenLevel))
+                if aDebug:
+                    templateLevels.append(str(templateBracketLevel))
+                    parenLevels.append(str(parenLevel))
                 continue
 
             if ch == "(":
@@ -224,27 +409,31 @@ class Stacksig(object):
 
             if templateBracketLevel < 1:
                 fn2 += ch
-            templateLevels.append(str(templateBracketLevel))
-            parenLevels.append(str(parenLevel))
+            if aDebug:
+                templateLevels.append(str(templateBracketLevel))
+                parenLevels.append(str(parenLevel))
 
         function = fn2
-        debug.append("template levels         : {}".format("".join(templateLevels)))
-        debug.append("paren    levels         : {}".format("".join(parenLevels)))
-        debug.append("Remove templates        : {}".format(function))
+        if aDebug:
+            debug.append("template levels         : {}".format("".join(templateLevels)))
+            debug.append("paren    levels         : {}".format("".join(parenLevels)))
+            debug.append("Remove templates        : {}".format(function))
 
         # This will chop off the last plausible looking argument list
         if lastIndexWithNoParens:
-            debug.append("lastIndexWithNoParens: {}".format(lastIndexWithNoParens))
-            debug.append("                       {}".format(function[:lastIndexWithNoParens]))
-            debug.append("                       {}".format(function[lastIndexWithNoParens:]))
+            if aDebug:
+                debug.append("lastIndexWithNoParens: {}".format(lastIndexWithNoParens))
+                debug.append("                       {}".format(function[:lastIndexWithNoParens]))
+                debug.append("                       {}".format(function[lastIndexWithNoParens:]))
             function = function[:lastIndexWithNoParens]
 
         # And for functions that return function pointers, this will remove the
         # actual argument list based on the above logic.
         if firstParenLevel2:
-            debug.append("firstParenLevel2         : {}".format(firstParenLevel2))
-            debug.append("                       {}".format(function[:firstParenLevel2]))
-            debug.append("                       {}".format(function[firstParenLevel2:]))
+            if aDebug:
+                debug.append("firstParenLevel2         : {}".format(firstParenLevel2))
+                debug.append("                       {}".format(function[:firstParenLevel2]))
+                debug.append("                       {}".format(function[firstParenLevel2:]))
             function = function[:firstParenLevel2]
 
         # The function name is now the last token.
@@ -254,7 +443,8 @@ class Stacksig(object):
         # If we previously substituted an operator, replace it.
         if opText:
             function = function.replace(self.OPERATOR_SUBST, "operator " + opText)
-            debug.append("restore operator       {}".format(function))
+            if aDebug:
+                debug.append("restore operator       {}".format(function))
 
         return function, debug
 
@@ -282,44 +472,30 @@ class Stacksig(object):
     #                             be tuned for generating a stack signature.
     #                             If False, then the output is for
     #                             pretty-printing.
+    #     aDebug                  Optional; False skips collecting debug
+    #                             messages.
     #
     # Return value: tuple (result, debug)
     #
     # result   The string the caller is requesting
     # debug    An array of debug messages with info about the transformation
     #          process.
-    def StackFrameToString(self, module, moduleOffset, function, functionOffset, forSignaturification = False):
+    def StackFrameToString(self, module, moduleOffset, function, functionOffset, forSignaturification = False, aDebug = True):
         debug = []
         if function:
             if forSignaturification:
                 # In order to structure and normalize function names, which can have
                 # very crazy and unpredictable formatting, just attempt to find the
                 # function name alone.
-                function, debug = self.IsolateFunctionName(function)
+                function, debug = self.IsolateFunctionName(function, aDebug)
             else:
                 # For pretty printing just attempt to fix up some of the oddness
                 # that come from symbolication
-
-                # Remove from the front of the string: words "static", "void", or spaces
-                leadingQualifiers = r"^(\s|\bstatic\b|\bvoid\b)+"
-                # Remove from the end of the string: const, &, spaces
-                trailingQualifiers = r"(\s|\bconst\b|&)+$"
-                function = re.sub("({})|({})".format(leadingQualifiers, trailingQualifiers), "", function)
-
-                # transform "unsigned __int16" into "uint16".
-                # "unsigned", space, any number of underscore, then lookahead for the type token.
-                function = re.sub(r"(unsigned\s+_*)(?=char|long|short|int|int64|int32|int16|int8)", "u", function)
-
-                # Remove spaces before any asterisk. This turns things like
-                # "char * * const *" into "char** const*" which is just prettier.
-                function = re.sub(r"\s+\*", "*", function)
-
-                # Make sure there is 1 space after commas. Again normalizing and
-                # just more readable.
-                function = re.sub(r",\s*", ", ", function)
-
-                # And collapse multiple spaces into 1 space
-                function = re.sub(r"\s+", " ", function)
+                if len(function) > self.MAX_SYMBOL_LEN:
+                    if aDebug:
+                        debug.append("Truncated from {} chars".format(len(function)))
+                    function = function[:self.MAX_SYMBOL_LEN]
+                function = PrettyFunction(function)
 
         # from here, just concatenate strings for the result based on what
         # was provided by the caller.
@@ -341,6 +517,20 @@ class Stacksig(object):
             return ("@" + moduleOffset), debug
         return "<???>", debug
 
+    # StackFrameToString for a stack frame dict as it comes from the
+    # symbolication server. Any of the keys "module", "module_offset",
+    # "function" and "function_offset" can be missing.
+    #
+    # Returns the same tuple (result, debug) as StackFrameToString.
+    def FrameDictToString(self, aFrame, forSignaturification = False, aDebug = True):
+        return self.StackFrameToString(
+            aFrame["module"] if "module" in aFrame else "",
+            aFrame["module_offset"] if "module_offset" in aFrame else "",
+            aFrame["function"] if "function" in aFrame else "",
+            aFrame["function_offset"] if "function_offset" in aFrame else "",
+            forSignaturification,
+            aDebug)
+
     # StackToSignature converts a stack (an array of stack frames) into a single
     # string signature.
     #
@@ -353,84 +543,159 @@ class Stacksig(object):
     #              }
     # aThreadName  Optional, string. The name of the thread. It gets prepended
     #                                to the signature.
+    # aDebug       Optional. False skips collecting debug messages, for bulk
+    #              processing where they would be thrown away. Rerun with
+    #              debug on to get them for a particular stack.
     #
     # returns (signature, debug) where
     #
     # signature  The signature(!)
     # debug      An array of strings with info about the signaturification
-    #            process.
-    def StackToSignature(self, aStack, aThreadName):
-        debug = []
-        frames = []
-
-        # Initialize our frame list just with indices
-        for frame in aStack[:self.MAX_FRAMES_TO_SCAN]:
-            frames.append(
-                {
-                    "idx" : frame["frame"],
-                    "source" : frame,
-                })
-
-        # sort
-        frames = sorted(frames, key=lambda s: s["idx"])
-
-        # Iterate over the list. We do a few things at once:
-        # - get a signature for each frame
+    #            process. Empty if aDebug is False.
+    def StackToSignature(self, aStack, aThreadName, aDebug = True):
+        return self.SignatureFromFrames(self.FrameSignatures(aStack), aThreadName, aDebug)
+
+    # Yields (index, signature) for each frame of aStack that StackToSignature
+    # looks at, bottom first. The frame signatures only depend on the frame
+    # and the limits, not on the ignore / floor / target rules, so they can be
+    # computed once and given to SignatureFromFrames of several Stacksigs.
+    #
+    # Frames are only converted as they're asked for, because
+    # SignatureFromFrames usually stops before the end of the stack.
+    def FrameSignatures(self, aStack):
+        for frame in sorted(aStack[:self.MAX_FRAMES_TO_SCAN], key=lambda s: s["frame"]):
+            signature, _ = self.StackFrameToString(
+                frame["module"] if "module" in frame else "",
+                None,
+                frame["function"] if "function" in frame else "",
+                None,
+                True,
+                False)
+            yield frame["frame"], signature
+
+    # Applies the rules to aFrameSignatures, an iterable of (index, signature)
+    # as from FrameSignatures, and returns (signature, debug) as
+    # StackToSignature does.
+    def SignatureFromFrames(self, aFrameSignatures, aThreadName, aDebug = True):
+        builder = SignatureBuilder(self, aThreadName, aDebug)
+        for idx, signature in aFrameSignatures:
+            if builder.AddFrameSignature(idx, signature):
+                break
+        return builder.Result()
+
+# Builds a signature from frames given one at a time, bottom first, for when
+# frames arrive in order (eg as they come back from symbolication). Once
+# AddFrame returns True the signature is final: the remaining frames can't
+# change it, so there's no need to fetch them. Result() is then exactly what
+# Stacksig.StackToSignature returns for the whole stack; called earlier, it's
+# the signature of the frames so far, as if the stack ended there.
+#
+# Stacksig.SignatureFromFrames runs on this too, so the two can't disagree.
+class SignatureBuilder(object):
+    # aUtils is the Stacksig whose rules and limits to use. aThreadName and
+    # aDebug are as for StackToSignature.
+    def __init__(self, aUtils, aThreadName, aDebug = True):
+        self.utils = aUtils
+        self.threadName = aThreadName
+        self.debug = [] if aDebug else None
+        self.done = False
+        self.numFrames = 0
+        self.lastIdx = None
+
+        # the state of the scan; see AddFrameSignature
+        self.lastFloorFrameIndex = -1
+        self.targetFrameIndex = -1
+        self.lastTargetFrameIndex = -1
+        self.filteredFrames = []
+
+    # Adds the next frame of the stack, a frame dict from symbolication. Frames
+    # must come in order of their "frame" index, and frames past
+    # MAX_FRAMES_TO_SCAN are ignored.
+    #
+    # Returns True once the signature is final.
+    def AddFrame(self, aFrame):
+        if self.done:
+            return True
+        if self.lastIdx is not None and aFrame["frame"] < self.lastIdx:
+            raise ValueError("Frame {} added after frame {}".format(aFrame["frame"], self.lastIdx))
+        signature, _ = self.utils.StackFrameToString(
+            aFrame["module"] if "module" in aFrame else "",
+            None,
+            aFrame["function"] if "function" in aFrame else "",
+            None,
+            True,
+            False)
+        return self.AddFrameSignature(aFrame["frame"], signature)
+
+    # AddFrame for a frame already converted by Stacksig.FrameSignatures.
+    def AddFrameSignature(self, aIdx, aSignature):
+        if self.done:
+            return True
+        self.lastIdx = aIdx
+        self.numFrames += 1
+        if self.numFrames >= self.utils.MAX_FRAMES_TO_SCAN:
+            self.done = True
+        utils = self.utils
+        debug = self.debug
+        filteredFrames = self.filteredFrames
+
+        # For each frame we do a few things at once:
         # - ignore dupes
         # - ignore explicitly ignored frames
         # - look for floor frames
         # - look for target frames
-        lastFloorFrameIndex = -1
-        targetFrameIndex = -1
-        lastTargetFrameIndex = -1
-        filteredFrames = []
-        for frame in frames:
-            # generate the signature
-            frameSource = frame["source"]
-            frame["signature"], _ = self.StackFrameToString(
-                frameSource["module"] if "module" in frameSource else "",
-                None,
-                frameSource["function"] if "function" in frameSource else "",
-                None,
-                True)
+        frame = {"idx": aIdx, "signature": aSignature}
 
-            # ignore list
-            if any(str in frame["signature"] for str in self.ignoreFrameSubstrings):
+        # ignore list
+        if any(str in frame["signature"] for str in utils.ignoreFrameSubstrings):
+            if debug is not None:
                 debug.append("ignoring {}".format(frame["signature"]))
-                continue
+            return self.done
 
-            # skip duplicates
-            if filteredFrames and frame["signature"] == filteredFrames[-1]["signature"]:
+        # skip duplicates
+        if filteredFrames and frame["signature"] == filteredFrames[-1]["signature"]:
+            if debug is not None:
                 debug.append("duplicate {}".format(frame["signature"]))
-                continue
+            return self.done
 
-            # save this frame; it's not ignored or skipped
-            filteredFrames.append(frame)
+        # save this frame; it's not ignored or skipped
+        filteredFrames.append(frame)
 
-            # Is this a floor frame?
-            if any(str in frame["signature"] for str in self.floorFrameSubstrings):
+        # Is this a floor frame?
+        if any(str in frame["signature"] for str in utils.floorFrameSubstrings):
+            if debug is not None:
                 debug.append("floor frame {}".format(frame["signature"]))
-                # keep track of the top-most floor frame index.
-                lastFloorFrameIndex = len(filteredFrames) - 1
+            # keep track of the top-most floor frame index.
+            self.lastFloorFrameIndex = len(filteredFrames) - 1
 
-            # Is it a target frame?
-            elif any(str in frame["signature"] for str in self.targetFrameSubstrings):
+        # Is it a target frame?
+        elif any(str in frame["signature"] for str in utils.targetFrameSubstrings):
+            if debug is not None:
                 debug.append("target frame {}".format(frame["signature"]))
-                lastTargetFrameIndex = len(filteredFrames) - 1 # it is; save the index.
-                if targetFrameIndex == -1:
-                    targetFrameIndex = lastTargetFrameIndex
-
-                # If we found a target frame before we found a floor frame, keep
-                # looking. We want to try and find frames "above" floor frames.
-                # But if we've found a floor frame already, then we don't need
-                # to look further in the stack.
-
-                if lastFloorFrameIndex != -1:
-                    # we have seen floor frames before. we know this is the signature we'll use.
-                    targetFrameIndex = lastTargetFrameIndex
-                    break
-
-        frames = filteredFrames
+            self.lastTargetFrameIndex = len(filteredFrames) - 1 # it is; save the index.
+            if self.targetFrameIndex == -1:
+                self.targetFrameIndex = self.lastTargetFrameIndex
+
+            # If we found a target frame before we found a floor frame, keep
+            # looking. We want to try and find frames "above" floor frames.
+            # But if we've found a floor frame already, then we don't need
+            # to look further in the stack.
+
+            if self.lastFloorFrameIndex != -1:
+                # we have seen floor frames before. we know this is the signature we'll use.
+                self.targetFrameIndex = self.lastTargetFrameIndex
+                self.done = True
+
+        return self.done
+
+    # Returns (signature, debug) as StackToSignature does, for the frames
+    # added so far.
+    def Result(self):
+        utils = self.utils
+        debug = list(self.debug) if self.debug is not None else []
+        frames = self.filteredFrames
+        lastFloorFrameIndex = self.lastFloorFrameIndex
+        targetFrameIndex = self.targetFrameIndex
 
         sigTokens = [] # tokens that will be joined to create the final signature
 
@@ -444,7 +709,7 @@ class Stacksig(object):
             i = lastFloorFrameIndex + 1
             if i >= len(frames): # clamp to bounds
                 i = len(frames) - 1
-            elif i < (len(frames) - 1) and frames[i]["signature"] == self.UNKNOWN_MODULE:
+            elif i < (len(frames) - 1) and frames[i]["signature"] == utils.UNKNOWN_MODULE:
                 # if there's another element available, and the one we're
                 # pointing at is "<unknown>", then skip it because that's not
                 # very useful.
@@ -452,20 +717,21 @@ class Stacksig(object):
             sigTokens.append(frames[i]["signature"])
 
         # prepend the thread name
-        if aThreadName:
-            sigTokens = ["<#{}>".format(aThreadName.upper())] + sigTokens #   <#WINSOCK THREAD> | 
+        if self.threadName:
+            sigTokens = ["<#{}>".format(self.threadName.upper())] + sigTokens #   <#WINSOCK THREAD> | 
 
         if not sigTokens:
             return "<no useful stack frames>", debug # we filtered everything out
 
         # Join and limit length to self.maxSignatureLength.
-        joined = self.SIG_TOKEN_DELIMITER.join(sigTokens)
+        joined = utils.SIG_TOKEN_DELIMITER.join(sigTokens)
 
-        debug.append("> frame dump:")
-        debug.append("> -----------------------------------------")
-        for frame in frames:
-            debug.append("> id:{:3d} {}".format(
-                frame["idx"],
-                frame["signature"]))
+        if self.debug is not None:
+            debug.append("> frame dump:")
+            debug.append("> -----------------------------------------")
+            for frame in frames:
+                debug.append("> id:{:3d} {}".format(
+                    frame["idx"],
+                    frame["signature"]))
 
-        return joined[:self.MAX_SIGNATURE_LEN], debug
+        return joined[:utils.MAX_SIGNATURE_LEN], debug
@@ -0,0 +1,210 @@
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import Pingdata
+import Sigpartial
+import Stacksig
+import TestData_Corpus
+
+# Benchmarks for the signature generator. Run directly:
+#     python StacksigBench.py            run all benchmarks
+#     python StacksigBench.py <name>     run one, eg "adversarial"
+#
+# Functions defined here:
+#     AdversarialSymbols    pathological function symbols
+#     FuzzSymbols           random symbols built from C++-ish tokens
+#     TimeFrame             seconds to signaturize and pretty-print one frame
+#     BenchAdversarial      the slowest single frame over adversarial input
+#     BenchBatch            serial vs thread pool vs process pool over a corpus
+#     BenchPrefilter        reading a dump with and without the pre-filter
+#     ChainedPrettyFunction Stacksig.PrettyFunction as the re.sub chain it replaced
+#     TemplatedSymbols      long, heavily templated C++ symbols
+#     BenchPretty           PrettyFunction vs the re.sub chain
+
+# No single frame may take longer than this, whatever its symbol looks like.
+FRAME_TIME_BUDGET = 0.05
+
+# Yields (description, symbol) pairs built to hit the worst case of each step
+# of IsolateFunctionName and the pretty printer. aLength is the rough length of
+# each symbol.
+def AdversarialSymbols(aLength):
+    n = aLength
+    yield "unclosed backticks", "`" * n
+    yield "unclosed brackets", "[" * n
+    yield "operator and newline", "operator\n" * (n // 9)
+    yield "operator no parens", "operator " * (n // 9)
+    yield "space run", "a" + " " * n + "b"
+    yield "space run then const", "a" + " " * n + "const x"
+    yield "unsigned and spaces", ("unsigned" + " " * 64) * (n // 72)
+    yield "nested templates", "<" * n + "f()"
+    yield "nested parens", "(" * n + "f" + ")" * n
+    yield "long namespace", "ns::" * (n // 4) + "f(int)"
+    yield "qualifier soup", "const & " * (n // 8)
+
+FUZZ_TOKENS = [
+    "operator", " ", "  ", "(", ")", "()", "<", ">", "`", "'", "[", "]", "*", "&",
+    "&&", "\n", "::", ",", "const", "static", "void", "unsigned", "__int64", "x",
+]
+
+# Yields aCount random symbols of up to aMaxTokens tokens.
+def FuzzSymbols(aCount, aMaxTokens, aSeed = 1):
+    rng = random.Random(aSeed)
+    for i in range(aCount):
+        yield "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randrange(aMaxTokens)))
+
+# Returns the time it takes to turn a one-frame stack with function aSymbol into
+# a signature, plus pretty-printing the frame, which is what the REPL does.
+def TimeFrame(aUtils, aSymbol):
+    start = time.perf_counter()
+    aUtils.StackToSignature([{"frame": 0, "module": "mod", "function": aSymbol}], None)
+    aUtils.StackFrameToString("mod", "0x1", aSymbol, "0x2")
+    return time.perf_counter() - start
+
+# Times every adversarial symbol at each length in aLengths, plus aFuzzCount
+# fuzzed symbols, and prints the slowest.
+#
+# Returns the slowest time seen for a single frame.
+def BenchAdversarial(aLengths = (1000, 10000, 100000, 1000000), aFuzzCount = 2000, aVerbose = True):
+    utils = Stacksig.Stacksig()
+    worst = 0
+    for length in aLengths:
+        for desc, symbol in AdversarialSymbols(length):
+            elapsed = TimeFrame(utils, symbol)
+            worst = max(worst, elapsed)
+            if aVerbose:
+                print("  {:>8d} chars  {:8.2f} ms  {}".format(len(symbol), elapsed * 1000, desc))
+
+    fuzzWorst = 0
+    for symbol in FuzzSymbols(aFuzzCount, 2000):
+        fuzzWorst = max(fuzzWorst, TimeFrame(utils, symbol))
+    worst = max(worst, fuzzWorst)
+    if aVerbose:
+        print("  {:>8d} fuzzed   {:8.2f} ms  slowest".format(aFuzzCount, fuzzWorst * 1000))
+        print("slowest frame {:.2f} ms, budget {:.2f} ms: {}".format(
+            worst * 1000, FRAME_TIME_BUDGET * 1000, "PASS" if worst <= FRAME_TIME_BUDGET else "FAIL"))
+    return worst
+
+# Times Sigpartial's serial, thread pool and process pool paths over the ping
+# dump at aPath, with aWorkers workers each. Without aPath, a corpus of
+# aNumStacks stacks is generated from the test data.
+#
+# Returns a dict of path name -> seconds.
+def BenchBatch(aPath = None, aWorkers = 4, aNumStacks = 20000, aVerbose = True):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not aPath:
+            aPath = os.path.join(tmp, "dump.json")
+            TestData_Corpus.WritePingDump(aPath, TestData_Corpus.MakeCorpus(Stacksig.Stacksig(), aNumStacks))
+
+        runs = [
+            ("serial", lambda: Sigpartial.AggregateShards([aPath], 1, aWorkers)),
+            ("threads", lambda: Sigpartial.AggregateShardsThreaded([aPath], aWorkers)),
+            ("processes", lambda: Sigpartial.AggregateShards([aPath], aWorkers)),
+        ]
+        ret = {}
+        baseline = None
+        for name, run in runs:
+            start = time.perf_counter()
+            partial = run()
+            ret[name] = time.perf_counter() - start
+            if baseline is None:
+                baseline = partial
+            elif list(partial.entries.items()) != list(baseline.entries.items()):
+                raise AssertionError("{} disagrees with serial".format(name))
+            if aVerbose:
+                print("  {:10s} {:8.2f} s  {:6.2f}x  ({} stacks)".format(
+                    name, ret[name], ret["serial"] / ret[name], partial.stats["stacks"]))
+
+    if aVerbose:
+        gil = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+        print("{} workers, GIL {}".format(aWorkers, "enabled" if gil else "disabled"))
+    return ret
+
+# Times Pingdata.ReadResults over a generated dump of aNumPings pings where
+# only one in aEligibleEvery is eligible, with and without the pre-filter.
+#
+# Returns a dict of "prefilter" / "full" -> seconds.
+def BenchPrefilter(aNumPings = 50000, aEligibleEvery = 4, aVerbose = True):
+    ret = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WriteMixedPingDump(path, TestData_Corpus.MakeCorpus(Stacksig.Stacksig(), aNumPings), aEligibleEvery)
+        for name, prefilter in [("full", False), ("prefilter", True)]:
+            stats = {"pings": 0, "results": 0}
+            start = time.perf_counter()
+            for _ in Pingdata.ReadResults(path, stats, 0, None, prefilter):
+                pass
+            ret[name] = time.perf_counter() - start
+            if aVerbose:
+                print("  {:10s} {:8.3f} s  {:6.2f}x  ({} of {} pings not decoded)".format(
+                    name, ret[name], ret["full"] / ret[name], stats.get("prefiltered", 0), stats["pings"]))
+    return ret
+
+# The pretty-printing StackFrameToString originally did, one re.sub per
+# rewrite, copied as it was (so quadratic on long runs of spaces). Kept as the
+# reference Stacksig.PrettyFunction has to match and the baseline it's timed
+# against.
+def ChainedPrettyFunction(aFunction):
+    leadingQualifiers = r"^(\s|\bstatic\b|\bvoid\b)+"
+    trailingQualifiers = r"(\s|\bconst\b|&)+$"
+    function = re.sub("({})|({})".format(leadingQualifiers, trailingQualifiers), "", aFunction)
+    function = re.sub(r"(unsigned\s+_*)(?=char|long|short|int|int64|int32|int16|int8)", "u", function)
+    function = re.sub(r"\s+\*", "*", function)
+    function = re.sub(r",\s*", ", ", function)
+    return re.sub(r"\s+", " ", function)
+
+TEMPLATE_ARGS = [
+    "unsigned int", "unsigned __int64", "char const *", "wchar_t * *", "int",
+    "std::allocator<char>", "mozilla::Maybe<unsigned char>", "void *", "bool",
+]
+
+# Yields aCount symbols like MSVC writes for deeply templated code, each
+# about aLength characters long.
+def TemplatedSymbols(aCount, aLength, aSeed = 1):
+    rng = random.Random(aSeed)
+    for i in range(aCount):
+        parts = ["static void "]
+        size = 0
+        while size < aLength:
+            part = "ns{}::Tmpl<{} ,{},  ".format(rng.randrange(100), rng.choice(TEMPLATE_ARGS), rng.choice(TEMPLATE_ARGS))
+            parts.append(part)
+            size += len(part)
+        parts.append("int>::Method(unsigned short,char * const &) const &")
+        yield "".join(parts)
+
+# Times Stacksig.PrettyFunction against ChainedPrettyFunction over aCount
+# templated symbols of each length in aLengths, checking they agree.
+#
+# Returns a dict of length -> (chained seconds, single pass seconds).
+def BenchPretty(aLengths = (100, 1000, 4000), aCount = 2000, aVerbose = True):
+    ret = {}
+    for length in aLengths:
+        symbols = list(TemplatedSymbols(aCount, length))
+        times = []
+        results = []
+        for pretty in [ChainedPrettyFunction, Stacksig.PrettyFunction]:
+            start = time.perf_counter()
+            results.append([pretty(symbol) for symbol in symbols])
+            times.append(time.perf_counter() - start)
+        if results[0] != results[1]:
+            raise AssertionError("PrettyFunction disagrees with the re.sub chain")
+        ret[length] = tuple(times)
+        if aVerbose:
+            print("  {:>6d} chars  chained {:8.2f} ms  single pass {:8.2f} ms  {:6.2f}x".format(
+                length, times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+    return ret
+
+BENCHMARKS = {
+    "adversarial": BenchAdversarial,
+    "batch": BenchBatch,
+    "prefilter": BenchPrefilter,
+    "pretty": BenchPretty,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print("\n== {}".format(name))
+        BENCHMARKS[name]()
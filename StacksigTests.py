@@ -1,6 +1,29 @@
 from importlib import reload
+import asyncio
+import concurrent.futures
+import gzip
+import io
+import json
+import numpy as np
+import os
+import Pager
+import Sigdiff
+import Sigindex
+import Sigmem
+import Sigpartial
+import Sigsample
+import Sigserver
+import Sigsnapshot
+import Sigstream
+import Sigsynth
+import Sigtime
 import Stacksig
+import StacksigBench
+import random
 import re
+import tempfile
+import tracemalloc
+import TestData_Corpus
 import TestData_FrameToString
 import TestData_Signatures
 
@@ -65,7 +88,821 @@ def Runtests():
                 print("                 : {}".format(s))
         testsRun += 1
 
+    for section in [RunPrettyTests, RunAggregationTests, RunPartialTests, RunCompressedTests, RunPrefilterTests, RunCheckpointTests, RunStreamTests, RunSynthTests, RunRuleDiffTests, RunTimeTests, RunSampleTests, RunMemoryTests, RunBuilderTests, RunServerTests, RunSnapshotTests, RunPagerTests, RunAdversarialTests]:
+        run, passed = section(utils)
+        testsRun += run
+        testsPassed += passed
+
     print("")
     print("TOTAL: {} of {} tests passed ({}%)".format(testsPassed, testsRun, 100.0 * testsPassed / testsRun))
     print("  -> PASS" if testsRun == testsPassed else "  -> FAIL")
 
+
+# Prints a PASS/FAIL line in the same format as the data-driven tests and
+# returns 1 if it passed.
+def Check(aDesc, aActual, aExpected):
+    print(aDesc)
+    if aActual == aExpected:
+        print("   PASS - expected: {}".format(str(aExpected)[:60]))
+        return 1
+    print(" ! FAIL - expected: {}".format(aExpected))
+    print("            actual: {}".format(aActual))
+    return 0
+
+PRETTY_TOKENS = [
+    "unsigned", " ", "  ", "\t", "\n", "_", "__", "int", "char", "short", "*", ",",
+    "&", "const", "xconst", "static", "void", "x", "\u00e9", "::", "<", ">", "(", ")",
+]
+
+def RunPrettyTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("PRETTY PRINT TESTS\n")
+
+    rng = random.Random(5)
+    fuzzed = ["".join(rng.choice(PRETTY_TOKENS) for _ in range(rng.randrange(14))) for _ in range(20000)]
+    mismatches = [s for s in fuzzed if Stacksig.PrettyFunction(s) != StacksigBench.ChainedPrettyFunction(s)]
+    testsPassed += Check("pretty: matches the re.sub chain on fuzzed symbols", mismatches[:3], [])
+
+    templated = list(StacksigBench.TemplatedSymbols(50, 2000))
+    testsPassed += Check("pretty: matches the re.sub chain on templated symbols",
+        [Stacksig.PrettyFunction(s) for s in templated], [StacksigBench.ChainedPrettyFunction(s) for s in templated])
+
+    testsPassed += Check("pretty: all the rewrites at once",
+        Stacksig.PrettyFunction(" static void f<unsigned  __int16 ,char * *>(int,  short)  const &"),
+        "f<uint16 , char**>(int, short)")
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunAggregationTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("AGGREGATION TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 2000)
+    testsPassed += Check("signature: same result without debug, and no debug",
+        [utils.StackToSignature(s["frames"], s["threadName"], False) for s in stacks],
+        [(s["signature"], []) for s in stacks])
+    testsRun += 1
+
+    # the original dict / set aggregation, as a reference
+    t = {}
+    for stack in stacks:
+        t["{}|{}".format(stack["clientID"], stack["signature"])] = stack
+    expected = {}
+    for stack in t.values():
+        sig = expected.setdefault(stack["signature"], {"count": 0, "modules": set()})
+        sig["count"] += 1
+        sig["modules"] |= set(stack["modules"])
+
+    index = Sigindex.SigIndex(stacks)
+    actual = {}
+    for sigId, signature in enumerate(index.signatures):
+        actual[signature] = {
+            "count": int(index.counts[sigId]),
+            "modules": set(index.SignatureModules(sigId)),
+        }
+
+    testsPassed += Check("index: dedup keeps last stack in first-seen order", index.stacks, list(t.values()))
+    testsPassed += Check("index: counts and module sets", actual, expected)
+    testsPassed += Check("index: IDs by descending count",
+        index.counts.tolist(), sorted(index.counts.tolist(), reverse=True))
+    testsPassed += Check("index: module prevalence",
+        dict((index.modules[m], int(c)) for m, c in zip(*index.ModulePrevalence())),
+        dict((m, sum(1 for s in expected.values() if m in s["modules"])) for m in index.modules))
+    testsPassed += Check("index: filter signatures",
+        sorted(index.signatures[i] for i in index.FilterSignatures("SHELL32")),
+        sorted(s for s in expected if "shell32" in s.lower()))
+    testsPassed += Check("index: signatures with module",
+        sorted(index.signatures[i] for i in index.SignaturesWithModule("evil")),
+        sorted(s for s in expected if any("evil" in m for m in expected[s]["modules"])))
+    testsPassed += Check("index: signatures with all modules",
+        sorted(index.signatures[i] for i in index.SignaturesWithAllModules(["evil", "a.dll"])),
+        sorted(s for s in expected if "evil.dll" in expected[s]["modules"] and "a.dll" in expected[s]["modules"]))
+    testsPassed += Check("index: bitset round trip",
+        Sigindex.BitsToIds(Sigindex.IdsToBits(np.array([0, 5, 64, 65, 200]))).tolist(), [0, 5, 64, 65, 200])
+    testsPassed += Check("index: posting lists",
+        [index.StacksForSignature(i).tolist() for i in range(len(index.signatures))],
+        [[j for j, s in enumerate(index.stacks) if s["signature"] == sig] for sig in index.signatures])
+    testsPassed += Check("index: stack ordinals",
+        [index.StacksForSignature(index.stackSig[i])[index.stackOrdinal[i]] for i in range(len(index.stacks))],
+        list(range(len(index.stacks))))
+    testsPassed += Check("index: frame search",
+        list(index.StacksMatchingFrames("SHELL32!blah")),
+        [i for i, s in enumerate(index.stacks)
+            if any("shell32!blah" in utils.FrameDictToString(f)[0].lower() for f in s["frames"])])
+    testsRun += 11
+
+    # strings from pings can hold anything, trailing NULs included
+    odd = Sigindex.SigIndex([{"signature": sig, "clientID": "c", "modules": [mod]}
+        for sig, mod in [("b\x00", "m\x00"), ("x" * 4096, "n"), ("b", "m")]])
+    testsPassed += Check("index: odd strings filter and sort like Python's",
+        (sorted(odd.signatures[i] for i in odd.FilterSignatures("\x00")),
+         [odd.modules[i] for i in Sigindex.BitsToIds(odd.ModuleBits("\x00"))],
+         [odd.signatures[i] for i in odd.SortedOrder("alpha")]),
+        (["b\x00"], ["m\x00"], sorted(odd.signatures)))
+    testsRun += 1
+
+    coLoaded = {}
+    stackCounts = {}
+    for stack in index.stacks:
+        mods = set(stack["modules"])
+        for a in mods:
+            stackCounts[a] = stackCounts.get(a, 0) + 1
+            for b in mods - {a}:
+                coLoaded[(a, b)] = coLoaded.get((a, b), 0) + 1
+    rows = [index.CoLoadedModules(i) for i in range(len(index.modules))]
+    testsPassed += Check("index: module co-occurrence",
+        dict(((index.modules[i], index.modules[m]), int(c)) for i, row in enumerate(rows) for m, c in zip(*row)), coLoaded)
+    testsPassed += Check("index: co-loaded modules most often first",
+        [row[1].tolist() == sorted(row[1].tolist(), reverse=True) for row in rows], [True] * len(rows))
+    testsPassed += Check("index: stacks per module",
+        dict(zip(index.modules, index.moduleStacks.tolist())), stackCounts)
+    blockPairs = Sigindex.CO_BLOCK_PAIRS
+    Sigindex.CO_BLOCK_PAIRS = 5
+    blocked = Sigindex.SigIndex(stacks)
+    Sigindex.CO_BLOCK_PAIRS = blockPairs
+    testsPassed += Check("index: co-occurrence counted in small blocks",
+        (blocked.coModules.tolist(), blocked.coCounts.tolist(), blocked.coOffsets.tolist()),
+        (index.coModules.tolist(), index.coCounts.tolist(), index.coOffsets.tolist()))
+    testsRun += 4
+
+    testsPassed += Check("hash: stable across runs and machines",
+        Stacksig.FormatSignatureHash(Stacksig.SignatureHash("xul!someFn")), "4a8e6845b97cf637")
+    testsPassed += Check("hash: every signature found by its hash",
+        [index.SignatureForHash(Stacksig.SignatureHash(s)) for s in index.signatures], list(range(len(index.signatures))))
+    testsPassed += Check("hash: unknown hashes",
+        [index.SignatureForHash(h) for h in [Stacksig.SignatureHash("not a signature"), -1, 2 ** 64]], [None] * 3)
+    reversedIndex = Sigindex.SigIndex(stacks[::-1])
+    testsPassed += Check("hash: same signature, same hash, in another index",
+        [int(reversedIndex.signatureHashes[reversedIndex.signatures.index(s)]) for s in index.signatures],
+        index.signatureHashes.tolist())
+    testsRun += 4
+
+    index.SortSignatures("alpha")
+    testsPassed += Check("index: alphabetical sort",
+        [index.signatures[i] for i in index.order], sorted(expected))
+    testsRun += 1
+
+    return testsRun, testsPassed
+
+def RunPartialTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("PARTIAL AGGREGATE TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 600, 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WritePingDump(dump, stacks)
+        whole = Sigpartial.AggregateShards([dump], 1, 1)
+        sharded = Sigpartial.AggregateShards([dump], 1, 7)
+        threaded = Sigpartial.AggregateShardsThreaded([dump], 4, 7)
+
+        # reduce the shards in a different grouping: (p0 p1) (p2 (p3 p4))
+        ranges = [(dump, a, b) for a, b in Sigpartial.Pingdata.ShardRanges(dump, 5)]
+        p = [Sigpartial.PartialAggregate.FromJson(Sigpartial.AggregateRange(r)) for r in ranges]
+        regrouped = p[0].Merge(p[1]).Merge(p[2].Merge(p[3].Merge(p[4])))
+
+        path = os.path.join(tmp, "partial.json")
+        sharded.Save(path)
+        loaded = Sigpartial.PartialAggregate.Load(path)
+
+    testsPassed += Check("partial: every ping read once", sharded.stats, whole.stats)
+    testsPassed += Check("partial: shards merge to the single pass",
+        list(sharded.entries.items()), list(whole.entries.items()))
+    testsPassed += Check("partial: merge is associative",
+        list(regrouped.entries.items()), list(whole.entries.items()))
+    testsPassed += Check("partial: thread pool matches the single pass",
+        list(threaded.entries.items()), list(whole.entries.items()))
+    testsPassed += Check("partial: save and load", list(loaded.entries.items()), list(sharded.entries.items()))
+    testsPassed += Check("partial: counts match the index",
+        whole.Counts(), dict(zip(whole.ToIndex().signatures, whole.ToIndex().counts.tolist())))
+    testsRun += 6
+
+    # one Stacksig hammered by several threads at once
+    def signaturize(aStacks):
+        return [utils.StackToSignature(s["frames"], s["threadName"])[0] for s in aStacks]
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        shared = list(pool.map(lambda i: signaturize(stacks[i::8]), range(8)))
+    testsPassed += Check("partial: Stacksig shared between threads",
+        shared, [signaturize(stacks[i::8]) for i in range(8)])
+    testsRun += 1
+
+    data = b"a\n\nbb\r\n\r\nccc"
+    testsPassed += Check("pingdata: scan lines",
+        [data[a:b] for a, b in Sigpartial.Pingdata.ScanLines(data)], [b"a", b"bb\r", b"ccc"])
+    testsPassed += Check("pingdata: scan lines from the middle of a line",
+        [data[a:b] for a, b in Sigpartial.Pingdata.ScanLines(data, 4, 10)], [b"ccc"])
+    testsPassed += Check("pingdata: invalid utf-8 is replaced",
+        Sigpartial.Pingdata.ParsePing(b'{"client_id":"ab\xffc"}'), {"client_id": "ab\ufffdc"})
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunCompressedTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("COMPRESSED DUMP TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 100, 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WritePingDump(dump, stacks)
+        with open(dump, "rb") as f:
+            raw = f.read()
+        plain = list(Sigpartial.Pingdata.ReadResults(dump, {"pings": 0, "results": 0}))
+        for ext, opener in sorted(Sigpartial.Pingdata.COMPRESSED_OPENERS.items()):
+            path = dump + ext
+            with opener(path, "wb") as f:
+                f.write(raw)
+            testsPassed += Check("pingdata: reads {} dumps".format(ext),
+                list(Sigpartial.Pingdata.ReadResults(path, {"pings": 0, "results": 0})), plain)
+            testsRun += 1
+        testsPassed += Check("partial: a compressed dump is one shard",
+            list(Sigpartial.AggregateShards([path], 1, 3).entries.items()),
+            list(Sigpartial.AggregateShards([dump], 1, 3).entries.items()))
+        testsRun += 1
+
+    return testsRun, testsPassed
+
+def RunPrefilterTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("PRE-FILTER TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 200, 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WriteMixedPingDump(dump, stacks, 3)
+        with open(dump, "ab") as f:
+            # escaped key names are left to the real parse
+            f.write(b'{"\\u0063lient_id":"x","environment":{"system":{"is_wow64":false}},"symbolicated_stacks":"{}"}\n')
+        filteredStats = {"pings": 0, "results": 0}
+        filtered = list(Sigpartial.Pingdata.ReadResults(dump, filteredStats))
+        fullStats = {"pings": 0, "results": 0}
+        full = list(Sigpartial.Pingdata.ReadResults(dump, fullStats, 0, None, False))
+    prefiltered = filteredStats.pop("prefiltered")
+    testsPassed += Check("pingdata: pre-filter gives the same results", filtered, full)
+    testsPassed += Check("pingdata: pre-filter gives the same counters", filteredStats, fullStats)
+    testsPassed += Check("pingdata: pre-filter skips decoding", prefiltered,
+        sum(n for key, n in fullStats.items() if key.startswith("dropped")) - 1)
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunCheckpointTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("CHECKPOINT TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 600, 2)
+
+    # interrupted at the second checkpoint, then resumed
+    class Interrupted(Exception):
+        pass
+    def interruptAt(aNumSegments):
+        def onCheckpoint(aManifest):
+            if len(aManifest["segments"]) == aNumSegments:
+                raise Interrupted()
+        return onCheckpoint
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WriteMixedPingDump(dump, stacks, 3)
+        with open(dump, "rb") as f:
+            raw = f.read()
+        with gzip.open(dump + ".gz", "wb") as f:
+            f.write(raw)
+        whole = Sigpartial.AggregateShards([dump], 1, 1)
+        checkpoint = os.path.join(tmp, "run.ckpt")
+        resumed = []
+        for path, pieceBytes, pieceLines in [(dump, len(raw) // 5, None), (dump + ".gz", None, 90)]:
+            try:
+                Sigpartial.AggregateCheckpointed(path, checkpoint, False, pieceBytes, pieceLines, interruptAt(2))
+            except Interrupted:
+                pass
+            resumed.append(Sigpartial.AggregateCheckpointed(path, checkpoint, True, pieceBytes, pieceLines))
+        with open(checkpoint, "r") as f:
+            manifest = json.load(f)
+        with open(dump, "ab") as f:
+            f.write(raw[:raw.index(b"\n") + 1])
+        try:
+            Sigpartial.AggregateCheckpointed(dump, checkpoint, True, len(raw) // 5)
+            changed = None
+        except ValueError as e:
+            changed = str(e)
+    testsPassed += Check("checkpoint: resumed run matches an uninterrupted one",
+        [(list(r.entries.items()), r.stats) for r in resumed], [(list(whole.entries.items()), whole.stats)] * 2)
+    testsPassed += Check("checkpoint: compressed dump counted in lines", manifest["position"], raw.count(b"\n"))
+    testsPassed += Check("checkpoint: won't resume over a changed dump", changed is not None and "changed" in changed, True)
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunStreamTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("STREAMING CLI TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 200, 3)
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WritePingDump(dump, stacks)
+        expected = []
+        for filtered in Sigpartial.Pingdata.ReadResults(dump, {"pings": 0, "results": 0}):
+            for stack in filtered:
+                signature = utils.StackToSignature(stack["frames"], stack["threadName"])[0]
+                expected.append({
+                    "signature": signature,
+                    "signatureHash": Stacksig.FormatSignatureHash(Stacksig.SignatureHash(signature)),
+                    "threadName": stack["threadName"],
+                    "clientID": stack["clientID"],
+                    "modules": stack["modules"]})
+
+        records = os.path.join(tmp, "records.json")
+        with open(records, "w") as f:
+            for stack in stacks[:5]:
+                f.write(json.dumps({"frames": stack["frames"]}) + "\n\n")
+
+        out = io.StringIO()
+        stats = Sigstream.Run([dump, records], out)
+
+        # more results than events, and a null event: only the first result
+        # has an event to go with it
+        short = os.path.join(tmp, "short.json")
+        with open(dump, "r") as f:
+            ping = json.loads(f.readline())
+        results = json.loads(ping["symbolicated_stacks"])["results"]
+        ping["symbolicated_stacks"] = json.dumps({"results": results * 3})
+        ping["payload"]["events"].append(None)
+        with open(short, "w") as f:
+            f.write(json.dumps(ping) + "\n")
+        shortOut = io.StringIO()
+        shortStats = Sigstream.Run([short], shortOut)
+
+    lines = [json.loads(l) for l in out.getvalue().splitlines()]
+    testsPassed += Check("stream: pings match the batch path", lines[:len(expected)], expected)
+    testsPassed += Check("stream: stack records",
+        [l["signature"] for l in lines[len(expected):]],
+        [utils.StackToSignature(s["frames"], None)[0] for s in stacks[:5]])
+    testsPassed += Check("stream: stats",
+        (stats["lines"], stats["pings"], stats["stacks"]), (205, 200, len(expected) + 5))
+    testsPassed += Check("stream: results without an event are counted, not printed",
+        ([json.loads(l) for l in shortOut.getvalue().splitlines()], shortStats["results"],
+            shortStats["dropped " + Sigpartial.Pingdata.DROP_NO_EVENT]),
+        (lines[:1], 3, 2))
+    testsRun += 4
+
+    return testsRun, testsPassed
+
+def RunSynthTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("SYNTHETIC DUMP TESTS\n")
+
+    options = (None, 200, 500)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, name) for name in ["a.json", "b.json", "c.json", "a.json.gz"]]
+        written = [Sigsynth.WriteDump(path, 400, seed, 1, options) for path, seed in zip(paths, [1, 1, 2, 1])]
+        contents = []
+        for path in paths[:3]:
+            with open(path, "rb") as f:
+                contents.append(f.read())
+        testsPassed += Check("synth: same seed, same dump; other seed, other dump",
+            (contents[0] == contents[1], contents[0] == contents[2]), (True, False))
+
+        read = []
+        for path in [paths[0], paths[3]]:
+            stats = {"pings": 0, "results": 0}
+            stacks = [stack for filtered in Sigpartial.Pingdata.ReadResults(path, stats) for stack in filtered]
+            read.append((stats, stacks))
+        stats, stacks = read[0]
+        testsPassed += Check("synth: stack count as reported",
+            (stats["pings"], len(stacks)), (written[0]["pings"], written[0]["stacks"]))
+        testsPassed += Check("synth: wow64 and malformed pings dropped",
+            [stats.get("dropped " + reason, 0) > 0 for reason in
+                [Sigpartial.Pingdata.DROP_WOW64, Sigpartial.Pingdata.DROP_NO_STACKS, Sigpartial.Pingdata.DROP_NO_RESULTS]],
+            [True, True, True])
+        testsPassed += Check("synth: compressed dump reads the same", read[1][1], stacks)
+
+    # Chunks must not depend on what other chunks were made first in the same
+    # process, or the dump would depend on how chunks are spread over workers.
+    numPings = Sigsynth.CHUNK_PINGS + 50
+    fresh = list(Sigsynth.PingGenerator(3, numPings, *options).Chunk(1))
+    used = Sigsynth.PingGenerator(3, numPings, *options)
+    for _ in zip(range(300), used.Chunk(0)):
+        pass
+    testsPassed += Check("synth: chunks are independent", list(used.Chunk(1)), fresh)
+    testsRun += 5
+
+    return testsRun, testsPassed
+
+def RunRuleDiffTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("RULE DIFF TESTS\n")
+
+    stacks = TestData_Corpus.MakeCorpus(utils, 500, 4)
+    other = Stacksig.Stacksig()
+    other.targetFrameSubstrings = other.targetFrameSubstrings + ("shell32!",)
+
+    same = Sigdiff.RuleDiff(utils, Stacksig.Stacksig())
+    diff = Sigdiff.RuleDiff(utils, other, 2)
+    for stack in stacks:
+        same.AddStack(stack)
+        diff.AddStack(stack)
+
+    expected = {}
+    for stack in stacks:
+        key = (utils.StackToSignature(stack["frames"], stack["threadName"])[0],
+               other.StackToSignature(stack["frames"], stack["threadName"])[0])
+        expected[key] = expected.get(key, 0) + 1
+    testsPassed += Check("rule diff: same rules move nothing", same.Moved(), [])
+    testsPassed += Check("rule diff: matches two full runs", diff.transitions, expected)
+    splits = {}
+    for (a, b), n in expected.items():
+        splits.setdefault(a, {})[b] = n
+    testsPassed += Check("rule diff: splits",
+        diff.Splits(), {a: bs for a, bs in splits.items() if len(bs) > 1})
+    testsPassed += Check("rule diff: client counts add up",
+        sum(b - a for _, a, b in diff.CountChanges()), len(diff.clientsB) - len(diff.clientsA))
+    testsRun += 4
+
+    # A floor frame under a target frame settles the signature, so neither a
+    # single run nor the diff should normalize the rest of a long stack.
+    counted = Stacksig.Stacksig()
+    calls = []
+    isolate = counted.IsolateFunctionName
+    counted.IsolateFunctionName = lambda *args: calls.append(1) or isolate(*args)
+    longStack = {"frames": [{"frame": 0, "module": "kernelbase", "function": "LoadLibraryExW(int)"}] +
+        [{"frame": i, "module": "xul", "function": "f{}(int)".format(i)} for i in range(1, 60)]}
+    counted.StackToSignature(longStack["frames"], None, False)
+    single = len(calls)
+    del calls[:]
+    Sigdiff.RuleDiff(counted, other).AddStack(longStack)
+    testsPassed += Check("rule diff: frames normalized once, only as far as needed",
+        (len(calls), single < 5), (single, True))
+    testsRun += 1
+
+    return testsRun, testsPassed
+
+def RunTimeTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("TIME BUCKET TESTS\n")
+
+    hour = Sigtime.HOUR
+    buckets = Sigtime.TimeBuckets(hour, 4)
+    buckets.Add(0, "c1", ["a"])
+    buckets.Add(10, "c1", ["a"])
+    buckets.Add(20, "c2", ["a", "b"])
+    buckets.Add(hour, "c1", ["a"])
+    testsPassed += Check("time: clients counted once per bucket", buckets.Series("a"), [(0, 2), (hour, 1)])
+    buckets.Add(4 * hour, "c3", ["b"])
+    buckets.Add(0, "c4", ["a"])
+    testsPassed += Check("time: old buckets are reused",
+        (buckets.Series("a"), buckets.Counts(), buckets.dropped),
+        ([(hour, 1), (2 * hour, 0), (3 * hour, 0), (4 * hour, 0)], {"a": 1, "b": 1}, 1))
+    testsRun += 2
+
+    buckets = Sigtime.TimeBuckets(hour, 24)
+    for h in range(8):
+        for c in range(2):
+            buckets.Add(h * hour, "steady{}".format(c), ["steady", "spiky"])
+    for c in range(10):
+        buckets.Add(8 * hour, "c{}".format(c), ["spiky", "new"])
+        buckets.Add(8 * hour, "steady{}".format(c % 2), ["steady"])
+    testsPassed += Check("time: spikes", buckets.Spikes(1, 8, 3),
+        [("new", 10, 0, float("inf")), ("spiky", 10, 2.0, 5.0)])
+    testsRun += 1
+
+    testsPassed += Check("time: creation dates",
+        [Sigpartial.Pingdata.ParseTime(d) for d in ["1970-01-02T00:00:01.5Z", "garbage", None]],
+        [86401, None, None])
+    testsRun += 1
+
+    return testsRun, testsPassed
+
+def RunSampleTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("SAMPLING TESTS\n")
+
+    corpus = TestData_Corpus.MakeCorpus(utils, 1000, 6)
+    full = Sigindex.SigIndex(corpus)
+    sampled = Sigindex.SigIndex(corpus, 3)
+    testsPassed += Check("sample: counts and modules are exact",
+        (sampled.signatures, sampled.counts.tolist(), sampled.sigModules),
+        (full.signatures, full.counts.tolist(), full.sigModules))
+    testsPassed += Check("sample: stacks per signature",
+        [sampled.NumStacks(i) for i in range(len(sampled.signatures))],
+        [min(3, c) for c in full.counts.tolist()])
+    testsPassed += Check("sample: kept stacks belong to their signature",
+        all(sampled.stacks[i]["signature"] == sampled.signatures[sampled.stackSig[i]] for i in range(len(sampled.stacks))),
+        True)
+    testsRun += 3
+
+    # Sampled as the dump is read: counts stay exact, but only the sampled
+    # stacks are ever held. The peak is measured from here on, so the tests
+    # can run with tracemalloc already on (mem on in main.py).
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "dump.json")
+        TestData_Corpus.WritePingDump(dump, TestData_Corpus.MakeCorpus(utils, 3000, 11))
+        def ingest(aSampleSize):
+            tracing = tracemalloc.is_tracing()
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            partial = Sigpartial.PartialAggregate(aSampleSize)
+            for filtered in Sigpartial.Pingdata.ReadResults(dump, partial.stats):
+                for stack in filtered:
+                    stack["signature"], _ = utils.StackToSignature(stack["frames"], stack["threadName"], False)
+                    partial.AddStack(stack)
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            return partial.ToIndex(), peak - before
+        whole, wholePeak = ingest(None)
+        ingested, ingestedPeak = ingest(2)
+    testsPassed += Check("sample: sampled while reading, counts and modules are exact",
+        (ingested.signatures, ingested.counts.tolist(), ingested.sigModules, ingested.coCounts.tolist()),
+        (whole.signatures, whole.counts.tolist(), whole.sigModules, whole.coCounts.tolist()))
+    testsPassed += Check("sample: sampled while reading, stacks per signature",
+        ([ingested.NumStacks(i) for i in range(len(ingested.signatures))], ingested.numSampledOut),
+        ([min(2, c) for c in whole.counts.tolist()], len(whole.stacks) - len(ingested.stacks)))
+    testsPassed += Check("sample: sampled while reading, peak memory under half",
+        ingestedPeak * 2 < wholePeak, True)
+    testsRun += 3
+
+    budget = 60000
+    reservoir = Sigsample.Reservoir(10, budget)
+    for i, stack in enumerate(corpus):
+        reservoir.Add(stack["signature"], i, Sigsample.StackSize(stack))
+    testsPassed += Check("sample: within the memory budget",
+        (reservoir.bytes <= budget, 1 < reservoir.size < 10, sum(reservoir.seen.values())), (True, True, len(corpus)))
+
+    hits = [0] * 10
+    for seed in range(2000):
+        reservoir = Sigsample.Reservoir(1, None, seed)
+        for i in range(10):
+            reservoir.Add("k", i, 1)
+        hits[reservoir.Sample("k")[0]] += 1
+    testsPassed += Check("sample: uniform", all(150 < h < 250 for h in hits), True)
+    testsRun += 2
+
+    return testsRun, testsPassed
+
+def RunMemoryTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("MEMORY ACCOUNTING TESTS\n")
+
+    shared = ["x" * 1000]
+    sizes = dict(Sigmem.ComponentSizes([("a", [shared]), ("b", [[shared, shared]])]))
+    testsPassed += Check("mem: shared objects counted once",
+        (sizes["a"] > 1000, sizes["b"] < 200), (True, True))
+
+    index = Sigindex.SigIndex(TestData_Corpus.MakeCorpus(utils, 300, 7))
+    components = index.Components()
+    whole = Sigmem.DeepSize(index, set())
+    testsPassed += Check("mem: components cover the index",
+        0.95 * whole < sum(size for _, size in Sigmem.ComponentSizes(components)) <= whole, True)
+    testsRun += 2
+
+    return testsRun, testsPassed
+
+# Feeds aFrames to a SignatureBuilder in order until it's final. Returns
+# (result, number of frames fed).
+def BuildOnline(utils, aFrames, aThreadName):
+    builder = Stacksig.SignatureBuilder(utils, aThreadName)
+    fed = 0
+    for frame in sorted(aFrames[:utils.MAX_FRAMES_TO_SCAN], key=lambda f: f["frame"]):
+        fed += 1
+        if builder.AddFrame(frame):
+            break
+    return builder.Result(), fed
+
+def RunBuilderTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("ONLINE BUILDER TESTS\n")
+
+    corpus = TestData_Corpus.MakeCorpus(utils, 500, 8)
+    testsPassed += Check("builder: matches the batch result",
+        [BuildOnline(utils, s["frames"], s["threadName"])[0] for s in corpus],
+        [utils.StackToSignature(s["frames"], s["threadName"]) for s in corpus])
+
+    frames = [{"frame": i, "module": m, "function": f} for i, (m, f) in enumerate([
+        ("ntdll", "LdrLoadDll"),
+        ("kernelbase", "LoadLibraryExW"),
+        ("shell32", "Blah"),
+        ("xul", "CallsShell"),
+        ("xul", "Outer"),
+        ("firefox", "main"),
+    ])]
+    testsPassed += Check("builder: final at the first target above a floor",
+        BuildOnline(utils, frames, None),
+        (utils.StackToSignature(frames, None), 4))
+
+    builder = Stacksig.SignatureBuilder(utils, None)
+    builder.AddFrame(frames[1])
+    try:
+        builder.AddFrame(frames[0])
+        outOfOrder = None
+    except ValueError:
+        outOfOrder = "ValueError"
+    testsPassed += Check("builder: frames out of order", outOfOrder, "ValueError")
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunServerTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("QUERY SERVER TESTS\n")
+
+    index = Sigindex.SigIndex(TestData_Corpus.MakeCorpus(utils, 400, 9))
+    api = Sigserver.QueryApi(index)
+    paths = [
+        "/signatures?limit=5",
+        "/signatures?q=SHELL32&sort=alpha",
+        "/signature/0",
+        "/module-signatures?q=a.dll&q=b.dll",
+        "/modules?offset=1&limit=2",
+        "/frames?q=weird",
+        "/co-modules?q=evil&top=2",
+        "/signature-hash/4a8e6845b97cf637",
+        "/stack/0/1",
+        "/nothing",
+        "/signature/100000",
+        "/signatures?sort=sideways",
+    ]
+
+    async def scenario():
+        ready = asyncio.get_running_loop().create_future()
+        server = asyncio.ensure_future(Sigserver.Serve(api, "127.0.0.1", 0, ready.set_result))
+        port = await ready
+        try:
+            first = await asyncio.gather(*[Sigserver.Get("127.0.0.1", port, p) for p in paths])
+            again = await asyncio.gather(*[Sigserver.Get("127.0.0.1", port, p) for p in paths])
+        finally:
+            server.cancel()
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    results = dict(zip(paths, first))
+    ids = lambda path: [item["id"] for item in results[path][1]["items"]]
+    testsPassed += Check("server: signature list",
+        (results["/signatures?limit=5"][1]["total"], ids("/signatures?limit=5")), (len(index.signatures), [0, 1, 2, 3, 4]))
+    testsPassed += Check("server: filter and sort",
+        ids("/signatures?q=SHELL32&sort=alpha"),
+        index.SortedOrder("alpha", index.FilterSignatures("shell32", np.arange(len(index.signatures)))).tolist())
+    testsPassed += Check("server: sig", results["/signature/0"][1]["modules"], index.SignatureModules(0))
+    testsPassed += Check("server: module counts in lists",
+        [item["numModules"] for item in results["/signatures?limit=5"][1]["items"]] + [results["/signature/0"][1]["numModules"]],
+        index.moduleCounts[:5].tolist() + [len(index.SignatureModules(0))])
+    testsPassed += Check("server: modules together",
+        ids("/module-signatures?q=a.dll&q=b.dll"), index.SignaturesWithAllModules(["a.dll", "b.dll"], np.arange(len(index.signatures))).tolist())
+    testsPassed += Check("server: module list", [m["module"] for m in results["/modules?offset=1&limit=2"][1]["items"]], index.modules[1:3])
+    testsPassed += Check("server: frame search",
+        [(item["id"], item["stackId"]) for item in results["/frames?q=weird"][1]["items"]],
+        [(index.stackSig[i], index.stackOrdinal[i]) for i in index.StacksMatchingFrames("weird", True)])
+    testsPassed += Check("server: co-loaded modules",
+        results["/co-modules?q=evil&top=2"][1]["items"],
+        [{"module": "evil.dll", "stacks": int(index.moduleStacks[index.modules.index("evil.dll")]),
+          "coLoaded": [{"module": index.modules[m], "stacks": int(c)}
+                       for m, c in zip(*index.CoLoadedModules(index.modules.index("evil.dll"), 2))]}])
+    testsPassed += Check("server: signature by hash",
+        results["/signature-hash/4a8e6845b97cf637"][1]["id"], index.signatures.index("xul!someFn"))
+    testsPassed += Check("server: stack detail",
+        results["/stack/0/1"][1]["frames"],
+        [utils.FrameDictToString(f)[0] for f in index.stacks[index.StacksForSignature(0)[1]]["frames"]])
+    testsPassed += Check("server: errors", [results[p][0] for p in paths[-3:]], [404, 404, 400])
+    testsPassed += Check("server: cached answers are the same", again, first)
+    testsPassed += Check("server: cache holds the good answers", len(api.cache), len(paths) - 1)
+
+    # a query that fails for reasons of its own
+    broken = Sigserver.QueryApi(index)
+    async def run(aFunction):
+        return aFunction()
+    broken.Modules = lambda aOffset, aLimit: 1 / 0
+    status, body = asyncio.run(broken.Handle("/modules", run))
+    testsPassed += Check("server: internal errors are 500 and not cached",
+        (status, "ZeroDivisionError" in json.loads(body)["error"], len(broken.cache)), (500, True, 0))
+    testsRun += 14
+
+    return testsRun, testsPassed
+
+def RunAdversarialTests(utils):
+    print("\n================================================================================")
+    print("ADVERSARIAL INPUT TESTS\n")
+
+    testsRun = 0
+    testsPassed = 0
+
+    # The linear rewrites must give exactly what the regexes they replaced
+    # gave, on the inputs that made those regexes slow. How long they take is
+    # for StacksigBench to report, not for the tests.
+    symbols = [symbol for _, symbol in StacksigBench.AdversarialSymbols(1000)]
+    symbols += list(StacksigBench.FuzzSymbols(500, 200))
+    def findOperator(aFunction):
+        match = re.search(r"(?P<all>\boperator\b(?P<op>((\(\s*\))|.*?)))(\(|$)", aFunction)
+        return (match.start("all"), match.end("all"), match.group("op")) if match else None
+    testsPassed += Check("adversarial: ReplaceEnclosed matches the regexes",
+        [s for s in symbols if Stacksig.ReplaceEnclosed(s, "`", "'", "unnamed") != re.sub(r"\`.*?\'", "unnamed", s) or
+            Stacksig.ReplaceEnclosed(s, "[", "]", " ") != re.sub(r"\[.*?\]", " ", s)][:3],
+        [])
+    testsPassed += Check("adversarial: FindOperator matches the regex",
+        [s for s in symbols if Stacksig.FindOperator(s) != findOperator(s)][:3], [])
+    testsPassed += Check("adversarial: PrettyFunction matches the re.sub chain",
+        [s for s in symbols if Stacksig.PrettyFunction(s) != StacksigBench.ChainedPrettyFunction(s)][:3], [])
+    testsRun += 3
+
+    return testsRun, testsPassed
+
+def RunPagerTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("PAGER TESTS\n")
+
+    pulled = []
+    def source():
+        for i in range(1000000):
+            pulled.append(i)
+            yield str(i)
+
+    pager = Pager.Pager(source(), 10)
+    testsPassed += Check("pager: first page", pager.GetPage(0), ([str(i) for i in range(10)], True))
+    testsPassed += Check("pager: only pulls one page plus one line", len(pulled), 11)
+    pager.GetPage(2)
+    pager.GetPage(1)
+    testsPassed += Check("pager: earlier pages are not recomputed", len(pulled), 31)
+    testsPassed += Check("pager: last page", Pager.Pager(iter(["a", "b", "c"]), 2).GetPage(1), (["c"], False))
+    testsRun += 4
+
+    return testsRun, testsPassed
+
+def RunSnapshotTests(utils):
+    testsRun = 0
+    testsPassed = 0
+
+    print("\n================================================================================")
+    print("SNAPSHOT TESTS\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inputPath = os.path.join(tmp, "outp.py")
+        snapshotPath = os.path.join(tmp, "outp.snapshot")
+        with open(inputPath, "w") as f:
+            f.write("[]")
+        index = Sigindex.SigIndex(TestData_Corpus.MakeCorpus(utils, 200))
+        key = Sigsnapshot.SnapshotKey(inputPath, utils)
+        Sigsnapshot.Save(snapshotPath, key, index)
+
+        loaded = Sigsnapshot.Load(snapshotPath, key)
+        testsPassed += Check("snapshot: round trip",
+            (loaded.signatures, loaded.counts.tolist(), loaded.sigModules, loaded.stacks),
+            (index.signatures, index.counts.tolist(), index.sigModules, index.stacks))
+
+        otherRules = Stacksig.Stacksig()
+        otherRules.floorFrameSubstrings = otherRules.floorFrameSubstrings + ("RtlUserThreadStart",)
+        testsPassed += Check("snapshot: rule change invalidates",
+            Sigsnapshot.Load(snapshotPath, Sigsnapshot.SnapshotKey(inputPath, otherRules)), None)
+
+        with open(inputPath, "w") as f:
+            f.write("[ ]")
+        testsPassed += Check("snapshot: input change invalidates",
+            Sigsnapshot.Load(snapshotPath, Sigsnapshot.SnapshotKey(inputPath, utils)), None)
+        testsRun += 3
+
+    return testsRun, testsPassed
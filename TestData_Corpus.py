@@ -0,0 +1,71 @@
+import json
+import random
+
+import TestData_Signatures
+
+# Functions defined here:
+#     MakeCorpus            a reproducible corpus of stack records
+#     WritePingDump         writes stack records as a ping dump
+#     WriteMixedPingDump    a ping dump with ineligible pings mixed in
+#
+# Corpora and ping dumps built from the signature test stacks, shared by
+# StacksigTests.py and StacksigBench.py.
+
+# A reproducible corpus built from the signature test stacks, with repeated
+# clients so that dedup has something to do.
+def MakeCorpus(utils, aNumStacks, aSeed = 1):
+    rng = random.Random(aSeed)
+    modules = ["a.dll", "b.dll", "c.dll", "inject.dll", "evil.dll", "foo.dll"]
+    stacks = []
+    for i in range(aNumStacks):
+        testIdx = rng.randrange(len(TestData_Signatures.tests))
+        t = TestData_Signatures.tests[testIdx]
+        pool = modules[:2 + testIdx % 5] # so modules are not spread evenly
+        stack = {
+            "frames": [dict(f, frame=j) for j, f in enumerate(t["stackFrames"])],
+            "clientID": "client{}".format(rng.randrange(aNumStacks // 20 + 1)),
+            "threadName": t["threadName"] if "threadName" in t else rng.choice([None, "Main"]),
+            "modules": rng.sample(pool, rng.randrange(1, 3)),
+        }
+        stack["signature"], _ = utils.StackToSignature(stack["frames"], stack["threadName"])
+        stacks.append(stack)
+    return stacks
+
+# Writes aStacks (as made by MakeCorpus) to aPath as a ping dump, one ping per
+# stack, in the shape Pingdata.ReadResults expects.
+def WritePingDump(aPath, aStacks):
+    with open(aPath, "w") as f:
+        for stack in aStacks:
+            ping = {
+                "client_id": stack["clientID"],
+                "environment": {"system": {"is_wow64": False}},
+                "payload": {"events": [{
+                    "thread_name": stack["threadName"] or "",
+                    "modules": [{"module_name": "c:\\windows\\" + m.upper()} for m in stack["modules"]],
+                }]},
+                "symbolicated_stacks": json.dumps({"results": [{"stacks": [stack["frames"]]}]}),
+            }
+            f.write(json.dumps(ping, separators=(",", ":")) + "\n")
+
+# Like WritePingDump, but only every aEligibleEvery-th ping is eligible; the
+# others are wow64, or lack their client, stacks or results, in turn.
+def WriteMixedPingDump(aPath, aStacks, aEligibleEvery = 2):
+    WritePingDump(aPath, aStacks)
+    with open(aPath, "r") as f:
+        pings = [json.loads(line) for line in f]
+    kind = 0
+    for i, ping in enumerate(pings):
+        if i % aEligibleEvery == 0:
+            continue
+        if kind == 0:
+            ping["environment"]["system"]["is_wow64"] = True
+        elif kind == 1:
+            del ping["client_id"]
+        elif kind == 2:
+            del ping["symbolicated_stacks"]
+        else:
+            ping["symbolicated_stacks"] = json.dumps({"errors": ["symbolication failed"]})
+        kind = (kind + 1) % 4
+    with open(aPath, "w") as f:
+        for ping in pings:
+            f.write(json.dumps(ping, separators=(",", ":")) + "\n")
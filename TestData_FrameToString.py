@@ -401,6 +401,20 @@ tests = [
         "frame": 0,
         "function": "static void xyz::abc() const",
     },
+
+    # untrusted input limits
+    {
+        "desc": "framesig: over-long symbol is truncated before parsing",
+        "forSignaturification": True,
+        "expected": "f",
+        "function": "f(" + "x" * 5000 + ")",
+    },
+    {
+        "desc": "framesig: unclosed backticks and brackets",
+        "forSignaturification": True,
+        "expected": "f",
+        "function": "`a`b[c[d `e' f(int)",
+    },
     # {
     #     # this is basically the most vexing and would require proper C++ type
     #     # parsing. so it's going to be unparsable.
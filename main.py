@@ -3,13 +3,30 @@
 from importlib import reload
 import json
 import os
+import Pager
 import re
+import Pingdata
+import Sigindex
+import Sigmem
+import Sigpartial
+import Sigsnapshot
+import Sigtime
 import Stacksig
 import StacksigTests
 import sys
 import time
+import tracemalloc
 
 MAX_LIST_LEN = 40
+# gen reads the first of these that exists
+DUMP_PATHS = ["big.json", "big.json.gz", "big.json.xz", "big.json.bz2"]
+SNAPSHOT_PATH = "outp.snapshot"
+
+# Set to keep only a random sample of this many stacks per signature for the
+# s command, and optionally a budget in bytes for all of them. Counts still
+# cover every stack. None keeps everything.
+MAX_SAMPLE_STACKS = None
+SAMPLE_MEMORY_BUDGET = None
 
 
 totalStart = time.time()
@@ -19,79 +36,86 @@ global currentStackId
 global currentSigId
 currentStackId = None
 currentSigId = None
+pager = None
+timeline = None
 
-def GetLeafName(path):
-    return os.path.split(path)[1].lower()
+def FindDump():
+    for path in DUMP_PATHS:
+        if os.path.isfile(path):
+            return path
+    return None
 
+# Yields the stack records of the dump as they're read, from the result that
+# goes past the first aSkipStacks stacks until at least aLimitStacks.
 def GetData(aSkipStacks, aLimitStacks):
     global pings
     global results
-    ret = []
+    numStacks = 0
     numStacksTouched = 0
-    with open("big.json", 'r', errors = 'replace') as f:
-        for line in f:
-            line = line.replace(":true", ":True").replace(":false", ":False")
-            data = eval(line)
-            pings += 1
-            if data["environment"]["system"]["is_wow64"]:
-                continue
-            if not ("symbolicated_stacks" in data) or not ("client_id" in data):
-                continue
-            stacks = data["symbolicated_stacks"]
-            realstacks = eval(stacks)
-            if "results" not in realstacks:
-                continue
-            results += len(realstacks["results"])
-            for idx, result in enumerate(realstacks["results"]):
-                event = data["payload"]["events"][idx]
-                if not event:
-                    print("No corresponding event!")
-                    continue
-                filtered = list(map(lambda stack: {
-                    "frames": stack,
-                    "clientID": data["client_id"],
-                    "threadName": event["thread_name"],
-                    "modules": list(map(lambda m: GetLeafName(m["module_name"]), event["modules"]))
-                    }, filter(lambda stack: stack, result["stacks"])));
-                numStacksTouched += len(filtered)
-                if numStacksTouched > aSkipStacks:
-                    ret.extend(filtered)
-                    if len(ret) >= aLimitStacks:
-                        return ret
+    stats = {"pings": 0, "results": 0}
+    for filtered in Pingdata.ReadResults(FindDump(), stats):
+        numStacksTouched += len(filtered)
+        if numStacksTouched > aSkipStacks:
+            yield from filtered
+            numStacks += len(filtered)
+            if numStacks >= aLimitStacks:
+                break
+    pings += stats["pings"]
+    results += stats["results"]
 
 def doGenData(aSkipStacks, aLimitStacks):
     start = time.time()
 
-    if not os.path.isfile('big.json'):
+    if not FindDump():
         print("\n!!")
         print("You need a JSON data source called 'big.json' to generate data from,")
-        print("where each line is raw JSON ping.")
+        print("where each line is raw JSON ping. It can be compressed as")
+        print("'big.json.gz', 'big.json.xz' or 'big.json.bz2'.")
         exit(0)
 
-    stacks = GetData(aSkipStacks, aLimitStacks)
-    end = time.time()
-    print("Slow load ({}): {}".format(len(stacks), end - start))
+    # The same text as formatting the whole list, written a stack at a time
+    # so the list is never held.
+    numStacks = 0
     with open("outp.py", "w") as text_file:
-        text_file.write("{}".format(stacks))
+        text_file.write("[")
+        for stack in GetData(aSkipStacks, aLimitStacks):
+            text_file.write("{}{}".format(", " if numStacks else "", stack))
+            numStacks += 1
+        text_file.write("]")
+    end = time.time()
+    print("Slow load ({}): {}".format(numStacks, end - start))
 
     print("{} pings found".format(pings))
     print("{} results found".format(results))
-    print("{} stacks found".format(len(stacks)))
+    print("{} stacks found".format(numStacks))
 
 def dumpSigList():
-    global uniqueSignatures
+    global sigIndex
     with open("sigs.txt", "w") as text_file:
-        text_file.write("\n".join(sorted(list(map(lambda s: s["signature"], uniqueSignatures)))))
+        text_file.write("\n".join(sorted(sigIndex.signatures)))
 
 def InitData():
     global stacks
-    global uniqueSignatures
+    global sigIndex
+    global timeline
 
     utils = Stacksig.Stacksig()
+    DropPager() # its lines may still read the old index
 
     if not os.path.isfile('outp.py'):
         doGenData(0, 10)
 
+    # Reuse the processed state from last time if nothing it depends on has
+    # changed.
+    start = time.time()
+    snapshotKey = Sigsnapshot.SnapshotKey("outp.py", utils, (MAX_SAMPLE_STACKS, SAMPLE_MEMORY_BUDGET))
+    state = Sigsnapshot.Load(SNAPSHOT_PATH, snapshotKey)
+    if state:
+        sigIndex, timeline = state
+        stacks = sigIndex.stacks
+        print("Snapshot load ({}): {}".format(len(stacks), time.time() - start))
+        return
+
     start = time.time()
     with open("outp.py", 'r') as f:
         stacks = eval(f.read());
@@ -99,157 +123,228 @@ def InitData():
     print("Fast load ({}): {}".format(len(stacks), end - start))
     print("Processing {} stacks in original data".format(len(stacks)))
 
-    # Add signature to each stack
-    for stack in stacks:
+    # remove duplicate signatures per client_id, to not skew the data.
+    # E.g. if a single user is sending us 10,000 of the same event. we want to get
+    # unique events per user
+    #
+    # The partial aggregate does the dedup as stacks are added. With
+    # MAX_SAMPLE_STACKS it only keeps the frames of a sample, and each stack
+    # is let go of once it's added, so the rest are freed as we go.
+    partial = Sigpartial.PartialAggregate(MAX_SAMPLE_STACKS, SAMPLE_MEMORY_BUDGET)
+    timeline = Sigtime.Timeline()
+    for i, stack in enumerate(stacks):
+        stacks[i] = None
         if not stack:
             continue
-        signature, debug = utils.StackToSignature(
+        # Add signature to each stack. The debug output isn't kept;
+        # StackReport regenerates it for the one stack being looked at.
+        signature, _ = utils.StackToSignature(
             stack["frames"],
-            stack["threadName"] if "threadName" in stack else None)
+            stack["threadName"] if "threadName" in stack else None,
+            False)
 
         stack["signature"] = signature
-        stack["signatureDebug"] = debug
 
-    # remove duplicate signatures per client_id, to not skew the data.
-    # E.g. if a single user is sending us 10,000 of the same event. we want to get
-    # unique events per user
-    t = {}
-    for stack in stacks:
-        t["{}|{}".format(stack["clientID"], stack["signature"])] = stack;
-
-    print("Removed {} duplicate-ish stacks".format(len(stacks) - len(t)))
-    stacks = t.values()
-
-    # get all unique signatures
-    uniqueSignatures = list(map(lambda sig: {
-        "signature": sig,
-        "count": 0,
-        "modules": set()
-        }, set(map(lambda stack: stack["signature"], stacks))))
-
-    # add occurrences and modules to the signatures
-    for sig in uniqueSignatures:
-            for stack in stacks:
-                    if stack["signature"] == sig["signature"]:
-                         sig["count"] += 1
-                         sig["modules"] |= set(stack["modules"])
-
-    # sort desc by occurrence
-    uniqueSignatures.sort(key=lambda sig: sig["count"], reverse=True)
-
-    # add a unique ID
-    for c, sig in enumerate(uniqueSignatures):
-            sig["id"] = c
+        # Time buckets are counted before the dedup, which keeps only one
+        # stack per client and signature for the whole corpus.
+        timeline.AddStack(stack)
+        partial.AddStack(stack)
+
+    # The index does the counting and module aggregation over integer IDs,
+    # and assigns signature IDs by descending occurrence.
+    sigIndex = partial.ToIndex()
+    print("Removed {} duplicate-ish stacks".format(partial.stats["stacks"] - len(partial.entries)))
+    if sigIndex.numSampledOut:
+        print("Sampled out {} stacks".format(sigIndex.numSampledOut))
+    stacks = sigIndex.stacks
+    sigIndex.BuildFrameText()
+
+    Sigsnapshot.Save(SNAPSHOT_PATH, snapshotKey, (sigIndex, timeline))
+
+# Replaces the session's data with a partial aggregate written by
+# Sigpartial.py, eg the merged result of a sharded run.
+def doLoadPartial(aPath):
+    global stacks
+    global sigIndex
+    global timeline
+    start = time.time()
+    DropPager()
+    partial = Sigpartial.PartialAggregate.Load(aPath)
+    sigIndex = partial.ToIndex(MAX_SAMPLE_STACKS, SAMPLE_MEMORY_BUDGET)
+    stacks = sigIndex.stacks
+    timeline = None # partial aggregates only keep one stack per client
+    print("Loaded {} stacks, {} signatures from {} pings in {} seconds".format(
+        len(stacks), len(sigIndex.signatures), partial.stats["pings"], time.time() - start))
+
+# Keeps only a random sample of at most aSize stacks per signature, within
+# aBudget bytes if given.
+def doSample(aSize, aBudget):
+    global stacks
+    global sigIndex
+    before = len(sigIndex.stacks)
+    DropPager() # stack IDs are renumbered
+    sigIndex.SampleStacks(aSize, aBudget)
+    stacks = sigIndex.stacks
+    print("Kept {} of {} stacks".format(len(stacks), before))
+
+# Shows how much memory each part of the session takes. aArg "on" / "off"
+# starts or stops tracemalloc instead.
+def doMemory(aArg):
+    global sigIndex
+    if aArg == "on":
+        tracemalloc.start()
+        print("tracemalloc on")
+        return
+    if aArg == "off":
+        tracemalloc.stop()
+        print("tracemalloc off")
+        return
+    components = sigIndex.Components()
+    components.append(("pager", [pager.lines] if pager else []))
+    components.append(("time buckets", [timeline]))
+    doPage(Sigmem.Report(components))
+
+# Forgets the last listing. Listings are generators that read sigIndex as
+# they're paged through, so one started before the data changed would mix the
+# old IDs with the new data.
+def DropPager():
+    global pager
+    pager = None
+
+# Shows the first page of aLines, an iterable of output lines which is only
+# consumed as far as the pages looked at. "n" and "p" move between pages.
+def doPage(aLines):
+    global pager
+    pager = Pager.Pager(aLines, MAX_LIST_LEN)
+    pager.Show(0)
 
 def doSig(aSigFilter):
-    global stacks
-    global uniqueSignatures
-    usigsFiltered = list(
-        uniqueSignatures if not aSigFilter
-            else filter(lambda s: aSigFilter.lower() in s["signature"].lower(), uniqueSignatures))
-    #print("Found {} non-null stacks".format(len(stacks)))
+    global sigIndex
+    usigsFiltered = sigIndex.FilterSignatures(aSigFilter)
     print("Found {} unique signatures".format(len(usigsFiltered)))
-    for sig in filter(lambda s: True, usigsFiltered[:MAX_LIST_LEN]):
-            print("  {:3d} stacks, {:3d} mods for sigID {:3d} : {}".format(
-                sig["count"],
-                len(sig["modules"]),
-                sig["id"],
-                sig["signature"]))
+    doPage("  {:3d} stacks, {:3d} mods for sigID {:3d} : {}".format(
+                sigIndex.counts[sigId],
+                sigIndex.moduleCounts[sigId],
+                sigId,
+                sigIndex.signatures[sigId])
+            for sigId in usigsFiltered)
+
+# Returns the signature ID aArg names: an ID, or "#" and a signature hash as
+# shown by sig, which stays the same across reloads. Returns -1 for a hash
+# that isn't in the data.
+def SigIdFromArg(aArg):
+    global sigIndex
+    if aArg.startswith("#"):
+        sigId = sigIndex.SignatureForHash(int(aArg[1:], 16))
+        return -1 if sigId is None else sigId
+    return int(aArg)
 
 def doSigDetails(sigId):
-    global stacks
-    global uniqueSignatures
-    matchSignature = next((sig for sig in uniqueSignatures if sig["id"] == sigId), None)
-    if not matchSignature:
+    global sigIndex
+    if sigId < 0 or sigId >= len(sigIndex.signatures):
         print("No matching signature for ID {}".format(sigId))
         return
+    modules = sigIndex.SignatureModules(sigId)
     print ("{} modules represented by signature: {}".format(
-        len(matchSignature["modules"]),
-        matchSignature["signature"]))
-    for mod in sorted(matchSignature["modules"]):
+        len(modules),
+        sigIndex.signatures[sigId]))
+    print("Hash #{}".format(Stacksig.FormatSignatureHash(int(sigIndex.signatureHashes[sigId]))))
+    for mod in modules:
         print("    " + mod)
 
 def doModuleSignatures(mod):
-    global stacks
-    global uniqueSignatures
-    for sig in uniqueSignatures:
-        if any(mod in str for str in sig["modules"]):
-            print ("ID {}, sig {}".format(sig["id"], sig["signature"]))
+    global sigIndex
+    doPage("ID {}, sig {}".format(sigId, sigIndex.signatures[sigId])
+        for sigId in sigIndex.SignaturesWithModule(mod))
+
+def doModulesTogether(mods):
+    global sigIndex
+    if not mods:
+        print("Usage: mb <Q> <Q2>..; give at least one module to match")
+        return
+    sigIds = sigIndex.SignaturesWithAllModules(mods)
+    union = 0
+    for sigId in sigIds:
+        union |= sigIndex.sigModules[sigId]
+    print("{} signatures loaded all of {}, {} modules between them".format(
+        len(sigIds), ", ".join(mods), Sigindex.PopCount(union)))
+    doPage("ID {}, sig {}".format(sigId, sigIndex.signatures[sigId]) for sigId in sigIds)
 
 def doListModules():
-    global stacks
-    global uniqueSignatures
-    uniqueModules = set()
-    for sig in uniqueSignatures:
-        uniqueModules |= sig["modules"]
-    uniqueModules2 = []
-    for mod in uniqueModules:
-        count = 0
-        # how many unique signatures contain this module
-        for sig in uniqueSignatures:
-            count += 1 if mod in sig["modules"] else 0
-        uniqueModules2.append({
-            "count": count,
-            "module": mod
-            })
-    uniqueModules2.sort(key=lambda x: x["count"], reverse=True)
+    global sigIndex
+    # how many unique signatures contain each module
+    moduleIds, counts = sigIndex.ModulePrevalence()
     print("N: M, where N stack signatures loaded module M")
-    for mod in uniqueModules2[:MAX_LIST_LEN]:
-        print("{:3d}: {}".format(mod["count"], mod["module"]))
+    doPage("{:3d}: {}".format(count, sigIndex.modules[modId]) for modId, count in zip(moduleIds, counts))
+
+# For every module whose name contains aQuery, lists the modules most often
+# loaded by the same stacks, eg the other DLLs an injector ships with.
+def doCoLoaded(aQuery):
+    global sigIndex
+    moduleIds = Sigindex.BitsToIds(sigIndex.ModuleBits(aQuery)).tolist()
+    def lines():
+        for modId in moduleIds:
+            total = int(sigIndex.moduleStacks[modId])
+            yield "{} ({} stacks):".format(sigIndex.modules[modId], total)
+            for otherId, count in zip(*sigIndex.CoLoadedModules(modId, MAX_LIST_LEN)):
+                yield "  {:5d} ({:5.1f}%): {}".format(count, 100.0 * count / total, sigIndex.modules[otherId])
+    print("N (P%): M, where N stacks (P% of the module's) also loaded M")
+    doPage(lines())
+
+# Lists signatures (or modules, with aModules) whose unique clients over the
+# last day are at least aFactor times their daily average over the week
+# before.
+def doTrending(aFactor, aModules):
+    global timeline
+    if not timeline or not timeline.hourlySignatures.Buckets():
+        print("No time data; pings need a creation_date")
+        return
+    buckets = timeline.hourlyModules if aModules else timeline.hourlySignatures
+    spikes = buckets.Spikes(24, 7 * 24, aFactor)
+    print("{} {} at least {}x their weekly baseline over the last day".format(
+        len(spikes), "modules" if aModules else "signatures", aFactor))
+    doPage("  {:5d} clients, {:8.1f} expected, {:>6s}x : {}".format(
+            count, expected, "new" if not expected else "{:.1f}".format(ratio), key)
+        for key, count, expected, ratio in spikes)
+
+# Shows unique clients per day for signature aSigId.
+def doSignatureTrend(aSigId):
+    global sigIndex
+    global timeline
+    if aSigId < 0 or aSigId >= len(sigIndex.signatures):
+        print("No matching signature for ID {}".format(aSigId))
+        return
+    if not timeline or not timeline.dailySignatures.Buckets():
+        print("No time data; pings need a creation_date")
+        return
+    print("Clients per day for signature: {}".format(sigIndex.signatures[aSigId]))
+    doPage("  {}  {:5d}".format(time.strftime("%Y-%m-%d", time.gmtime(start)), count)
+        for start, count in timeline.dailySignatures.Series(sigIndex.signatures[aSigId]))
 
 def FrameToString(aFrame):
     utils = Stacksig.Stacksig()
-    x = utils.StackFrameToString(
-        aFrame["module"] if "module" in aFrame else "",
-        aFrame["module_offset"] if "module_offset" in aFrame else "",
-        aFrame["function"] if "function" in aFrame else "",
-        aFrame["function_offset"] if "function_offset" in aFrame else "")
-    return x
+    return utils.FrameDictToString(aFrame)
+
+# Yields the number of signatures with a frame matching aQuery, then a line
+# for the first stack of each. The stacks are all scanned for the count, but
+# only the lines asked for are formatted.
+def SearchStackFrames(aQuery):
+    global sigIndex
+    found = list(sigIndex.StacksMatchingFrames(aQuery, True))
+    yield "Found {} unique signatures".format(len(found))
+    for i in found:
+        sigId = sigIndex.stackSig[i]
+        yield "  sigID {:3d} stackID {:3d} : {}".format(
+            sigId,
+            sigIndex.stackOrdinal[i],
+            sigIndex.signatures[sigId])
 
 def doSearchStackFrames(aQuery):
-    global stacks
-    global uniqueSignatures
-
-    for uniqueSig in uniqueSignatures:
-        matchingStacks = list(filter(lambda s: s["signature"] == uniqueSig["signature"], stacks))
-        for i, ms in enumerate(matchingStacks):
-            ms["stackID"] = i
-
-    class StackHashAdapter:
-        def __init__(self, aStack):
-            self.mStack = aStack
-        def __str__(self):
-            return str(self.mStack["signature"])
-        def __hash__(self):
-            return hash(self.mStack["signature"])
-        def __eq__(self,other):
-            return self.mStack["signature"] == other.mStack["signature"]
-
-    matchingStacks = set() # of StackHashAdapter
-    for stack in stacks:
-        for frame in stack["frames"]:
-            if (aQuery.lower() in FrameToString(frame)[0].lower()):
-                matchingStacks.add(StackHashAdapter(stack))
-                break
-
-    matchingStacks = list(matchingStacks)
-    #matchingStacks.sort(key=lambda x: x.mStack["count"], reverse=True)
-    print("Found {} unique signatures".format(len(matchingStacks)))
-    for stack2 in matchingStacks[:MAX_LIST_LEN]:
-        stack = stack2.mStack
-        usig = next(filter(lambda us: us["signature"] == stack["signature"], uniqueSignatures))
-        print("  sigID {:3d} stackID {:3d} : {}".format(
-            usig["id"],
-            stack["stackID"],
-            usig["signature"]))
-                         #    if stack["signature"] == sig["signature"]:
-                         # sig["count"] += 1
-                         # sig["modules"] |= set(stack["modules"])
-    # sigID {} stack {}
+    doPage(SearchStackFrames(aQuery))
 
 def doStackPrint(sigId):
     global stacks
-    global uniqueSignatures
+    global sigIndex
     global currentStackId
     global currentSigId
 
@@ -261,42 +356,49 @@ def doStackPrint(sigId):
 
     currentSigId = sigId
 
-    matchSignature = next(sig for sig in uniqueSignatures if sig["id"] == sigId)
+    if sigId < 0 or sigId >= len(sigIndex.signatures):
+        print("No matching signature for ID {}".format(sigId))
+        return
     print ("{} stacks represented by signature: {}".format(
-        matchSignature["count"],
-        matchSignature["signature"]))
-    matchingStacks = list(filter(lambda s: s["signature"] == matchSignature["signature"], stacks))
-    if not matchingStacks:
+        sigIndex.counts[sigId],
+        sigIndex.signatures[sigId]))
+    numStacks = sigIndex.NumStacks(sigId)
+    if numStacks < sigIndex.counts[sigId]:
+        print("{} of them sampled".format(numStacks))
+    if not numStacks:
         print("!! No stacks found")
         return
     if currentStackId is None:
         currentStackId = 0
-    if currentStackId < 0 or currentStackId >= len(matchingStacks):
-        print("!! out of range of 0-{}; setting to 0".format(len(matchingStacks)))
+    if currentStackId < 0 or currentStackId >= numStacks:
+        print("!! out of range of 0-{}; setting to 0".format(numStacks))
         currentStackId = 0
-    stack = matchingStacks[currentStackId]
+    stack = stacks[sigIndex.StacksForSignature(sigId)[currentStackId]]
 
-    print ("\nDebug:")
-    for msg in stack["signatureDebug"]:
-        print("    " + msg)
+    doPage(StackReport(stack, currentStackId))
 
-    print ("\n{} modules.".format(len(stack["modules"])))
-    for mod in stack["modules"]:
-        print("    " + mod)
-
-    print ("\nStack index {}".format(currentStackId))
-    for frame in stack["frames"]:
-        x = FrameToString(frame)
-        print("    " + x[0])
+# Yields the lines of the detailed report for one stack. Frames are only
+# pretty-printed when their page is shown.
+def StackReport(aStack, aStackId):
+    utils = Stacksig.Stacksig()
+    _, debug = utils.StackToSignature(
+        aStack["frames"],
+        aStack["threadName"] if "threadName" in aStack else None)
+    yield "\nDebug:"
+    for msg in debug:
+        yield "    " + msg
+
+    yield "\n{} modules.".format(len(aStack["modules"]))
+    for mod in aStack["modules"]:
+        yield "    " + mod
+
+    yield "\nStack index {}".format(aStackId)
+    for frame in aStack["frames"]:
+        x = utils.FrameDictToString(frame)
+        yield "    " + x[0]
         # for l in x[1]:
-        #     print("    (debug): " + l)
-
-
-
-InitData()
+        #     yield "    (debug): " + l
 
-end = time.time()
-print("init took {} seconds".format(end - totalStart))
 
 def doHelp():
     print("Untrusted Modules Signature Generator")
@@ -305,112 +407,160 @@ def doHelp():
     print("  q              Quit")
     print("  d              Dump signature list to sigs.txt")
     print("  r              Recompile the sig gen modules, re-process data")
-    print("  len <N>        Set MAX_LIST_LEN")
+    print("  len <N>        Set MAX_LIST_LEN, the number of lines per page")
+    print("  n              Show the next page of the last listing")
+    print("  p              Show the previous page of the last listing")
     print("  gen <N>        Grab N stacks from 'big.json', output in outp.py,")
     print("  gen <S> <N>    Grab N stacks from 'big.json' after skipping S")
     print("                 stacks, output in outp.py,")
     print("                 and re-process data.")
     print("  t              Recompile tests and run them")
+    print("  mem            Show memory used per component, and the top")
+    print("                 allocation sites if tracemalloc is on")
+    print("  mem on|off     Start or stop tracemalloc")
+    print("  load <F>       Replace the data with partial aggregate F, as")
+    print("                 written by Sigpartial.py")
+    print("  sample <N> <B> Keep only a random sample of N stacks per signature,")
+    print("                 optionally within B bytes. Counts are unchanged.")
     print("")
     print("  \\ <Q>          Show a list of stack signatures, optionally matching")
     print("                 substring Q")
-    print("  sig <ID>       Show info about the signature <ID>")
+    print("  sig <ID>       Show info about the signature <ID>, or #<HASH> for")
+    print("                 the signature with that hash, which is stable")
+    print("                 across reloads")
     print("  s <ID> <SID>   Show detailed stack report for signature <ID>,")
     print("                 and 0-based stack ID <SID>.")
     print("  fn <Q>         Test pretty-printing / sig for function name Q")
     print("")
     print("  ms <Q>         Show stacks signatures that loaded module Q")
+    print("  mb <Q> <Q2>..  Show stack signatures that loaded modules matching")
+    print("                 every one of Q, Q2, ...")
     print("  lm             List all modules seen, sorted by prevalence")
+    print("  co <Q>         Show the modules most often loaded by the same stacks")
+    print("                 as each module matching Q")
     print("")
     print("  sf <Q>         Search for signatures whose stack frames match Q")
     print("")
+    print("  tr <F>         Show signatures whose clients over the last day are at")
+    print("                 least F (default 3) times their weekly baseline")
+    print("  trm <F>        Same as tr, for modules")
+    print("  ts <ID>        Show clients per day for signature <ID>")
+    print("")
     print("  sm             Sort signature list by # of unique modules loaded")
     print("  so             Sort signature list by # of occurrences")
     print("  sa             Sort signature list alphabetically")
     print("  sl <->         Sort signature list by length of signature")
 
-lastCommand = "?"
-
-while True:
-    cmd = input("> ").strip()
-    if not cmd:
-        cmd = lastCommand
-
-    args = cmd.split(" ");
-    lastCommand = cmd
-
-    if args[0] == "?":
-        doHelp()
-    elif args[0] == "q":
-        break
-    elif args[0] == "sig":
-        doSigDetails(int(args[1]))
-    elif args[0] == "len":
-        MAX_LIST_LEN = int(args[1])
-    elif args[0] == "ms":
-        doModuleSignatures(args[1])
-    elif args[0] == "d":
-        dumpSigList()
-    elif args[0] == "sm":
-        uniqueSignatures.sort(key=lambda sig: -len(sig["modules"]))
-        print("Sorting by modules")
-    elif args[0] == "so":
-        uniqueSignatures.sort(key=lambda sig: sig["count"], reverse=True)
-        print("Sorting by occurrence")
-    elif args[0] == "sa":
-        uniqueSignatures.sort(key=lambda sig: sig["signature"])
-        print("Sorting alphabetically")
-    elif args[0] == "sl":
-        uniqueSignatures.sort(key=lambda sig: len(sig["signature"]))
-        print("Sorting by signature length")
-    elif args[0] == "sl-":
-        uniqueSignatures.sort(key=lambda sig: len(sig["signature"]), reverse=True)
-        print("Sorting by signature length (DESC)")
-    elif args[0] == "lm":
-        doListModules()
-    elif args[0] == "sf":
-        doSearchStackFrames(args[1])
-    elif args[0] == "fn":
-        q = cmd[len(args[0]):].strip()
-        print("Function : {}".format(q))
-        utils = Stacksig.Stacksig()
-        x = utils.StackFrameToString(None, None, q, None, True)
-        print("\nFor sig  : {}".format(x[0]))
-        for l in x[1]:
-            print("  (debug): " + l)
-        x = utils.StackFrameToString(None, None, q, None, False)
-        print("\nFor print: {}".format(x[0]))
-        for l in x[1]:
-            print("  (debug): " + l)
-        print("")
-    elif args[0] == "gen":
-        if len(args) == 2:
-            doGenData(0, int(args[1]))
-        if len(args) == 3:
-            doGenData(int(args[1]), int(args[2]))
-        InitData()
-    elif args[0] == "\\":
-        if len(args) == 2:
-            doSig(args[1])
-        else:
-            doSig(None)
-    elif args[0] == "s": # s 79 0
-        sigId = int(args[1].strip())
-        if len(args) == 3:
-            currentSigId = None
-            currentStackId = int(args[2].strip())
-        doStackPrint(sigId)
-    elif args[0] == "r":
-        print("recompiling...")
-        print(reload(Stacksig))
-        InitData()
-    elif args[0] == "t":
-        print("recompiling tests...")
-        print(reload(Stacksig))
-        print(reload(StacksigTests))
-        StacksigTests.Runtests()
-    else:
-        print("Unknown command. ? for help")
+# The prompt only runs when main.py is run directly, so importing it (eg from
+# the tests) doesn't load any data.
+if __name__ == "__main__":
+    InitData()
 
-exit(0)
+    end = time.time()
+    print("init took {} seconds".format(end - totalStart))
+
+    lastCommand = "?"
+
+    while True:
+        cmd = input("> ").strip()
+        if not cmd:
+            cmd = lastCommand
+
+        args = cmd.split(" ");
+        lastCommand = cmd
+
+        if args[0] == "?":
+            doHelp()
+        elif args[0] == "q":
+            break
+        elif args[0] == "n" or args[0] == "p":
+            if not pager:
+                print("Nothing to page through")
+            elif args[0] == "n":
+                pager.Next()
+            else:
+                pager.Previous()
+        elif args[0] == "sig":
+            doSigDetails(SigIdFromArg(args[1]))
+        elif args[0] == "len":
+            MAX_LIST_LEN = int(args[1])
+        elif args[0] == "ms":
+            doModuleSignatures(args[1])
+        elif args[0] == "mb":
+            doModulesTogether(args[1:])
+        elif args[0] == "d":
+            dumpSigList()
+        elif args[0] == "sm":
+            sigIndex.SortSignatures("modules")
+            print("Sorting by modules")
+        elif args[0] == "so":
+            sigIndex.SortSignatures("count")
+            print("Sorting by occurrence")
+        elif args[0] == "sa":
+            sigIndex.SortSignatures("alpha")
+            print("Sorting alphabetically")
+        elif args[0] == "sl":
+            sigIndex.SortSignatures("length")
+            print("Sorting by signature length")
+        elif args[0] == "sl-":
+            sigIndex.SortSignatures("length-desc")
+            print("Sorting by signature length (DESC)")
+        elif args[0] == "lm":
+            doListModules()
+        elif args[0] == "co":
+            doCoLoaded(args[1])
+        elif args[0] == "sf":
+            doSearchStackFrames(args[1])
+        elif args[0] == "tr" or args[0] == "trm":
+            doTrending(float(args[1]) if len(args) > 1 else 3, args[0] == "trm")
+        elif args[0] == "ts":
+            doSignatureTrend(int(args[1]))
+        elif args[0] == "fn":
+            q = cmd[len(args[0]):].strip()
+            print("Function : {}".format(q))
+            utils = Stacksig.Stacksig()
+            x = utils.StackFrameToString(None, None, q, None, True)
+            print("\nFor sig  : {}".format(x[0]))
+            for l in x[1]:
+                print("  (debug): " + l)
+            x = utils.StackFrameToString(None, None, q, None, False)
+            print("\nFor print: {}".format(x[0]))
+            for l in x[1]:
+                print("  (debug): " + l)
+            print("")
+        elif args[0] == "gen":
+            if len(args) == 2:
+                doGenData(0, int(args[1]))
+            if len(args) == 3:
+                doGenData(int(args[1]), int(args[2]))
+            InitData()
+        elif args[0] == "load":
+            doLoadPartial(args[1])
+        elif args[0] == "mem":
+            doMemory(args[1] if len(args) > 1 else None)
+        elif args[0] == "sample":
+            doSample(int(args[1]), int(args[2]) if len(args) > 2 else None)
+        elif args[0] == "\\":
+            if len(args) == 2:
+                doSig(args[1])
+            else:
+                doSig(None)
+        elif args[0] == "s": # s 79 0
+            sigId = int(args[1].strip())
+            if len(args) == 3:
+                currentSigId = None
+                currentStackId = int(args[2].strip())
+            doStackPrint(sigId)
+        elif args[0] == "r":
+            print("recompiling...")
+            print(reload(Stacksig))
+            InitData()
+        elif args[0] == "t":
+            print("recompiling tests...")
+            print(reload(Stacksig))
+            print(reload(StacksigTests))
+            StacksigTests.Runtests()
+        else:
+            print("Unknown command. ? for help")
 
+    exit(0)